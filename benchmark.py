@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for patch.py hot paths
+Run: python3 benchmark.py [name ...]   (no names = run everything)
+     python3 benchmark.py corpus --save new.json --compare old.json
+"""
+
+import sys
+import os
+import time
+import shlex
+import io
+import json
+import hashlib
+import platform
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import patch
+
+
+def time_call(func, *args, repeat=5, number=None):
+    """Return best per-call time in microseconds over several rounds."""
+    if number is None:
+        # Calibrate so each round takes roughly 50ms
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                func(*args)
+            if time.perf_counter() - start > 0.05 or number >= 1_000_000:
+                break
+            number *= 4
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best * 1e6
+
+
+def report(label, micros):
+    ops = 1e6 / micros if micros else float('inf')
+    print(f"  {label:<48} {micros:>12.2f} us   {ops:>12.0f} ops/s")
+
+
+def long_compound_command(segments):
+    """Build a realistic compound command with pipes, lists and redirections."""
+    parts = []
+    for i in range(segments):
+        parts.append(
+            f'FOO_{i}=bar sudo -u deploy env PATH="/opt/bin:$PATH" docker run --rm -v "$(pwd)/src {i}:/app" '
+            f'image:{i} 2>&1 | grep -v "warning; ignored" | tee /tmp/build_{i}.log'
+        )
+    return ' && '.join(parts)
+
+
+def bench_parser():
+    """Shared command parser vs. the previous repeated shlex/lowercase scans."""
+    print("\n[*] Command parser")
+    for segments in (1, 10, 100):
+        cmd = long_compound_command(segments)
+
+        def parse_uncached():
+            patch.parse_command.cache_clear()
+            patch.parse_command(cmd)
+
+        def legacy_scans():
+            # What get_file_system_context + detectors did before: three
+            # shlex.split passes and several lowercase substring scans
+            for _ in range(3):
+                shlex.split(cmd)
+            for _ in range(4):
+                cmd.lower().split()
+
+        def detectors():
+            patch.is_pipe_to_shell(cmd)
+            patch.is_interactive_command(cmd)
+            patch.get_non_interactive_alternative(cmd)
+            patch.get_app_info(cmd)
+
+        print(f"  -- {segments} segment(s), {len(cmd)} chars")
+        report("parse_command (cold)", time_call(parse_uncached))
+        report("legacy shlex x3 + lower scans x4", time_call(legacy_scans))
+        report("all detectors (parse cached)", time_call(detectors))
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint with a fixed latency."""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.server.latency)
+        content = 'ls -la /tmp:::90:::Path does not exist:::The directory was missing.'
+        body = json.dumps({
+            'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{'index': i, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}
+                        for i in range(request.get('n', 1))],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under --jobs 32 and adds 1s SYN retries
+    request_queue_size = 128
+
+
+def start_mock_llm(latency):
+    """Serve MockLLMHandler on a free localhost port; returns the server (call shutdown())."""
+    server = MockLLMServer(('127.0.0.1', 0), MockLLMHandler)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_batch():
+    """Batch mode throughput (commands/s) against a local mock LLM backend."""
+    print("\n[*] Batch mode (mock LLM, 50ms latency)")
+    server = start_mock_llm(latency=0.05)
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{server.server_port}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-mock-benchmark-key-0000')
+    patch.TELEMETRY_ENABLED = False
+    count = 64
+    # Half fail (context + LLM round trip), half succeed (run only)
+    lines = [f'ls /nonexistent-bench-{i}' if i % 2 else f'true {i}' for i in range(count)]
+    try:
+        for jobs in (1, 4, 16, 32):
+            options = {'timeout': None, 'idle_timeout': None, 'jobs': jobs, 'order': 'input'}
+            start = time.perf_counter()
+            summary = patch.run_batch(options, io.StringIO('\n'.join(lines)), out=io.StringIO())
+            elapsed = time.perf_counter() - start
+            assert sum(summary.values()) == count, summary
+            print(f"  {f'{count} commands, --jobs {jobs}':<48} {elapsed:>10.2f} s   {count / elapsed:>10.1f} cmds/s")
+    finally:
+        server.shutdown()
+
+
+def synthetic_log(megabytes, noisy=False):
+    """Build-log-like bytes with a few real errors; noisy logs mention trigger words on every line."""
+    line = (b'[12:00:00] INFO compiling module_%d.c with -Werror -O2 (config: release)\n' if noisy
+            else b'[12:00:00] INFO step %d completed in 0.01s, 42 objects written\n')
+    error = b"\x1b[31merror:\x1b[0m src/foo.c:12: fatal error: openssl/ssl.h: No such file or directory\n"
+    lines = []
+    size = 0
+    i = 0
+    while size < megabytes << 20:
+        lines.append(error if i % 50000 == 25000 else line % i)
+        size += len(lines[-1])
+        i += 1
+    return b''.join(lines)
+
+
+def bench_log_scan():
+    """--from-stdin scanner throughput on clean and trigger-heavy logs."""
+    print("\n[*] Log scanner (--from-stdin)")
+    for noisy in (False, True):
+        data = synthetic_log(64, noisy)
+        start = time.perf_counter()
+        scanner = patch.scan_log(io.BytesIO(data))
+        elapsed = time.perf_counter() - start
+        label = f"64 MB {'noisy' if noisy else 'quiet'} log, {scanner.region_count} regions"
+        print(f"  {label:<48} {elapsed:>10.2f} s   {len(data) / elapsed / 1e6:>10.1f} MB/s")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def load_test(port, concurrency, total, payload):
+    """POST total requests to /fix from concurrency keep-alive clients; returns (elapsed, latencies, statuses)."""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        mine = []
+        for i in counter:
+            body = json.dumps(payload(i))
+            start = time.perf_counter()
+            conn.request('POST', '/fix', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            mine.append(time.perf_counter() - start)
+            with lock:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            if response.will_close:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, sorted(latencies), statuses
+
+
+def bench_serve():
+    """patch serve requests/s and latency percentiles against a mock LLM backend.
+
+    The service and the mock run as separate processes, as in production,
+    so neither competes with the load generator for the GIL.
+    """
+    import subprocess
+    jobs, queue, latency = 16, 48, 0.05
+    print(f"\n[*] Fix service (mock LLM, {latency * 1000:.0f}ms latency, --jobs {jobs} --queue {queue})")
+    mock = subprocess.Popen([sys.executable, __file__, '--mock-llm', str(latency)], stdout=subprocess.PIPE, text=True)
+    mock_port = int(mock.stdout.readline())
+    env = dict(os.environ, OPENAI_BASE_URL=f'http://127.0.0.1:{mock_port}/v1',
+               OPENAI_API_KEY='sk-mock-benchmark-key-0000', PATCH_TELEMETRY='0')
+    server = subprocess.Popen([sys.executable, patch.__file__, 'serve', '--port', '0', '--jobs', str(jobs),
+                               '--queue', str(queue)], stdout=subprocess.PIPE, text=True, env=env)
+    port = int(server.stdout.readline().split('http://127.0.0.1:')[1].split()[0])
+    unique = lambda i: {'command': f'ls /nonexistent-{i}', 'error': f'ls: cannot access /nonexistent-{i}: No such file or directory'}
+    repeated = lambda i: {'command': f'cat config-{i % 8}.yml', 'error': f'cat: config-{i % 8}.yml: No such file or directory'}
+    try:
+        for label, concurrency, total, payload, offset in (('unique', 1, 50, unique, 0), ('unique', 16, 400, unique, 1000),
+                                                           ('unique', 64, 800, unique, 2000), ('unique', 128, 800, unique, 3000),
+                                                           ('8 distinct', 64, 4000, repeated, 0)):
+            elapsed, latencies, statuses = load_test(port, concurrency, total, lambda i: payload(i + offset))
+            codes = ' '.join(f'{code}x{count}' for code, count in sorted(statuses.items()))
+            print(f"  {f'{total} {label}, {concurrency} clients':<30} {total / elapsed:>8.0f} req/s   "
+                  f"p50 {percentile(latencies, 50) * 1000:>6.1f}  p95 {percentile(latencies, 95) * 1000:>6.1f}  "
+                  f"p99 {percentile(latencies, 99) * 1000:>6.1f} ms   {codes}")
+    finally:
+        for process in (server, mock):
+            process.terminate()
+            process.wait()
+
+
+def legacy_categorize(patterns, text):
+    """The previous classifier: one re.search per rule over the whole lowercased text."""
+    text = text.lower()
+    for regex, category in patterns:
+        if regex.search(text):
+            return category
+    return None
+
+
+def bench_classify():
+    """categorize_error_type on 1KB, 1MB and 100MB inputs, including adversarial shapes."""
+    import re
+    print("\n[*] Error classifier (compiled literal sequences vs. previous re.search cascade)")
+    legacy = [(re.compile(pattern), category) for pattern, category in patch.ERROR_TYPE_RULES]
+    shapes = {
+        'clean lines': lambda n: 'step %d ok, 42 objects written\n' * (n // 32),
+        'noisy lines': lambda n: 'compiling module_1.c (config: release)\n' * (n // 40),
+        'one long line': lambda n: 'module x ' * (n // 9),
+        'alternating worst case': lambda n: 'module here\nnot here found\n' * (n // 32),
+        'error at the end': lambda n: 'step ok\n' * (n // 8) + 'error: no such file or directory\n',
+    }
+    for size, label in ((1 << 10, '1KB'), (1 << 20, '1MB'), (100 << 20, '100MB')):
+        print(f"  -- {label}")
+        for shape, make in shapes.items():
+            text = make(size)
+            start = time.perf_counter()
+            category = patch.categorize_error_type(text, '')
+            elapsed = time.perf_counter() - start
+            # The old cascade is quadratic on one long line: minutes at 1MB
+            if size <= 1 << 20 and not (shape == 'one long line' and size > 1 << 10):
+                start = time.perf_counter()
+                legacy_categorize(legacy, text)
+                old = f"{(time.perf_counter() - start) * 1000:>10.2f} ms"
+            else:
+                old = f"{'(skipped)':>13}"
+            print(f"  {shape:<28} {elapsed * 1000:>10.2f} ms   previous {old}   {len(text) / elapsed / 1e6 if elapsed else 0:>8.0f} MB/s   {category.split(':')[0]}")
+
+
+def legacy_app_info(mapping, command):
+    """The previous get_app_info: exact lookup, then every keyword against every word."""
+    parts = [w.lower() for c in patch.parse_command(command).commands for w in c.argv]
+    for part in parts:
+        if part in mapping:
+            return mapping[part]
+    for part in parts:
+        for key, value in mapping.items():
+            if key in part:
+                return value
+    return None
+
+
+def bench_detectors():
+    """All command detectors in one pass, as the app table grows to thousands of entries."""
+    print("\n[*] Command detectors (one automaton pass vs. previous per-keyword scans)")
+    # No app keyword anywhere: the case where every word meets every keyword
+    cmd = ' && '.join(f'FOO_{i}=bar sudo -u deploy make -C "/srv/build {i}" install 2>&1 | tee /tmp/build_{i}.log'
+                      for i in range(3))
+    original = patch.detector_tables
+    try:
+        for extra in (0, 1000, 10000):
+            config = {'apps': {f'tool{i:05d}x': f'Tool {i}' for i in range(extra)}}
+            tables = patch.DetectorTables(config)
+            patch.detector_tables = lambda: tables
+            mapping = tables.apps
+            print(f"  -- {len(mapping)} app keywords")
+            report("detect_command (all four detectors)", time_call(patch.detect_command.__wrapped__, cmd))
+            report("previous get_app_info alone", time_call(legacy_app_info, mapping, cmd))
+    finally:
+        patch.detector_tables = original
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+CORPUS_ROUNDS = 5
+
+
+def corpus_manifest(directory=CORPUS_DIR):
+    """corpus/manifest.json, checked against the files it lists (ValueError if one changed)."""
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for name, entry in manifest['files'].items():
+        with open(os.path.join(directory, name), 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() != entry['sha256']:
+                raise ValueError(f"corpus/{name} changed: bump the manifest version and update its sha256")
+    return manifest
+
+
+def cold(func, *caches):
+    """func with the given lru_caches cleared before every call."""
+    def call(*args):
+        for cache in caches:
+            cache.cache_clear()
+        return func(*args)
+    return call
+
+
+def time_each(func, inputs, rounds=CORPUS_ROUNDS):
+    """Best-of-rounds time in microseconds for each input."""
+    best = [float('inf')] * len(inputs)
+    for _ in range(rounds):
+        for i, args in enumerate(inputs):
+            start = time.perf_counter()
+            func(*args)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return [b * 1e6 for b in best]
+
+
+def summarize(micros):
+    ordered = sorted(micros)
+    return {
+        'calls': len(ordered),
+        'ops_per_sec': round(len(ordered) / (sum(ordered) / 1e6)),
+        'mean_us': round(sum(ordered) / len(ordered), 2),
+        'p50_us': round(percentile(ordered, 50), 2),
+        'p90_us': round(percentile(ordered, 90), 2),
+        'p99_us': round(percentile(ordered, 99), 2),
+        'max_us': round(ordered[-1], 2),
+    }
+
+
+def bench_corpus():
+    """The hot helpers over every entry of the labelled corpus: ops/s and latency percentiles."""
+    manifest = corpus_manifest()
+    examples = patch.load_error_corpus(os.path.join(CORPUS_DIR, 'errors.jsonl'))
+    print(f"\n[*] Hot helpers on corpus v{manifest['version']} ({len(examples)} entries, best of {CORPUS_ROUNDS} rounds)")
+    # The detectors and parser are lru_cached: clear them so every call does the work
+    caches = (patch.detect_command, patch.parse_command)
+    replies = [(f"{e['fix']}:::90:::{e['category']}:::Suggested by the corpus.",) for e in examples if e['fix']]
+    helpers = {
+        'categorize_error_type': (patch.categorize_error_type, [(e['error'], e['command']) for e in examples]),
+        'get_app_info': (cold(patch.get_app_info, *caches), [(e['command'],) for e in examples]),
+        'is_interactive_command': (cold(patch.is_interactive_command, *caches), [(e['command'],) for e in examples]),
+        'get_file_system_context': (cold(patch.get_file_system_context, *caches), [(e['command'],) for e in examples]),
+        'parse_fix_response': (patch.parse_fix_response, replies),
+    }
+    timings = {}
+    print(f"  {'':<26} {'calls':>6} {'ops/s':>10} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>9}")
+    for name, (func, inputs) in helpers.items():
+        stats = timings[name] = summarize(time_each(func, inputs))
+        print(f"  {name:<26} {stats['calls']:>6} {stats['ops_per_sec']:>10,} {stats['p50_us']:>9.1f} "
+              f"{stats['p90_us']:>9.1f} {stats['p99_us']:>9.1f} {stats['max_us']:>9.1f}")
+    # The timings only mean something if the answers are right
+    accuracy = {
+        'category': sum(patch.categorize_error_type(e['error'], e['command']).split(':')[0] == e['category']
+                        for e in examples) / len(examples),
+        'app': sum(patch.get_app_info(e['command']) == e['app'] for e in examples) / len(examples),
+        'fix_parsed': sum(patch.parse_fix_response(reply)[0] == reply.split(':::')[0]
+                          for reply, in replies) / len(replies),
+    }
+    print("  accuracy: " + ", ".join(f"{name} {value:.1%}" for name, value in accuracy.items()))
+    return {'corpus_version': manifest['version'], 'examples': len(examples),
+            'classifier': patch.local_classifier() is not None, 'helpers': timings, 'accuracy': accuracy}
+
+
+def bench_history(rows=1_000_000, failures=100_000):
+    """Attempt history lookups with a million rows: sorted mmap index plus unindexed tail."""
+    import random
+    import tempfile
+    print(f"\n[*] Attempt history ({rows:,} rows over {failures:,} distinct failures)")
+    with tempfile.TemporaryDirectory() as directory:
+        history = patch.AttemptHistory(directory)
+        cases = []
+        for i in range(failures):
+            command, output = f'deploy --target web{i}', f'error: unit web{i}.service failed to start'
+            fingerprint = patch.failure_fingerprint(output)
+            cases.append((command, output, patch.history_key(command, fingerprint).hex(), fingerprint))
+        start = time.perf_counter()
+        with open(history.log_path, 'w') as f:
+            for n in range(rows):
+                command, _, key, fingerprint = cases[n % failures]
+                fix = f'systemctl restart web{n % failures}' if n % 3 else f'deploy --target web{n % failures} --force'
+                f.write(json.dumps({'ts': 1.7e9 + n, 'command': command, 'fingerprint': fingerprint,
+                                    'suggestion': fix, 'applied': True, 'returncode': n % 3 and 0,
+                                    'latency_ms': 900.0, 'key': key}) + '\n')
+        print(f"  {'write log':<48} {time.perf_counter() - start:>10.2f} s   "
+              f"{os.path.getsize(history.log_path) / 1e6:>8.0f} MB")
+        start = time.perf_counter()
+        history.compact()
+        print(f"  {'build index':<48} {time.perf_counter() - start:>10.2f} s   "
+              f"{os.path.getsize(history.index_path) / 1e6:>8.0f} MB")
+        # Leave a tail of unindexed rows, as between two rebuilds
+        for command, output, _, _ in cases[:500]:
+            history.record(command, output, 'systemctl reset-failed', True, 1, 10.0)
+        sample = random.Random(1).sample(cases, 1000)
+        key = bytes.fromhex(sample[0][2])
+        report("lookup one key (index + tail)", time_call(history.lookup, key))
+        report("ranked fixes for a failure", time_call(history.ranked, sample[0][0], sample[0][1]))
+        report("known_fix for a failure", time_call(history.known_fix, sample[0][0], sample[0][1]))
+        latencies = sorted(time_each(history.known_fix, [(c, o) for c, o, _, _ in sample], rounds=1))
+        print(f"  {'known_fix over 1000 failures':<48} p50 {percentile(latencies, 50):.0f} us   "
+              f"p99 {percentile(latencies, 99):.0f} us")
+        start = time.perf_counter()
+        history.compact()
+        print(f"  {'fold 500 new rows into the index':<48} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+
+
+def bench_fixpack():
+    """Fix pack build, open (mmap, no parse) and lookups against the bundled common pack."""
+    import tempfile
+    print(f"\n[*] Fix pack ({os.path.relpath(patch.FIXPACK_SOURCE)})")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'common.pfp')
+        start = time.perf_counter()
+        name, version, entries = patch.build_fix_pack(patch.FIXPACK_SOURCE, path)
+        print(f"  {'build':<48} {(time.perf_counter() - start) * 1000:>10.1f} ms   "
+              f"{entries:,} error lines, {os.path.getsize(path) / 1e3:.0f} KB")
+        report("open pack", time_call(patch.FixPack, path))
+        old_dir, patch.FIXPACK_DIR = patch.FIXPACK_DIR, directory
+        patch.fix_packs.cache_clear()
+        try:
+            pack = patch.fix_packs()[0]
+            report("lookup one error line", time_call(pack.lookup, patch.fixpack_key('bash: gti: command not found')))
+            traceback = ('Traceback (most recent call last):\n  File "app.py", line 3, in <module>\n'
+                         '    import yaml\nModuleNotFoundError: No module named \'yaml\'')
+            report("packed_fix, hit (traceback)", time_call(patch.packed_fix, 'python3 app.py', traceback))
+            miss = '\n'.join(f'step {i}: compiling module_{i}.c' for i in range(40)) + '\nerror: build failed'
+            report("packed_fix, miss (40 lines of output)", time_call(patch.packed_fix, 'make', miss))
+        finally:
+            patch.FIXPACK_DIR = old_dir
+            patch.fix_packs.cache_clear()
+
+
+def bench_team_cache(lookups=2000, threads=16):
+    """Team fix cache hits through the reference server on localhost, alone and concurrent."""
+    import threading
+    print(f"\n[*] Team fix cache (reference server on localhost)")
+    store = patch.TeamCacheStore()
+    server = patch.make_cache_server(store, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    old_url = os.environ.get('PATCH_TEAM_CACHE')
+    os.environ['PATCH_TEAM_CACHE'] = f'http://127.0.0.1:{server.server_port}'
+    patch.team_cache.cache_clear()
+    try:
+        cases = [(f'deploy --target web{i}', f'error: unit {chr(97 + i % 26)}{i // 26}.service failed')
+                 for i in range(lookups)]
+        store.put_many([{'key': patch.team_cache_key(c, o), 'fix': f'systemctl restart {c.split()[-1]}'}
+                        for c, o in cases])
+        report("shared_fix, hit", time_call(patch.shared_fix, *cases[0]))
+        report("shared_fix, miss", time_call(patch.shared_fix, 'deploy', 'error: nothing like it'))
+        requests_before = store.health()['requests']
+        chunks = [cases[i::threads] for i in range(threads)]
+        start = time.perf_counter()
+        workers = [threading.Thread(target=lambda chunk=chunk: [patch.shared_fix(c, o) for c, o in chunk])
+                   for chunk in chunks]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        print(f"  {f'{lookups} lookups from {threads} threads':<48} {elapsed * 1e6 / lookups:>12.2f} us   "
+              f"{lookups / elapsed:>12.0f} ops/s   ({store.health()['requests'] - requests_before} requests)")
+    finally:
+        server.shutdown()
+        server.server_close()
+        if old_url is None:
+            os.environ.pop('PATCH_TEAM_CACHE', None)
+        else:
+            os.environ['PATCH_TEAM_CACHE'] = old_url
+        patch.team_cache.cache_clear()
+
+
+def bench_metrics():
+    """Per-phase cost of the textfile metrics and of a flush into a populated patch.prom."""
+    import tempfile
+    print(f"\n[*] Metrics (PATCH_METRICS_DIR)")
+    old = patch.METRICS, patch.TRACER
+    patch.TRACER = None
+    try:
+        def phase():
+            with patch.trace_span('classify'):
+                pass
+        patch.METRICS = None
+        report("trace_span, metrics off", time_call(phase))
+        with tempfile.TemporaryDirectory() as directory:
+            patch.METRICS = patch.Metrics(directory)
+            patch.METRICS.flushed = float('inf')
+            report("trace_span, metrics on", time_call(phase))
+            for name in ('execute', 'context', 'classify', 'prompt', 'llm', 'parse', 'validate', 'think'):
+                patch.METRICS.observe('patch_phase_seconds', 0.1, phase=name)
+            patch.METRICS.flush()
+
+            def flush():
+                patch.METRICS.inc('patch_attempts_total')
+                patch.METRICS.flush()
+            report("flush (locked read, merge, replace)", time_call(flush))
+    finally:
+        patch.METRICS, patch.TRACER = old
+
+
+def compare_results(old, new):
+    """Print how each helper's throughput and latency moved between two saved runs."""
+    print(f"\n[*] Compared with {old.get('saved', 'the previous run')}")
+    for name, result in new['benchmarks'].items():
+        previous = old.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+        if previous.get('corpus_version') != result.get('corpus_version'):
+            print(f"  [!] {name}: corpus v{previous.get('corpus_version')} vs v{result.get('corpus_version')}, "
+                  f"not comparable")
+            continue
+        for helper, stats in result['helpers'].items():
+            before = previous['helpers'].get(helper)
+            if not before:
+                continue
+            change = (stats['ops_per_sec'] / before['ops_per_sec'] - 1) * 100
+            print(f"  {helper:<26} {before['ops_per_sec']:>10,} -> {stats['ops_per_sec']:>10,} ops/s "
+                  f"({change:+6.1f}%)   p99 {before['p99_us']:.1f} -> {stats['p99_us']:.1f} us")
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'batch': bench_batch,
+    'logscan': bench_log_scan,
+    'serve': bench_serve,
+    'classify': bench_classify,
+    'detectors': bench_detectors,
+    'corpus': bench_corpus,
+    'history': bench_history,
+    'fixpack': bench_fixpack,
+    'team_cache': bench_team_cache,
+    'metrics': bench_metrics,
+}
+
+
+def main():
+    if sys.argv[1:2] == ['--mock-llm']:
+        # Helper process for bench_serve: print the port, serve until killed
+        server = start_mock_llm(float(sys.argv[2]))
+        print(server.server_port, flush=True)
+        threading.Event().wait()
+    args = sys.argv[1:]
+    save = compare = None
+    while '--save' in args or '--compare' in args:
+        flag = '--save' if '--save' in args else '--compare'
+        i = args.index(flag)
+        if i + 1 >= len(args):
+            print(f"[!] {flag} needs a file name")
+            sys.exit(1)
+        if flag == '--save':
+            save = args[i + 1]
+        else:
+            compare = args[i + 1]
+        del args[i:i + 2]
+    names = args or list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        print(f"[!] Unknown benchmark(s): {', '.join(unknown)}")
+        print(f"[!] Available: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+    print("=" * 60)
+    print("   Patch.py Benchmarks")
+    print("=" * 60)
+    results = {}
+    for name in names:
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+    run = {'saved': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+           'machine': platform.machine(), 'benchmarks': results}
+    if compare:
+        with open(compare) as f:
+            compare_results(json.load(f), run)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(run, f, indent=2)
+            f.write('\n')
+        print(f"\n[+] Results saved to {save}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,32 @@ import time
 import platform
 import re
 import shutil
+import functools
+import collections
+import json
+import shlex
+import difflib
+import concurrent.futures
+import tempfile
+import mmap
+import signal
+import selectors
+import select
+import pty
+import tty
+import termios
+import fcntl
+import ctypes
+import ctypes.util
+import struct
+import hashlib
+import codecs
+import zlib
+import atexit
+import bisect
+import contextlib
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from openai import OpenAI, AuthenticationError, APITimeoutError, RateLimitError, APIConnectionError, APIError
 
 stop_cursor = False
@@ -25,7 +51,7 @@ def get_api_key():
         print('[!] OpenAI API key not found.')
         print('[!] Get your key at: https://platform.openai.com/api-keys')
         print('[!] Set it with: export OPENAI_API_KEY="your-key-here"')
-        key = input('Enter your OpenAI API key: ').strip()
+        key = user_input('Enter your OpenAI API key: ').strip()
         if key:
             os.environ['OPENAI_API_KEY'] = key
     
@@ -36,62 +62,1325 @@ def get_api_key():
     
     return key
 
+# --- Shell command analysis ---
+#
+# Every detector and context probe works from the same parsed view of the
+# command. parse_command() tokenizes the string once (quotes, escapes, $(...),
+# operators, redirections) and builds a small list/pipeline AST; results are
+# memoized so repeated lookups for the same string are free.
+
+SHELL_OPERATORS = ['&&', '||', ';;', '|&', '|', ';', '&', '\n', '(', ')']
+REDIRECT_OPERATORS = ['<<<', '<<-', '&>>', '<<', '>>', '&>', '>&', '<&', '<>', '>|', '>', '<']
+SHELL_INTERPRETERS = {'bash', 'sh', 'zsh', 'dash', 'ksh'}
+
+# Wrapper commands that run another command; value = options taking an argument
+COMMAND_PREFIXES = {
+    'sudo': {'-u', '-g', '-h', '-p', '-C', '-D', '-r', '-t', '-U', '--user', '--group', '--host', '--prompt'},
+    'doas': {'-u', '-C'},
+    'env': {'-u', '-C', '-S', '--unset', '--chdir'},
+    'time': {'-f', '-o', '--format', '--output'},
+    'nice': {'-n', '--adjustment'},
+    'ionice': {'-c', '-n', '-p'},
+    'nohup': set(),
+    'command': set(),
+    'builtin': set(),
+    'exec': {'-a'},
+    'stdbuf': {'-i', '-o', '-e'},
+    'timeout': {'-s', '-k', '--signal', '--kill-after'},
+}
+# Prefixes followed by a positional argument before the wrapped command
+PREFIX_POSITIONALS = {'timeout': 1}
+
+_ASSIGNMENT_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\[[^\]]*\])?\+?=')
+
+
+class SimpleCommand:
+    """One command of a pipeline: assignments, wrapper prefixes, argv and redirections."""
+
+    def __init__(self):
+        self.assignments = []   # [(name, value)]
+        self.prefixes = []      # wrapper names in order, e.g. ['sudo', 'env']
+        self.prefix_words = []  # wrapper words including their options
+        self.argv = []
+        self.redirects = []     # [(fd, op, target)]
+
+    @property
+    def name(self):
+        """Lowercased basename of the executed program ('' for pure assignments)."""
+        if not self.argv:
+            return ''
+        return os.path.basename(self.argv[0]).lower()
+
+    @property
+    def args(self):
+        return self.argv[1:]
+
+    @property
+    def words(self):
+        return self.prefix_words + self.argv
+
+    def __repr__(self):
+        return f'SimpleCommand(prefixes={self.prefixes}, argv={self.argv}, redirects={self.redirects})'
+
+
+class Pipeline:
+    """Commands joined by | or |&, plus the list operator that follows it."""
+
+    def __init__(self):
+        self.commands = []
+        self.negated = False
+        self.operator = None  # '&&', '||', ';', '&' or None for the last pipeline
+
+    def __repr__(self):
+        return f'Pipeline({self.commands}, operator={self.operator!r})'
+
+
+class CommandAnalysis:
+    """Parsed view of a full command line shared by all detectors and probes."""
+
+    def __init__(self, text, tokens, pipelines):
+        self.text = text
+        self.lower = text.lower()
+        self.tokens = tokens
+        self.pipelines = pipelines
+        self.commands = [c for p in pipelines for c in p.commands]
+        self.words = [w for c in self.commands for w in c.words]
+        self.names = [c.name for c in self.commands if c.name]
+        self.redirect_targets = [r[2] for c in self.commands for r in c.redirects if r[2]]
+        self.operators = [t[1] for t in tokens if t[0] == 'op']
+
+    def has_name(self, *names):
+        return any(n in names for n in self.names)
+
+    def __repr__(self):
+        return f'CommandAnalysis({self.pipelines})'
+
+
+def _scan_balanced(cmd, i, open_ch, close_ch):
+    """Return index just past the close_ch matching the open_ch before position i."""
+    depth = 1
+    n = len(cmd)
+    while i < n and depth:
+        ch = cmd[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == "'":
+            end = cmd.find("'", i + 1)
+            i = n if end < 0 else end + 1
+            continue
+        if ch == open_ch:
+            depth += 1
+        elif ch == close_ch:
+            depth -= 1
+        i += 1
+    return i
+
+
+def tokenize_command(cmd):
+    """Split a shell command into ('word'|'op'|'redir', value[, fd]) tokens.
+
+    Quotes and escapes are removed from word values; $(...), ${...} and
+    backticks are kept verbatim inside the word. Unterminated quotes consume
+    the rest of the line instead of raising like shlex does.
+    """
+    tokens = []
+    buf = []
+    in_word = False
+    i = 0
+    n = len(cmd)
+
+    def flush():
+        if in_word:
+            tokens.append(('word', ''.join(buf)))
+        buf.clear()
+        return False
+
+    while i < n:
+        ch = cmd[i]
+        if ch in ' \t\r':
+            in_word = flush()
+            i += 1
+            continue
+        if ch == '#' and not in_word:
+            end = cmd.find('\n', i)
+            i = n if end < 0 else end
+            continue
+        if ch == '\\':
+            if i + 1 < n and cmd[i + 1] != '\n':
+                buf.append(cmd[i + 1])
+                in_word = True
+            i += 2
+            continue
+        if ch == "'":
+            end = cmd.find("'", i + 1)
+            end = n if end < 0 else end
+            buf.append(cmd[i + 1:end])
+            in_word = True
+            i = end + 1
+            continue
+        if ch == '"':
+            j = i + 1
+            while j < n and cmd[j] != '"':
+                if cmd[j] == '\\' and j + 1 < n and cmd[j + 1] in '"\\$`':
+                    buf.append(cmd[j + 1])
+                    j += 2
+                    continue
+                if cmd.startswith('$(', j):
+                    k = _scan_balanced(cmd, j + 2, '(', ')')
+                    buf.append(cmd[j:k])
+                    j = k
+                    continue
+                buf.append(cmd[j])
+                j += 1
+            in_word = True
+            i = j + 1
+            continue
+        if ch == '$' and i + 1 < n and cmd[i + 1] in '({':
+            close_ch = ')' if cmd[i + 1] == '(' else '}'
+            k = _scan_balanced(cmd, i + 2, cmd[i + 1], close_ch)
+            buf.append(cmd[i:k])
+            in_word = True
+            i = k
+            continue
+        if ch == '`':
+            end = cmd.find('`', i + 1)
+            end = n if end < 0 else end
+            buf.append(cmd[i:end + 1])
+            in_word = True
+            i = end + 1
+            continue
+        if ch in '<>' or cmd.startswith('&>', i):
+            op = next(o for o in REDIRECT_OPERATORS if cmd.startswith(o, i))
+            fd = None
+            if in_word and ''.join(buf).isdigit():
+                fd = ''.join(buf)
+                buf.clear()
+                in_word = False
+            else:
+                in_word = flush()
+            tokens.append(('redir', op, fd))
+            i += len(op)
+            continue
+        if ch in '|&;\n()':
+            in_word = flush()
+            op = next(o for o in SHELL_OPERATORS if cmd.startswith(o, i))
+            tokens.append(('op', op))
+            i += len(op)
+            continue
+        buf.append(ch)
+        in_word = True
+        i += 1
+    flush()
+    return tokens
+
+
+def _finish_command(words, redirects):
+    """Classify a run of words into assignments, wrapper prefixes and argv."""
+    command = SimpleCommand()
+    command.redirects = redirects
+    i = 0
+    n = len(words)
+    while i < n and _ASSIGNMENT_RE.match(words[i]):
+        name, _, value = words[i].partition('=')
+        command.assignments.append((name.rstrip('+'), value))
+        i += 1
+    while i < n and os.path.basename(words[i]).lower() in COMMAND_PREFIXES:
+        prefix = os.path.basename(words[i]).lower()
+        takes_arg = COMMAND_PREFIXES[prefix]
+        command.prefixes.append(prefix)
+        command.prefix_words.append(words[i])
+        i += 1
+        while i < n and words[i].startswith('-') and words[i] != '-':
+            command.prefix_words.append(words[i])
+            flag = words[i].split('=', 1)[0]
+            i += 1
+            if words[i - 1] == '--':
+                break
+            if flag in takes_arg and '=' not in words[i - 1] and i < n:
+                command.prefix_words.append(words[i])
+                i += 1
+        if prefix == 'env':
+            while i < n and _ASSIGNMENT_RE.match(words[i]):
+                name, _, value = words[i].partition('=')
+                command.assignments.append((name, value))
+                command.prefix_words.append(words[i])
+                i += 1
+        for _ in range(PREFIX_POSITIONALS.get(prefix, 0)):
+            if i < n:
+                command.prefix_words.append(words[i])
+                i += 1
+    command.argv = words[i:]
+    return command
+
+
+def _build_pipelines(tokens):
+    pipelines = []
+    pipeline = Pipeline()
+    words = []
+    redirects = []
+    pending_redirect = None
+
+    def end_command():
+        if words or redirects:
+            pipeline.commands.append(_finish_command(list(words), list(redirects)))
+        words.clear()
+        redirects.clear()
+
+    for token in tokens:
+        kind, value = token[0], token[1]
+        if kind == 'word':
+            if pending_redirect is not None:
+                redirects.append((pending_redirect[2], pending_redirect[1], value))
+                pending_redirect = None
+            elif value == '!' and not words and not pipeline.commands:
+                pipeline.negated = True
+            elif value in ('{', '}') and not words:
+                continue
+            else:
+                words.append(value)
+        elif kind == 'redir':
+            if pending_redirect is not None:
+                redirects.append((pending_redirect[2], pending_redirect[1], ''))
+            pending_redirect = token
+        else:
+            if pending_redirect is not None:
+                redirects.append((pending_redirect[2], pending_redirect[1], ''))
+                pending_redirect = None
+            end_command()
+            if value in ('|', '|&', '(', ')'):
+                continue
+            if pipeline.commands:
+                pipeline.operator = value if value != '\n' else ';'
+                pipelines.append(pipeline)
+                pipeline = Pipeline()
+    if pending_redirect is not None:
+        redirects.append((pending_redirect[2], pending_redirect[1], ''))
+    end_command()
+    if pipeline.commands:
+        pipelines.append(pipeline)
+    return pipelines
+
+
+@functools.lru_cache(maxsize=256)
+def parse_command(cmd):
+    """Parse a command line once into a shared CommandAnalysis (memoized)."""
+    tokens = tokenize_command(cmd or '')
+    return CommandAnalysis(cmd or '', tokens, _build_pipelines(tokens))
+
 def is_pipe_to_shell(cmd):
     """Detect if command pipes into shell interpreter (bash, sh, zsh)"""
-    shell_pipes = ['| bash', '| sh', '| zsh']
-    cmd_lower = cmd.lower().strip()
-    for pipe in shell_pipes:
-        if cmd_lower.endswith(pipe.lower()):
-            return True
-    return False
+    return detect_command(cmd)['pipe_to_shell']
+
+INTERACTIVE_COMMANDS = {
+    'adduser', 'useradd', 'passwd', 'chpasswd',
+    'mysql', 'psql', 'sqlite3', 'mongosh', 'redis-cli',
+    'vim', 'nano', 'vi', 'emacs',
+    'less', 'more', 'top', 'htop',
+    'ssh', 'telnet', 'ftp', 'sftp',
+}
+# Package installs that prompt for a password/confirmation when run via sudo
+INTERACTIVE_SUDO_SUBCOMMANDS = {('apt-get', 'install'), ('dnf', 'install'), ('yum', 'install')}
+# Flags that make an otherwise interactive command run unattended
+NON_INTERACTIVE_FLAGS = {
+    'mysql': {'-e', '--execute'},
+    'psql': {'-c', '--command', '-f', '--file'},
+    'redis-cli': set(),
+}
 
 def is_interactive_command(cmd):
     """Detect if command requires interactive user input"""
-    interactive_commands = [
-        'adduser', 'useradd', 'passwd', 'chpasswd',
-        'mysql', 'psql', 'sqlite3', 'mongosh', 'redis-cli',
-        'vim', 'nano', 'vi', 'emacs',
-        'less', 'more', 'top', 'htop',
-        'ssh', 'telnet', 'ftp', 'sftp',
-        'sudo apt-get install', 'sudo dnf install', 'sudo yum install',
-    ]
-    cmd_lower = cmd.lower()
-    for base_cmd in interactive_commands:
-        # Check if the base command is present (handle sudo, spaces)
-        patterns = [
-            f" {base_cmd} ",  # Command with spaces around
-            f"^{base_cmd} ",   # Command at start
-            f" {base_cmd}$",   # Command at end
-            f" {base_cmd} ",   # Command in middle
-        ]
-        for pattern in patterns:
-            if pattern.strip() in cmd_lower or cmd_lower.startswith(pattern.strip()):
-                return True
-    return False
+    return detect_command(cmd)['interactive']
+
+NON_INTERACTIVE_ALTERNATIVES = {
+    'adduser': [
+        'adduser --disabled-password --gecos "" {user}',
+        'useradd -m {user}'
+    ],
+    'useradd': ['useradd -m {user}'],
+    'mysql': ['mysql -e "{query}"', 'mysql -BNe "{query}"'],
+    'psql': ['psql -c "{query}"'],
+}
 
 def get_non_interactive_alternative(cmd):
     """Provide non-interactive alternatives for interactive commands"""
-    cmd_lower = cmd.lower()
-    alternatives = {
-        'adduser': [
-            'adduser --disabled-password --gecos "" {user}',
-            'useradd -m {user}'
-        ],
-        'useradd': ['useradd -m {user}'],
-        'mysql': ['mysql -e "{query}"', 'mysql -BNe "{query}"'],
-        'psql': ['psql -c "{query}"'],
+    return detect_command(cmd)['alternative']
+
+# --- Streaming command execution ---
+#
+# Output is teed to the terminal as it arrives. Only a bounded head and a
+# ring-buffered tail are kept in memory; everything past the head is also
+# spilled to an anonymous temp file once the tail starts overwriting, so the
+# full stream stays available (via mmap) without growing the heap. The spill
+# is capped at CAPTURE_SPILL_BYTES (past that only the ring buffer keeps
+# going) and is what failure_context() scans for an error that scrolled out
+# of the tail of a stdout-only failure.
+
+CAPTURE_HEAD_BYTES = 64 * 1024
+CAPTURE_TAIL_BYTES = 256 * 1024
+CAPTURE_SPILL_BYTES = 32 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class RingBuffer:
+    """Fixed-capacity byte buffer that keeps only the most recent bytes."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.pos = 0
+        self.full = False
+
+    def write(self, data):
+        n = len(data)
+        if n >= self.capacity:
+            self.buf[:] = data[-self.capacity:]
+            self.pos = 0
+            self.full = True
+            return
+        end = self.pos + n
+        if end <= self.capacity:
+            self.buf[self.pos:end] = data
+        else:
+            first = self.capacity - self.pos
+            self.buf[self.pos:] = data[:first]
+            self.buf[:n - first] = data[first:]
+        if end >= self.capacity:
+            self.full = True
+        self.pos = end % self.capacity
+
+    def getvalue(self):
+        if not self.full:
+            return bytes(self.buf[:self.pos])
+        return bytes(self.buf[self.pos:] + self.buf[:self.pos])
+
+    def __len__(self):
+        return self.capacity if self.full else self.pos
+
+
+class OutputCapture:
+    """Bounded capture of a command's output: head + ring-buffered tail + spill file."""
+
+    def __init__(self, head_bytes=CAPTURE_HEAD_BYTES, tail_bytes=CAPTURE_TAIL_BYTES, evidence=None):
+        self.head_bytes = head_bytes
+        self.head = bytearray()
+        # Optional ErrorEvidence fed every byte, including the dropped middle
+        self.evidence = evidence
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace') if evidence else None
+        self.tail = RingBuffer(tail_bytes)
+        self.total = 0
+        self.spill = None
+        self.spill_bytes = 0
+        self.returncode = None
+        self.timed_out = None
+        self.usage = None
+
+    def write(self, data):
+        self.total += len(data)
+        if self.evidence is not None:
+            self.evidence.feed(self._decoder.decode(data))
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+            if not data:
+                return
+        if self.spill is None and len(self.tail) + len(data) > self.tail.capacity:
+            # The tail is about to drop bytes: start keeping everything on disk
+            self.spill = tempfile.TemporaryFile(prefix='patch-output-')
+            self.spill.write(self.tail.getvalue())
+            self.spill_bytes = len(self.tail)
+        if self.spill is not None and self.spill_bytes < CAPTURE_SPILL_BYTES:
+            kept = data[:CAPTURE_SPILL_BYTES - self.spill_bytes]
+            self.spill.write(kept)
+            self.spill_bytes += len(kept)
+        self.tail.write(data)
+
+    @property
+    def truncated(self):
+        return self.total > len(self.head) + len(self.tail)
+
+    def getvalue(self):
+        """Head and tail bytes, with a marker where the middle was dropped."""
+        if not self.truncated:
+            return bytes(self.head) + self.tail.getvalue()
+        omitted = self.total - len(self.head) - len(self.tail)
+        marker = f'\n[... {omitted} bytes omitted ...]\n'.encode()
+        return bytes(self.head) + marker + self.tail.getvalue()
+
+    def text(self):
+        return self.getvalue().decode('utf-8', errors='replace')
+
+    def mmap(self):
+        """Memory-map everything after the head, up to CAPTURE_SPILL_BYTES (None if nothing was spilled)."""
+        if self.spill is None:
+            return None
+        self.spill.flush()
+        return mmap.mmap(self.spill.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def scan(self):
+        """LogScanner over the head and the spill: the stream as far as it was kept."""
+        scanner = LogScanner()
+        scanner.feed(bytes(self.head))
+        spilled = self.mmap()
+        if spilled is None:
+            scanner.feed(self.tail.getvalue())
+        else:
+            with spilled:
+                for start in range(0, len(spilled), LOG_CHUNK_BYTES):
+                    scanner.feed(spilled[start:start + LOG_CHUNK_BYTES])
+        return scanner.finish()
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+FAILURE_STDOUT_LINES = 40
+
+
+def _last_lines(data, count):
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    return lines[-count:], len(lines)
+
+
+class CommandCapture:
+    """Separate stdout/stderr captures plus a bounded, timestamped chronological timeline."""
+
+    def __init__(self, head_bytes=CAPTURE_HEAD_BYTES, tail_bytes=CAPTURE_TAIL_BYTES):
+        self.stdout = OutputCapture(head_bytes, tail_bytes)
+        # stderr is classified as it streams (see ErrorEvidence)
+        self.stderr = OutputCapture(head_bytes, tail_bytes, evidence=ErrorEvidence())
+        self.started = time.monotonic()
+        # Timeline of (seconds since start, stream name, bytes): first head_bytes
+        # and last tail_bytes worth of chunks, like OutputCapture
+        self.timeline_head = []
+        self.timeline_head_size = 0
+        self.timeline_tail = collections.deque()
+        self.timeline_tail_size = 0
+        self.timeline_dropped = 0
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.stdout_before_failure = None
+        self.stdout_at_failure = 0
+        self.returncode = None
+        self.timed_out = None
+        self.usage = None
+
+    def write(self, name, data, when=None):
+        offset = (time.monotonic() if when is None else when) - self.started
+        if name == 'stderr' and self.stdout_before_failure is None:
+            # Snapshot the stdout lines leading up to the first error output
+            self.stdout_before_failure = _last_lines(self.stdout.tail.getvalue() if self.stdout.truncated
+                                                     else self.stdout.getvalue(), FAILURE_STDOUT_LINES)[0]
+            self.stdout_at_failure = self.stdout.total
+        getattr(self, name).write(data)
+        if self.timeline_head_size < self.head_bytes:
+            self.timeline_head.append((offset, name, data))
+            self.timeline_head_size += len(data)
+            return
+        self.timeline_tail.append((offset, name, data))
+        self.timeline_tail_size += len(data)
+        while self.timeline_tail_size > self.tail_bytes and len(self.timeline_tail) > 1:
+            dropped = self.timeline_tail.popleft()
+            self.timeline_tail_size -= len(dropped[2])
+            self.timeline_dropped += len(dropped[2])
+
+    def timeline(self):
+        """Kept (seconds, stream, bytes) chunks in arrival order."""
+        return self.timeline_head + list(self.timeline_tail)
+
+    def merged(self):
+        """Chronologically interleaved stdout+stderr text."""
+        parts = [chunk for _, _, chunk in self.timeline_head]
+        if self.timeline_dropped:
+            parts.append(f'\n[... {self.timeline_dropped} bytes omitted ...]\n'.encode())
+        parts.extend(chunk for _, _, chunk in self.timeline_tail)
+        return b''.join(parts).decode('utf-8', errors='replace')
+
+    def text(self):
+        return self.merged()
+
+    def failure_context(self, stdout_lines=FAILURE_STDOUT_LINES):
+        """What diagnosis needs: stderr plus the stdout lines around it.
+
+        That is the last stdout lines before the first error output and, if
+        the command kept writing to stdout afterwards, the last ones at exit.
+        """
+        stdout_value = self.stdout.tail.getvalue() if self.stdout.truncated else self.stdout.getvalue()
+        if not self.stderr.total:
+            lines, total = _last_lines(stdout_value, stdout_lines)
+            if total <= stdout_lines and not self.stdout.truncated:
+                return '\n'.join(lines)
+            tail = f'[stdout: last {len(lines)} lines]\n' + '\n'.join(lines)
+            if not self.stdout.truncated:
+                return tail
+            # The tail may have scrolled past the actual error: look for it in what was kept
+            scanner = self.stdout.scan()
+            region = scanner.first_region
+            if region is None or region['end'] > scanner.lines - len(lines):
+                return tail
+            return (f"[stdout: lines {region['start']}-{region['end']}, the first error]\n"
+                    f"{region['text']}\n{tail}")
+        parts = []
+        before = (self.stdout_before_failure or [])[-stdout_lines:]
+        if before:
+            parts.append(f'[stdout: last {len(before)} lines before the first error output]')
+            parts.extend(before)
+            parts.append('[stderr]')
+        parts.append(self.stderr.text().rstrip('\n'))
+        after = self.stdout.total - self.stdout_at_failure
+        if after:
+            # Only the bytes written since the snapshot, as far as the tail still has them
+            lines = _last_lines(stdout_value[-after:], stdout_lines)[0]
+            if lines:
+                parts.append(f'[stdout: last {len(lines)} lines at exit]')
+                parts.extend(lines)
+        return '\n'.join(parts)
+
+    def labels(self):
+        """Error labels for all of stderr (line numbers count stderr lines), else for failure_context()."""
+        if not self.stderr.total:
+            return classify_error_labels(self.failure_context())
+        evidence = self.stderr.evidence
+        evidence.feed(self.stderr._decoder.decode(b'', final=True)).finish()
+        return evidence.labels()
+
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
+
+
+# --- Tracing (--trace, --profile) ---
+#
+# --trace FILE (or PATCH_TRACE=FILE) records where a session's time goes:
+# running the command, each file system probe, classification, prompt
+# assembly, the model request (streamed while tracing, to time the first
+# token), parsing, validation and the time spent waiting on the user. It is
+# written at exit as Chrome trace events (open in chrome://tracing or
+# Perfetto), or as OTLP/JSON when FILE ends in .otlp.json. --profile FILE
+# (PATCH_PROFILE) also dumps cProfile stats for the whole run, for
+# python -m pstats FILE. Spans also feed the phase latency histogram when
+# PATCH_METRICS_DIR is set. With neither, trace_span() and @traced functions
+# cost two global lookups, TRACER and METRICS (one, TRACER, before the
+# histogram was fed from here).
+
+TRACER = None
+PROFILER = None
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class Tracer:
+    """Collects spans (and instant events) from every thread; write() exports them.
+
+    A root span covering the whole run is opened on the creating thread and
+    ended by write().
+    """
+
+    def __init__(self, path, root='session', **attrs):
+        self.path = path
+        self.lock = threading.Lock()
+        self.spans = []          # [span id, parent id, name, start ns, end ns, thread id, attrs, events]
+        self.local = threading.local()
+        self.trace_id = os.urandom(16).hex()
+        # Wall clock at perf_counter zero, for absolute OTLP timestamps
+        self.epoch_ns = time.time_ns() - time.perf_counter_ns()
+        self.root = [os.urandom(8).hex(), None, root, time.perf_counter_ns(), None, threading.get_ident(), attrs, []]
+        self.local.stack = [self.root]
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        stack = self.local.__dict__.setdefault('stack', [])
+        record = [os.urandom(8).hex(), stack[-1][0] if stack else None, name, time.perf_counter_ns(), None,
+                  threading.get_ident(), attrs, []]
+        stack.append(record)
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs.setdefault('error', type(e).__name__)
+            raise
+        finally:
+            record[4] = time.perf_counter_ns()
+            stack.pop()
+            with self.lock:
+                self.spans.append(record)
+
+    def event(self, name, **attrs):
+        """Mark a point in time inside the current span."""
+        stack = self.local.__dict__.get('stack')
+        if stack:
+            stack[-1][7].append((name, time.perf_counter_ns(), attrs))
+
+    def chrome_events(self):
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'patch'}}]
+        for _, _, name, start, end, tid, attrs, marks in sorted(self.spans, key=lambda r: r[3]):
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': start / 1000,
+                           'dur': (end - start) / 1000, 'args': attrs})
+            events.extend({'name': mark, 'ph': 'i', 's': 't', 'pid': pid, 'tid': tid, 'ts': at / 1000,
+                           'args': mark_attrs} for mark, at, mark_attrs in marks)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def otlp(self):
+        spans = []
+        for span_id, parent, name, start, end, tid, attrs, marks in sorted(self.spans, key=lambda r: r[3]):
+            span = {'traceId': self.trace_id, 'spanId': span_id, 'name': name, 'kind': 1,
+                    'startTimeUnixNano': str(self.epoch_ns + start), 'endTimeUnixNano': str(self.epoch_ns + end),
+                    'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in dict(attrs, thread=tid).items()],
+                    'events': [{'name': mark, 'timeUnixNano': str(self.epoch_ns + at),
+                                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in mark_attrs.items()]}
+                               for mark, at, mark_attrs in marks]}
+            if parent:
+                span['parentSpanId'] = parent
+            if 'error' in attrs:
+                span['status'] = {'code': 2, 'message': attrs['error']}
+            spans.append(span)
+        resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'patch'}},
+                                   {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}}]}
+        return {'resourceSpans': [{'resource': resource,
+                                   'scopeSpans': [{'scope': {'name': 'patch'}, 'spans': spans}]}]}
+
+    def write(self):
+        with self.lock:
+            if self.root[4] is None:
+                self.root[4] = time.perf_counter_ns()
+                self.spans.append(self.root)
+            doc = self.otlp() if self.path.endswith('.otlp.json') else self.chrome_events()
+        with open(self.path, 'w') as f:
+            json.dump(doc, f)
+
+def trace_span(name, **attrs):
+    """Context manager timing a phase when tracing or metrics are on; yields a dict for more attributes."""
+    if TRACER is None and METRICS is None:
+        return contextlib.nullcontext({})
+    return _measured_span(name, attrs)
+
+@contextlib.contextmanager
+def _measured_span(name, attrs):
+    started = time.perf_counter()
+    try:
+        if TRACER is None:
+            yield attrs
+        else:
+            with TRACER.span(name, **attrs) as attrs:
+                yield attrs
+    finally:
+        observe_metric('patch_phase_seconds', time.perf_counter() - started, phase=name)
+
+def trace_event(name, **attrs):
+    if TRACER is not None:
+        TRACER.event(name, **attrs)
+
+def traced(name):
+    """Decorator: run the function inside trace_span(name)."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if TRACER is None and METRICS is None:
+                return func(*args, **kwargs)
+            with _measured_span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def user_input(prompt=''):
+    """input(), traced as user think time."""
+    with trace_span('think'):
+        return input(prompt)
+
+def _finish_tracing():
+    if PROFILER is not None:
+        PROFILER[0].disable()
+        try:
+            PROFILER[0].dump_stats(PROFILER[1])
+        except OSError as e:
+            print(f'[!] Cannot write profile {PROFILER[1]}: {e}', file=sys.stderr)
+    if TRACER is not None:
+        try:
+            TRACER.write()
+        except OSError as e:
+            print(f'[!] Cannot write trace {TRACER.path}: {e}', file=sys.stderr)
+
+def start_tracing(trace_path=None, profile_path=None):
+    """Turn on tracing and/or profiling for the rest of the run; later paths replace earlier ones."""
+    global TRACER, PROFILER
+    if not (trace_path or profile_path):
+        return
+    if TRACER is None and PROFILER is None:
+        atexit.register(_finish_tracing)
+    if trace_path:
+        if TRACER is None:
+            TRACER = Tracer(trace_path, argv=' '.join(sys.argv[1:]))
+        TRACER.path = trace_path
+    if profile_path:
+        if PROFILER is None:
+            import cProfile
+            PROFILER = (cProfile.Profile(), profile_path)
+            PROFILER[0].enable()
+        else:
+            PROFILER = (PROFILER[0], profile_path)
+
+
+# --- Metrics (PATCH_METRICS_DIR, node_exporter textfile collector) ---
+#
+# With PATCH_METRICS_DIR set to node_exporter's --collector.textfile.directory,
+# patch keeps counters (fix attempts and successes, model calls, answers from
+# history, fix packs and the team cache, rate limiting) and histograms (phase
+# latencies from the trace spans, prompt sizes in tokens) and adds them to
+# patch.prom there. Every sample is cumulative, so a flush takes an flock,
+# reads the file, adds this process's counts since its last flush and
+# atomically replaces it: concurrent runs (and patch serve) add up instead of
+# overwriting each other, and node_exporter never reads a half-written file.
+# Short runs flush at exit, long-running ones at most every
+# METRICS_FLUSH_SECONDS as they record.
+
+METRICS_DIR = os.environ.get('PATCH_METRICS_DIR')
+METRICS_FILE = 'patch.prom'
+METRICS_FLUSH_SECONDS = 15
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+# name: (type, help, histogram buckets)
+METRIC_FAMILIES = {
+    'patch_attempts_total': ('counter', 'Suggested fixes that were run.', None),
+    'patch_successes_total': ('counter', 'Suggested fixes that ran successfully.', None),
+    'patch_llm_calls_total': ('counter', 'Requests to the model, by outcome.', None),
+    'patch_cache_hits_total': ('counter', 'Fixes answered without the model, by cache.', None),
+    'patch_rate_limit_events_total': ('counter', 'Rate limited model requests (openai) and diagnoses (follow).', None),
+    'patch_phase_seconds': ('histogram', 'Time spent in each phase, named as in --trace.', PHASE_BUCKETS),
+    'patch_prompt_tokens': ('histogram', 'Prompt size of model requests in tokens.', TOKEN_BUCKETS),
+}
+METRICS = None
+
+_PROM_SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$')
+_PROM_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _prom_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _prom_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _metric_family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        base = name[:-len(suffix)]
+        if name.endswith(suffix) and METRIC_FAMILIES.get(base, ('',))[0] == 'histogram':
+            return base
+    return name
+
+def parse_prom_samples(text):
+    """{(name, ((label, value), ...)): value} for the samples in Prometheus text format."""
+    samples = {}
+    for line in text.splitlines():
+        match = None if line.startswith('#') else _PROM_SAMPLE.match(line.strip())
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        labels = tuple((k, re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), v))
+                       for k, v in _PROM_LABEL.findall(labels or ''))
+        try:
+            samples[(name, labels)] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+def _sample_order(family, sample):
+    """Series by labels; a histogram's buckets in le order, then _sum and _count."""
+    name, labels, _ = sample
+    suffix = ('', '_bucket', '_sum', '_count').index(name[len(family):]) if name.startswith(family) else 0
+    return [l for l in labels if l[0] != 'le'], suffix, [float(v) for k, v in labels if k == 'le']
+
+def format_prom_samples(samples):
+    """Prometheus text format, each family's samples together under its HELP and TYPE lines."""
+    families = {}
+    for (name, labels), value in samples.items():
+        families.setdefault(_metric_family(name), []).append((name, labels, value))
+    order = list(METRIC_FAMILIES)
+    lines = []
+    for family in sorted(families, key=lambda f: (order.index(f) if f in order else len(order), f)):
+        if family in METRIC_FAMILIES:
+            kind, text, _ = METRIC_FAMILIES[family]
+            lines += [f'# HELP {family} {text}', f'# TYPE {family} {kind}']
+        for name, labels, value in sorted(families[family], key=lambda sample: _sample_order(family, sample)):
+            label_text = ','.join(f'{k}="{_prom_escape(v)}"' for k, v in labels)
+            lines.append(f'{name}{{{label_text}}} {_prom_number(value)}' if labels else f'{name} {_prom_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+class Metrics:
+    """This process's counts since the last flush; flush() adds them to DIRECTORY/patch.prom."""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, METRICS_FILE)
+        self.lock_path = os.path.join(directory, f'.{METRICS_FILE}.lock')
+        self.lock = threading.Lock()
+        self.counters = {}       # (name, labels): amount
+        self.histograms = {}     # (name, labels): [count per bucket..., count above the last, sum]
+        self.flushed = time.monotonic()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        if time.monotonic() - self.flushed >= METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRIC_FAMILIES[name][2]
+        with self.lock:
+            state = self.histograms.get(key)
+            if state is None:
+                state = self.histograms[key] = [0] * (len(buckets) + 2)
+            state[bisect.bisect_left(buckets, value)] += 1
+            state[-1] += value
+        if time.monotonic() - self.flushed >= METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def _merge(self, counters, histograms):
+        for key, amount in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + amount
+        for key, state in histograms.items():
+            mine = self.histograms.setdefault(key, [0] * len(state))
+            mine[:] = [a + b for a, b in zip(mine, state)]
+
+    def samples(self, counters, histograms):
+        """The pending counts as samples; histograms as every cumulative bucket, _sum and _count."""
+        samples = dict(counters)
+        for (name, labels), state in histograms.items():
+            total = 0
+            for le, count in zip(METRIC_FAMILIES[name][2] + (float('inf'),), state):
+                total += count
+                samples[(f'{name}_bucket', labels + (('le', _prom_number(le)),))] = total
+            samples[(f'{name}_sum', labels)] = state[-1]
+            samples[(f'{name}_count', labels)] = total
+        return samples
+
+    def flush(self):
+        """Add the pending counts to the .prom file; they are kept for the next flush if that fails."""
+        with self.lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+            self.flushed = time.monotonic()
+        if not (counters or histograms):
+            return
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(self.lock_path, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.path) as f:
+                        samples = parse_prom_samples(f.read())
+                except FileNotFoundError:
+                    samples = {}
+                for key, amount in self.samples(counters, histograms).items():
+                    samples[key] = samples.get(key, 0) + amount
+                fd, tmp = tempfile.mkstemp(prefix=f'.{METRICS_FILE}-', dir=directory)
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        # node_exporter usually runs as another user
+                        os.fchmod(f.fileno(), 0o644)
+                        f.write(format_prom_samples(samples))
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+        except OSError:
+            with self.lock:
+                self._merge(counters, histograms)
+
+def count_metric(name, amount=1, **labels):
+    if METRICS is not None:
+        METRICS.inc(name, amount, **labels)
+
+def observe_metric(name, value, **labels):
+    if METRICS is not None:
+        METRICS.observe(name, value, **labels)
+
+def start_metrics(directory):
+    """Collect metrics for DIRECTORY/patch.prom for the rest of the run (no-op without a directory)."""
+    global METRICS
+    if directory and METRICS is None:
+        METRICS = Metrics(directory)
+        atexit.register(METRICS.flush)
+
+# --- Resource accounting ---
+#
+# Children are reaped with os.wait4 so every run reports wall time, user/sys
+# CPU and peak RSS. Attempts are also appended to a local JSONL telemetry log.
+# Once it passes TELEMETRY_MAX_BYTES it is rotated to telemetry.jsonl.1
+# (replacing the previous one), so it never takes more than twice that.
+
+PATCH_HOME = os.path.expanduser(os.environ.get('PATCH_HOME', '~/.patch'))
+TELEMETRY_ENABLED = os.environ.get('PATCH_TELEMETRY', '1') != '0'
+TELEMETRY_MAX_BYTES = 4 * 1024 * 1024
+
+
+def _exit_status(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return status
+
+def _reap(proc, timeout=None):
+    """Wait for proc via os.wait4, storing proc.returncode and proc.rusage.
+
+    Returns False if timeout (seconds) expired before the process exited.
+    """
+    if proc.returncode is not None:
+        return True
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            proc.returncode = proc.returncode if proc.returncode is not None else -1
+            proc.rusage = None
+            return True
+        if pid:
+            proc.returncode = _exit_status(status)
+            proc.rusage = rusage
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+
+def resource_usage(rusage, wall_seconds):
+    """Summarize a child's rusage as wall/user/sys seconds and peak RSS in KiB.
+
+    Peak RSS is retained across exec, so it has patch's own forked size as a floor.
+    """
+    max_rss = rusage.ru_maxrss if rusage else 0
+    if sys.platform == 'darwin':
+        # macOS reports bytes, Linux reports KiB
+        max_rss //= 1024
+    return {
+        'wall_s': round(wall_seconds, 4),
+        'user_s': round(rusage.ru_utime, 4) if rusage else 0.0,
+        'sys_s': round(rusage.ru_stime, 4) if rusage else 0.0,
+        'max_rss_kb': max_rss,
     }
-    for base_cmd, alts in alternatives.items():
-        if base_cmd in cmd_lower:
-            return alts
+
+def format_usage(usage):
+    return (f"{usage['wall_s']:.2f}s wall, {usage['user_s']:.2f}s user, {usage['sys_s']:.2f}s sys, "
+            f"peak RSS {usage['max_rss_kb'] / 1024:.1f} MB")
+
+def record_telemetry(event, **fields):
+    """Append one JSON event to PATCH_HOME/telemetry.jsonl (PATCH_TELEMETRY=0 disables)."""
+    if not TELEMETRY_ENABLED:
+        return
+    path = os.path.join(PATCH_HOME, 'telemetry.jsonl')
+    try:
+        os.makedirs(PATCH_HOME, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # One write of a whole line: concurrent patch processes never interleave
+            os.write(fd, (json.dumps(dict(ts=round(time.time(), 3), event=event, **fields)) + '\n').encode())
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > TELEMETRY_MAX_BYTES:
+            rotate_telemetry(path)
+    except OSError:
+        pass
+
+def rotate_telemetry(path):
+    """Move an oversized log to path.1 (skipped if another process is at it)."""
+    with open(path + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        # Another process may have rotated it between our write and the lock
+        if os.path.getsize(path) > TELEMETRY_MAX_BYTES:
+            os.replace(path, path + '.1')
+
+
+# Execution limits (seconds); 0/None disables. Overridden by --timeout/--idle-timeout.
+COMMAND_TIMEOUT = float(os.environ.get('PATCH_TIMEOUT', 0) or 0) or None
+IDLE_TIMEOUT = float(os.environ.get('PATCH_IDLE_TIMEOUT', 0) or 0) or None
+KILL_GRACE_SECONDS = 2.0
+
+
+def _tee_target(stream):
+    return getattr(stream, 'buffer', None)
+
+def _terminal_fd():
+    """Return stdin's fd if we own the foreground of a terminal, else None."""
+    try:
+        fd = sys.stdin.fileno()
+        if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+            return fd
+    except (AttributeError, ValueError, OSError):
+        pass
     return None
 
-def execute_command(cmd, check_for_sudo=False, force_interactive=False):
+def _set_foreground(fd, pgid):
+    """Hand the terminal to pgid (ignoring SIGTTOU while we do it)."""
+    old = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        os.tcsetpgrp(fd, pgid)
+    except OSError:
+        pass
+    finally:
+        signal.signal(signal.SIGTTOU, old)
+
+def _spawn_process_group(cmd, foreground=True, **popen_kwargs):
+    """Start cmd in its own process group, foregrounded on our terminal if we have one.
+
+    A separate group lets timeouts kill the whole job (children included);
+    giving it the terminal keeps Ctrl-C and sudo password prompts working.
+    Background jobs (foreground=False) get their own session instead and
+    never touch the terminal, which is also safe to do from worker threads.
+    """
+    if not foreground:
+        proc = subprocess.Popen(cmd, shell=True, start_new_session=True, **popen_kwargs)
+        return proc, None
+    tty_fd = _terminal_fd()
+
+    def preexec():
+        os.setpgid(0, 0)
+        if tty_fd is not None:
+            _set_foreground(tty_fd, os.getpgrp())
+
+    proc = subprocess.Popen(cmd, shell=True, preexec_fn=preexec, **popen_kwargs)
+    try:
+        os.setpgid(proc.pid, proc.pid)
+    except OSError:
+        pass
+    if tty_fd is not None:
+        _set_foreground(tty_fd, proc.pid)
+    return proc, tty_fd
+
+def _kill_process_group(proc):
+    """SIGTERM the command's process group, escalating to SIGKILL after a grace period."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            return
+        if _reap(proc, timeout=KILL_GRACE_SECONDS):
+            return
+
+def run_streaming(cmd, tee=True, capture=None, timeout=None, idle_timeout=None, foreground=True, **popen_kwargs):
+    """Run cmd through the shell, teeing stdout/stderr live into a bounded CommandCapture.
+
+    timeout is a wall-clock limit and idle_timeout a limit on time without any
+    output. When either fires the process group is terminated and
+    capture.timed_out is set to 'timeout' or 'idle'. Extra keyword arguments
+    (cwd, env, stdin) go to Popen.
+    """
+    capture = capture or CommandCapture()
+    proc, tty_fd = _spawn_process_group(cmd, foreground, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **popen_kwargs)
+    streams = {
+        proc.stdout.fileno(): ('stdout', _tee_target(sys.stdout) if tee else None),
+        proc.stderr.fileno(): ('stderr', _tee_target(sys.stderr) if tee else None),
+    }
+    selector = selectors.DefaultSelector()
+    for fd in streams:
+        selector.register(fd, selectors.EVENT_READ)
+    start = last_output = time.monotonic()
+    try:
+        while streams:
+            wait = None
+            now = time.monotonic()
+            if timeout:
+                wait = timeout - (now - start)
+            if idle_timeout:
+                idle_left = idle_timeout - (now - last_output)
+                wait = idle_left if wait is None else min(wait, idle_left)
+            if wait is not None and wait <= 0:
+                capture.timed_out = 'timeout' if timeout and now - start >= timeout else 'idle'
+                break
+            for key, _ in selector.select(wait):
+                fd = key.fd
+                chunk = os.read(fd, READ_CHUNK_BYTES)
+                name, sink = streams[fd]
+                if not chunk:
+                    selector.unregister(fd)
+                    del streams[fd]
+                    continue
+                last_output = time.monotonic()
+                capture.write(name, chunk, last_output)
+                if sink is not None:
+                    sink.write(chunk)
+                    sink.flush()
+                elif tee:
+                    print(chunk.decode('utf-8', errors='replace'), end='', flush=True,
+                          file=sys.stderr if name == 'stderr' else sys.stdout)
+    except KeyboardInterrupt:
+        # The child received the same SIGINT; just collect its exit status
+        pass
+    finally:
+        selector.close()
+        if capture.timed_out:
+            _kill_process_group(proc)
+        proc.stdout.close()
+        proc.stderr.close()
+        _reap(proc)
+        capture.returncode = proc.returncode
+        capture.usage = resource_usage(proc.rusage, time.monotonic() - start)
+        if tty_fd is not None:
+            _set_foreground(tty_fd, os.getpgrp())
+    if capture.timed_out:
+        # Mirror coreutils timeout(1) so callers never mistake a kill for success
+        capture.returncode = 124
+        capture.write('stderr', timeout_marker(capture.timed_out, timeout, idle_timeout).encode())
+    return capture
+
+def timeout_marker(kind, timeout=None, idle_timeout=None):
+    """Marker appended to partial output so diagnosis knows the command never finished."""
+    if kind == 'idle':
+        return f'\n[patch] Command hung: no output for {idle_timeout:g}s, process group terminated\n'
+    return f'\n[patch] Command timed out after {timeout:g}s, process group terminated\n'
+
+# --- PTY-backed execution for interactive commands ---
+#
+# Interactive programs get a real pseudo-terminal, so prompts, line editing
+# and password entry behave normally. Keystrokes are forwarded untouched and
+# never recorded; only what the program prints is kept in a bounded
+# transcript for diagnosis. --timeout/--idle-timeout apply here too: a hung
+# ssh or psql session is killed like any other command, except that
+# keystrokes count as activity so a user thinking at a prompt is left alone.
+
+_ANSI_ESCAPE_RE = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[@-Z\\-_])')
+
+
+def clean_transcript(text):
+    """Strip terminal control sequences and carriage returns from a PTY transcript."""
+    text = _ANSI_ESCAPE_RE.sub('', text)
+    lines = []
+    for line in text.replace('\r\n', '\n').split('\n'):
+        # A bare \r redraws the line: keep what was drawn last
+        lines.append(line.rsplit('\r', 1)[-1] if '\r' in line else line)
+    return '\n'.join(lines)
+
+def _write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+def _copy_winsize(src_fd, dst_fd):
+    try:
+        size = fcntl.ioctl(src_fd, termios.TIOCGWINSZ, b'\0' * 8)
+        fcntl.ioctl(dst_fd, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+
+def _stdin_fd():
+    try:
+        return sys.stdin.fileno()
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class _PtyChild:
+    """Just enough of Popen for _reap and _kill_process_group."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self.rusage = None
+
+def run_pty(cmd, tee=True, capture=None, forward_input=True, timeout=None, idle_timeout=None):
+    """Run cmd on a pseudo-terminal, passing keystrokes through and recording output.
+
+    timeout and idle_timeout work as in run_streaming; on expiry the command's
+    session is terminated and capture.timed_out is set.
+    """
+    capture = capture or OutputCapture()
+    stdin_fd = _stdin_fd() if forward_input else None
+    stdin_is_tty = stdin_fd is not None and os.isatty(stdin_fd)
+    start = time.monotonic()
+    pid, master = pty.fork()
+    if pid == 0:
+        try:
+            os.execv('/bin/sh', ['/bin/sh', '-c', cmd])
+        finally:
+            os._exit(127)
+    # pty.fork() makes the child a session leader, so its pid is also its pgid
+    child = _PtyChild(pid)
+
+    old_winch = None
+    old_attrs = None
+    if stdin_is_tty:
+        _copy_winsize(stdin_fd, master)
+        old_winch = signal.signal(signal.SIGWINCH, lambda *_: _copy_winsize(stdin_fd, master))
+        old_attrs = termios.tcgetattr(stdin_fd)
+        tty.setraw(stdin_fd)
+    read_fds = [master] + ([stdin_fd] if stdin_fd is not None else [])
+    last_activity = start
+    try:
+        while True:
+            wait = None
+            now = time.monotonic()
+            if timeout:
+                wait = timeout - (now - start)
+            if idle_timeout:
+                idle_left = idle_timeout - (now - last_activity)
+                wait = idle_left if wait is None else min(wait, idle_left)
+            if wait is not None and wait <= 0:
+                capture.timed_out = 'timeout' if timeout and now - start >= timeout else 'idle'
+                break
+            ready, _, _ = select.select(read_fds, [], [], wait)
+            if ready:
+                last_activity = time.monotonic()
+            if master in ready:
+                try:
+                    data = os.read(master, READ_CHUNK_BYTES)
+                except OSError:
+                    # EIO: the slave side closed because the command exited
+                    data = b''
+                if not data:
+                    break
+                capture.write(data)
+                if tee:
+                    _write_all(sys.stdout.fileno(), data)
+            if stdin_fd in ready:
+                data = os.read(stdin_fd, 1024)
+                if data:
+                    _write_all(master, data)
+                else:
+                    read_fds.remove(stdin_fd)
+    finally:
+        if old_attrs is not None:
+            termios.tcsetattr(stdin_fd, termios.TCSAFLUSH, old_attrs)
+        if old_winch is not None:
+            signal.signal(signal.SIGWINCH, old_winch)
+        if capture.timed_out:
+            _kill_process_group(child)
+        os.close(master)
+        _reap(child)
+        capture.returncode = child.returncode
+        capture.usage = resource_usage(child.rusage, time.monotonic() - start)
+    if capture.timed_out:
+        capture.returncode = 124
+        capture.write(timeout_marker(capture.timed_out, timeout, idle_timeout).encode())
+    return capture
+
+@traced('execute')
+def execute_command(cmd, check_for_sudo=False, force_interactive=False, timeout=None, idle_timeout=None,
+                    usage=None):
+    """Run cmd (after safety prompts) and return (returncode, output, is_interactive).
+
+    If a usage dict is passed it is filled with the run's wall/CPU/RSS figures.
+    """
     print(f'\n$ {cmd}')
     
     # Check for sudo
     if check_for_sudo and cmd.startswith('sudo'):
-        response = input('[!] Warning: This command uses sudo. Continue? (y/n): ')
+        response = user_input('[!] Warning: This command uses sudo. Continue? (y/n): ')
         if response.lower() != 'y':
             print('[!] Aborted.')
             return None, None, False
@@ -101,7 +1390,7 @@ def execute_command(cmd, check_for_sudo=False, force_interactive=False):
         print('[!] WARNING: This command will execute a remote or local script through piped shell.')
         print('[!] Pattern detected: pipes to bash|sh|zsh')
         print('[!] The script will be downloaded and executed with full shell privileges.')
-        response = input('[!] Continue anyway? (y/n): ')
+        response = user_input('[!] Continue anyway? (y/n): ')
         if response.lower() != 'y':
             print('[!] Aborted.')
             return None, None, False
@@ -110,7 +1399,7 @@ def execute_command(cmd, check_for_sudo=False, force_interactive=False):
     is_interactive = is_interactive_command(cmd)
     if is_interactive and not force_interactive:
         print('[!] WARNING: This command is INTERACTIVE and requires manual user input.')
-        print('[!] The tool will not handle interactive prompts.')
+        print('[!] It will run on a terminal you control; its output is recorded for diagnosis.')
         print('[!] You must interact with the command manually.')
         
         alternatives = get_non_interactive_alternative(cmd)
@@ -120,20 +1409,33 @@ def execute_command(cmd, check_for_sudo=False, force_interactive=False):
                 print(f'  [{i}] {alt}')
             print()
         
-        response = input('[!] Continue anyway and handle prompts manually? (y/n): ')
+        response = user_input('[!] Continue anyway and handle prompts manually? (y/n): ')
         if response.lower() != 'y':
             print('[!] Aborted.')
             return None, None, False
     
     try:
         if is_interactive:
-            # Interactive commands need to run without capturing output
-            result = subprocess.run(cmd, shell=True, capture_output=False)
-            return result.returncode, '', True  # is_interactive flag
+            # Interactive commands run on a PTY; keep a transcript of what they printed
+            capture = run_pty(cmd, timeout=timeout, idle_timeout=idle_timeout)
+            output = clean_transcript(capture.text())
+            if capture.timed_out:
+                print(f'\n[!] Command {"hung" if capture.timed_out == "idle" else "timed out"}; terminated. Diagnosing partial output.')
+            capture.close()
+            if usage is not None:
+                usage.update(capture.usage)
+            return capture.returncode, output, True  # is_interactive flag
         else:
-            # Non-interactive commands: capture output for AI analysis
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            return result.returncode, result.stdout + result.stderr, False
+            # Non-interactive commands: stream live, keep a bounded copy for AI analysis
+            capture = run_streaming(cmd, timeout=timeout, idle_timeout=idle_timeout)
+            # Diagnosis works from stderr plus the stdout lines leading up to it
+            output = capture.failure_context()
+            if capture.timed_out:
+                print(f'\n[!] Command {"hung" if capture.timed_out == "idle" else "timed out"}; terminated. Diagnosing partial output.')
+            capture.close()
+            if usage is not None:
+                usage.update(capture.usage)
+            return capture.returncode, output, False
     except Exception as e:
         return None, str(e), False
 
@@ -161,19 +1463,24 @@ def is_command_or_binary(word):
     if not word.isalnum() and not (''.join(c for c in word if c.isalnum()).isalnum()): return False
     return True
 
+@traced('context')
 def get_file_system_context(cmd):
     """Gather information about the current directory and file structure"""
     context = []
     
     try:
-        import shlex
-        parts = shlex.split(cmd)
+        analysis = parse_command(cmd)
         
         # Detect binaries/commands in the user's command (FIRST - most important)
         context.append("--- COMMAND INSTALLATION STATUS ---")
-        for part in parts:
-            if is_command_or_binary(part):
-                installed = is_command_installed(part)
+        seen = set()
+        for command in analysis.commands:
+            for part in command.prefix_words[:1] + command.argv[:1]:
+                if part in seen or not is_command_or_binary(part):
+                    continue
+                seen.add(part)
+                with trace_span('context.installed', program=part):
+                    installed = is_command_installed(part)
                 status = "✓ INSTALLED" if installed else "✗ NOT INSTALLED - MUST INSTALL FIRST"
                 context.append(f"  {status}: {part}")
         
@@ -182,9 +1489,10 @@ def get_file_system_context(cmd):
         context.append(f"\nCurrent working directory: {cwd}")
         
         # If command involves /home/, list /home/ to show available users
-        if '/home/' in cmd.lower():
+        if '/home/' in analysis.lower:
             try:
-                result = subprocess.run(['ls', '-1', '/home/'], capture_output=True, text=True)
+                with trace_span('context.list', path='/home/'):
+                    result = subprocess.run(['ls', '-1', '/home/'], capture_output=True, text=True)
                 if result.returncode == 0:
                     users = result.stdout.strip().split('\n')[:20]
                     context.append(f"Available users in /home/:")
@@ -193,37 +1501,34 @@ def get_file_system_context(cmd):
                 pass
         
         # If command involves cd to a path, check if that directory exists
-        if 'cd ' in cmd.lower():
-            import shlex
-            parts = shlex.split(cmd)
-            for i, part in enumerate(parts):
-                if part == 'cd' and i + 1 < len(parts):
-                    target_path = parts[i + 1]
-                    if os.path.isdir(target_path):
-                        context.append(f"Target directory EXISTS: {target_path}")
-                        try:
+        for command in analysis.commands:
+            if command.name == 'cd' and command.args:
+                target_path = command.args[0]
+                if os.path.isdir(target_path):
+                    context.append(f"Target directory EXISTS: {target_path}")
+                    try:
+                        with trace_span('context.list', path=target_path):
                             result = subprocess.run(['ls', '-1', target_path], capture_output=True, text=True)
-                            if result.returncode == 0:
-                                items = result.stdout.strip().split('\n')[:20]
-                                context.append(f"Contents of {target_path}:")
-                                context.extend([f"  - {item}" for item in items if item])
-                        except:
-                            pass
-                    else:
-                        context.append(f"Target directory DOES NOT EXIST: {target_path}")
-                    break
+                        if result.returncode == 0:
+                            items = result.stdout.strip().split('\n')[:20]
+                            context.append(f"Contents of {target_path}:")
+                            context.extend([f"  - {item}" for item in items if item])
+                    except:
+                        pass
+                else:
+                    context.append(f"Target directory DOES NOT EXIST: {target_path}")
+                break
         
         # If command involves accessing a file, check if parent directory exists
-        import shlex
-        parts = shlex.split(cmd)
-        for part in parts:
+        for part in analysis.words + analysis.redirect_targets:
             if os.path.isfile(part):
                 context.append(f"File EXISTS: {part}")
             elif not part.startswith('-') and '/' in part:
                 parent_dir = os.path.dirname(part)
                 if parent_dir and os.path.isdir(parent_dir):
                     try:
-                        result = subprocess.run(['ls', '-1', parent_dir], capture_output=True, text=True)
+                        with trace_span('context.list', path=parent_dir):
+                            result = subprocess.run(['ls', '-1', parent_dir], capture_output=True, text=True)
                         if result.returncode == 0:
                             items = result.stdout.strip().split('\n')[:20]
                             context.append(f"Contents of parent directory {parent_dir}:")
@@ -258,118 +1563,772 @@ def get_platform_info():
     else:
         return system
 
+APP_MAPPING = {
+    'docker-compose': 'Docker Compose',
+    'docker': 'Docker',
+    'kubernetes': 'Kubernetes',
+    'kubectl': 'Kubernetes (kubectl)',
+    'git': 'Git',
+    'npm': 'Node.js (npm)',
+    'pip': 'Python (pip)',
+    'aws': 'AWS CLI',
+    'gcloud': 'Google Cloud CLI',
+    'az': 'Azure CLI',
+    'brew': 'Homebrew',
+    'apt': 'apt (package manager)',
+    'yum': 'yum (package manager)',
+    'dnf': 'dnf (package manager)'
+}
+
 def get_app_info(command):
     """Detect application/service from command"""
-    command_parts = command.lower().strip().split()
-    if not command_parts:
-        return None
-    
-    app_mapping = {
-        'docker-compose': 'Docker Compose',
-        'docker': 'Docker',
-        'kubernetes': 'Kubernetes',
-        'kubectl': 'Kubernetes (kubectl)',
-        'git': 'Git',
-        'npm': 'Node.js (npm)',
-        'pip': 'Python (pip)',
-        'aws': 'AWS CLI',
-        'gcloud': 'Google Cloud CLI',
-        'az': 'Azure CLI',
-        'brew': 'Homebrew',
-        'apt': 'apt (package manager)',
-        'yum': 'yum (package manager)',
-        'dnf': 'dnf (package manager)'
-    }
-    
-    # Skip common prefixes like sudo
-    prefixes_to_skip = ['sudo', 'time', 'env']
-    
-    for part in command_parts:
-        if part in prefixes_to_skip:
-            continue
-        for key, value in app_mapping.items():
-            # Check for exact match first
-            if part == key:
-                return value
-    
-    # If no exact match, try substring matches
-    for part in command_parts:
-        if part in prefixes_to_skip:
-            continue
-        for key, value in app_mapping.items():
-            # Docker-compose check - make sure we don't match just 'docker'
-            if key in part and (key == 'docker' and not part.startswith('docker-')):
-                return value
-            # Normal substring match
-            if key in part:
-                return value
-    
-    return None
+    return detect_command(command)['app']
 
-def categorize_error_type(error_message, command):
-    """Categorize the type of error to provide better context"""
-    error_lower = error_message.lower()
-    
-    # Daemon/service not running
-    daemon_patterns = [
-        'daemon not running',
-        'connect to the.*api',
-        'no such file or directory.*docker.sock',
-        'connection refused.*docker',
-        'could not connect to server'
-    ]
-    for pattern in daemon_patterns:
-        if re.search(pattern, error_lower):
-            if 'macOS' in get_platform_info():
-                return 'daemon_not_running: macOS: Use open -a Docker app'
-            else:
-                return 'daemon_not_running: Linux: Use systemctl start docker'
-    
-    # Permission/access denied (check before syntax)
-    if re.search(r'permission denied|access denied|unauthorized', error_lower):
-        return 'permission_denied: User lacks required permissions'
-    
-    # Connection/refused errors specific to Docker daemon
-    if re.search(r'connection refused.*docker|cannot connect.*docker', error_lower):
-        return 'daemon_not_running: Docker daemon not running'
-    
+# --- Command detectors ---
+#
+# The detector tables above (plus any entries from PATCH_HOME/detectors.json)
+# are compiled once into DetectorTables: exact-name dicts and an Aho-Corasick
+# automaton for the app keywords, which get_app_info matches as substrings of
+# every word. detect_command() then answers all four detectors in one pass
+# over the parsed command, and its cost depends on the command's length, not
+# on how many entries the tables hold.
+#
+# detectors.json (or the file named by PATCH_DETECTORS) may contain:
+#   {"interactive": ["mycli"], "non_interactive_flags": {"mycli": ["-e"]},
+#    "interactive_sudo_subcommands": [["zypper", "install"]],
+#    "alternatives": {"mycli": ["mycli -e \"{query}\""]},
+#    "apps": {"terraform": "Terraform"}, "shells": ["fish"]}
+# Entries extend the built-in tables; built-in app keywords keep priority.
+
+DETECTOR_CONFIG = os.path.join(PATCH_HOME, 'detectors.json')
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over (keyword, value) pairs.
+
+    find_best(text) returns the value of the earliest-listed keyword that
+    occurs anywhere in text, in one pass over text whatever the number of
+    keywords.
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [None]   # (rank, value) of the best keyword ending here or at a suffix
+        for rank, (keyword, value) in enumerate(keywords):
+            node = 0
+            for ch in keyword:
+                child = self.goto[node].get(ch)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                    self.goto[node][ch] = child
+                node = child
+            if self.best[node] is None or rank < self.best[node][0]:
+                self.best[node] = (rank, value)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                if node:
+                    self.fail[child] = self.goto[fail].get(ch, 0)
+                inherited = self.best[self.fail[child]]
+                if inherited and (self.best[child] is None or inherited[0] < self.best[child][0]):
+                    self.best[child] = inherited
+
+    def find_best(self, text):
+        goto, fail, best = self.goto, self.fail, self.best
+        node = 0
+        found = None
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            candidate = best[node]
+            if candidate and (found is None or candidate[0] < found[0]):
+                found = candidate
+        return found[1] if found else None
+
+def load_detector_config(path=None):
+    """Extra detector entries from PATCH_DETECTORS or PATCH_HOME/detectors.json ({} if none)."""
+    path = path or os.environ.get('PATCH_DETECTORS') or DETECTOR_CONFIG
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f'[!] Ignoring detector config {path}: {e}', file=sys.stderr)
+        return {}
+    if not isinstance(config, dict):
+        print(f'[!] Ignoring detector config {path}: expected a JSON object', file=sys.stderr)
+        return {}
+    return config
+
+class DetectorTables:
+    """The built-in detector tables merged with config entries and compiled for lookup."""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.interactive = {name: frozenset(NON_INTERACTIVE_FLAGS.get(name, ())) for name in INTERACTIVE_COMMANDS}
+        self.sudo_subcommands = collections.defaultdict(set)
+        for name, subcommand in INTERACTIVE_SUDO_SUBCOMMANDS:
+            self.sudo_subcommands[name].add(subcommand)
+        self.alternatives = dict(NON_INTERACTIVE_ALTERNATIVES)
+        self.shells = set(SHELL_INTERPRETERS)
+        apps = dict(APP_MAPPING)
+        try:
+            for name in config.get('interactive', []):
+                self.interactive.setdefault(name.lower(), frozenset())
+            for name, flags in config.get('non_interactive_flags', {}).items():
+                self.interactive[name.lower()] = self.interactive.get(name.lower(), frozenset()) | set(flags)
+            for name, subcommand in config.get('interactive_sudo_subcommands', []):
+                self.sudo_subcommands[name.lower()].add(subcommand.lower())
+            self.alternatives.update((name.lower(), list(alts)) for name, alts in config.get('alternatives', {}).items())
+            self.shells.update(name.lower() for name in config.get('shells', []))
+            for keyword, label in config.get('apps', {}).items():
+                apps.setdefault(keyword.lower(), str(label))
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f'[!] Detector config partly ignored: {e}', file=sys.stderr)
+        self.apps = apps
+        self.app_keywords = KeywordAutomaton(apps.items())
+
+@functools.lru_cache(maxsize=1)
+def detector_tables():
+    """The compiled DetectorTables, built on first use."""
+    return DetectorTables(load_detector_config())
+
+@functools.lru_cache(maxsize=256)
+def detect_command(cmd):
+    """Answer every command detector in one pass over the parsed command (memoized).
+
+    Returns {'interactive', 'pipe_to_shell', 'alternative', 'app'}.
+    """
+    tables = detector_tables()
+    interactive = pipe_to_shell = False
+    alternative = app = app_substring = None
+    for pipeline in parse_command(cmd).pipelines:
+        for position, command in enumerate(pipeline.commands):
+            name = command.name
+            if position and name in tables.shells:
+                pipe_to_shell = True
+            flags = tables.interactive.get(name)
+            if flags is not None and not (flags and any(arg.split('=', 1)[0] in flags for arg in command.args)):
+                interactive = True
+            if 'sudo' in command.prefixes and len(command.argv) >= 2 and \
+                    command.argv[1].lower() in tables.sudo_subcommands.get(command.argv[0].lower(), ()):
+                interactive = True
+            if alternative is None:
+                alternative = tables.alternatives.get(name)
+            if app is not None:
+                continue
+            # Wrapper prefixes like sudo/env/time are already split off by the parser
+            for word in command.argv:
+                part = word.lower()
+                app = tables.apps.get(part)
+                if app is not None:
+                    break
+                if app_substring is None:
+                    app_substring = tables.app_keywords.find_best(part)
+    return {'interactive': interactive, 'pipe_to_shell': pipe_to_shell,
+            'alternative': alternative, 'app': app or app_substring}
+
+# (pattern, category) in priority order: the first pattern found in the
+# lowercased message decides. A category of None is the daemon case, whose
+# hint depends on the platform.
+ERROR_TYPE_RULES = [
+    # Command was killed by patch's own wall-clock or inactivity limit
+    (r'\[patch\] command (timed out|hung)', 'timeout: Command hung or exceeded its time limit (partial output only)'),
+    # Daemon/service not running
+    (r'daemon not running|connect to the.*api|no such file or directory.*docker\.sock|'
+     r'connection refused.*docker|could not connect to server', None),
+    # Permission/access denied (check before syntax)
+    (r'permission denied|access denied|unauthorized', 'permission_denied: User lacks required permissions'),
+    # Connection/refused errors specific to Docker daemon
+    (r'connection refused.*docker|cannot connect.*docker', 'daemon_not_running: Docker daemon not running'),
     # Network issues
-    if re.search(r'connection refused|cannot connect|connection failed|failed to connect|unable to connect', error_lower):
-        return 'network_error: Cannot connect to remote host'
-    if re.search(r'hostname|servname|network.*unreachable', error_lower):
-        return 'network_error: Cannot connect to remote host'
-    
+    (r'connection refused|cannot connect|connection failed|failed to connect|unable to connect',
+     'network_error: Cannot connect to remote host'),
+    (r'hostname|servname|network.*unreachable', 'network_error: Cannot connect to remote host'),
     # Package/dependency issues
-    if re.search(r'module.*not.*found|no.*such.*module|modulenotfounderror', error_lower):
-        return 'dependency_missing: Required package not available'
-    if re.search(r'package not found|package.*could.*not.*be.*found', error_lower):
-        return 'dependency_missing: Required package not available'
-    
+    (r'module.*not.*found|no.*such.*module|modulenotfounderror', 'dependency_missing: Required package not available'),
+    (r'package not found|package.*could.*not.*be.*found', 'dependency_missing: Required package not available'),
     # Configuration issues
-    if re.search(r'configuration.*not.*found|config.*file', error_lower):
-        return 'configuration: Configuration or file not found'
-    
+    (r'configuration.*not.*found|config.*file', 'configuration: Configuration or file not found'),
     # File/directory not found (check last - most generic)
-    if re.search(r'no such file or directory|file not found', error_lower):
-        return 'file_not_found: File or directory does not exist'
-    
+    (r'no such file or directory|file not found', 'file_not_found: File or directory does not exist'),
     # Syntax/command error (check last - most generic)
-    if re.search(r'invalid option|unrecognized command|command not found|illegal option|unknown option|usage:|is not a', error_lower):
-        return 'command_syntax: Invalid command syntax or options'
-    
+    (r'invalid option|unrecognized command|command not found|illegal option|unknown option|usage:|is not a',
+     'command_syntax: Invalid command syntax or options'),
+]
+
+# The rules are compiled once into literal sequences: "connect to the.*api"
+# becomes ('connect to the', 'api'), and "(timed out|hung)" groups expand
+# into one sequence per branch. Matching is then plain str.find with no
+# backtracking, so classifying n bytes costs at most one linear scan per
+# distinct literal. re.search on stacked .* patterns is quadratic on long
+# lines (a 1MB line of "module ..." took minutes).
+_RULE_METACHARS = set('.^$*+?{}[]|()')
+
+def _split_alternatives(pattern):
+    """Split a regex on its top-level | (not inside groups or classes)."""
+    parts, depth, start, i = [], 0, 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            i += 1
+        elif ch in '([':
+            depth += 1
+        elif ch in ')]':
+            depth -= 1
+        elif ch == '|' and depth == 0:
+            parts.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    parts.append(pattern[start:])
+    return parts
+
+def _expand_groups(pattern):
+    """Expand (a|b) groups into one alternative per branch."""
+    depth, i = 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            i += 1
+        elif ch == '(' and depth == 0:
+            start = i
+            depth = 1
+        elif ch == '(':
+            depth += 1
+        elif ch == ')' and depth:
+            depth -= 1
+            if depth == 0:
+                head, tail = pattern[:start], pattern[i + 1:]
+                return [expanded for branch in _split_alternatives(pattern[start + 1:i])
+                        for expanded in _expand_groups(head + branch + tail)]
+        i += 1
+    return [pattern]
+
+def _rule_sequences(pattern):
+    """Compile a rule regex into literal sequences matched in order within one line.
+
+    Only literals, escapes, .* gaps, | and (a|b) groups are supported;
+    anything else raises ValueError so a new rule cannot silently misbehave.
+    """
+    sequences = []
+    for alternative in _split_alternatives(pattern):
+        for expanded in _expand_groups(alternative):
+            literals, current, i = [], [], 0
+            while i < len(expanded):
+                ch = expanded[i]
+                if ch == '\\' and i + 1 < len(expanded) and not expanded[i + 1].isalnum():
+                    current.append(expanded[i + 1])
+                    i += 2
+                    continue
+                if expanded.startswith('.*', i):
+                    literals.append(''.join(current))
+                    current = []
+                    i += 2
+                    continue
+                if ch in _RULE_METACHARS or ch == '\\':
+                    raise ValueError(f'unsupported construct {expanded[i:i + 2]!r} in error rule {pattern!r}')
+                current.append(ch)
+                i += 1
+            literals.append(''.join(current))
+            sequences.append(tuple(literal for literal in literals if literal))
+    return sequences
+
+def _matching_lines(text, literals, absent):
+    """Yield the start offset of each line of text on which literals occur in order.
+
+    This is re.search of a.*b.*c line by line. absent caches literals known
+    not to occur anywhere in text.
+    """
+    first = literals[0]
+    if first in absent:
+        return
+    start = 0
+    while True:
+        pos = text.find(first, start)
+        if pos == -1:
+            if start == 0:
+                absent.add(first)
+            return
+        line_end = text.find('\n', pos)
+        if line_end == -1:
+            line_end = len(text)
+        line_start = pos
+        # The leftmost occurrence of each literal leaves the most room for the rest
+        pos += len(first)
+        for literal in literals[1:]:
+            if literal in absent:
+                return
+            pos = text.find(literal, pos, line_end)
+            if pos == -1:
+                break
+            pos += len(literal)
+        else:
+            yield text.rfind('\n', 0, line_start) + 1
+            start = line_end + 1
+            continue
+        # Any matching line contains the literal that was missing here, so
+        # skip to the next one that does instead of walking every line
+        pos = text.find(literal, line_end)
+        if pos == -1:
+            return
+        start = text.rfind('\n', 0, pos) + 1
+
+def _find_sequence(text, literals, absent):
+    """True if literals occur in order on one line of text."""
+    return next(_matching_lines(text, literals, absent), None) is not None
+
+_ERROR_TYPE_TABLE = [(_rule_sequences(pattern), category) for pattern, category in ERROR_TYPE_RULES]
+# Rules for text patch writes itself (its timeout marker): these are facts
+# about the run, not guesses, so no model answer is taken over them
+_PATCH_MARKER_TABLE = [entry for entry, (pattern, _) in zip(_ERROR_TYPE_TABLE, ERROR_TYPE_RULES)
+                       if pattern.startswith(r'\[patch\]')]
+
+def patch_marker_category(error_message):
+    """The category of a marker patch itself wrote into the output, or None."""
+    error_lower = error_message.lower()
+    absent = set()
+    for sequences, category in _PATCH_MARKER_TABLE:
+        if any(_find_sequence(error_lower, literals, absent) for literals in sequences):
+            return category
+    return None
+
+@functools.lru_cache(maxsize=1)
+def _daemon_hint():
+    if 'macOS' in get_platform_info():
+        return 'daemon_not_running: macOS: Use open -a Docker app'
+    return 'daemon_not_running: Linux: Use systemctl start docker'
+
+@traced('classify')
+def categorize_error_type(error_message, command):
+    """Categorize the type of error to provide better context"""
+    predicted = patch_marker_category(error_message) or model_category(error_message, command)
+    if predicted:
+        return predicted
+    error_lower = error_message.lower()
+    absent = set()
+    for sequences, category in _ERROR_TYPE_TABLE:
+        if any(_find_sequence(error_lower, literals, absent) for literals in sequences):
+            return category or _daemon_hint()
     return 'other: General error'
 
-def ask_openai_for_fix(error, cmd, previous_error=None, previous_fix=None):
-    client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-    
-    platform_info = get_platform_info()
-    app_info = get_app_info(cmd)
-    error_type = categorize_error_type(error, cmd)
-    
-    # Gather file system context
-    file_system_context = get_file_system_context(cmd)
-    
-    system_prompt = """You are a helpful CLI assistant. Fix shell commands based on errors.
+# Multi-label classification keeps every matching category and where its
+# evidence is, as line ranges. ErrorEvidence is fed text as it arrives, so
+# stderr is classified while it streams; the prompt builder then sends long
+# output as evidence spans with context instead of the whole text.
+EVIDENCE_MAX_SPANS = 20
+# A line this long without a newline is classified in pieces
+EVIDENCE_LINE_MAX_CHARS = 1 << 20
+
+class ErrorEvidence:
+    """Incremental multi-label error classifier with evidence line ranges."""
+
+    def __init__(self):
+        self.lines = 0
+        self._carry = []
+        self._carry_len = 0
+        self._labels = {}   # category -> {'rank', 'count', 'spans'}
+
+    def feed(self, text):
+        """Classify text (any split, including partial lines); returns self."""
+        end = text.rfind('\n') + 1
+        if not end and self._carry_len + len(text) < EVIDENCE_LINE_MAX_CHARS:
+            self._carry.append(text)
+            self._carry_len += len(text)
+            return self
+        if not end:
+            end = len(text)
+        self._carry.append(text[:end])
+        block = ''.join(self._carry)
+        self._carry = [text[end:]] if end < len(text) else []
+        self._carry_len = len(text) - end
+        self._scan(block if block.endswith('\n') else block + '\n')
+        return self
+
+    def finish(self):
+        if self._carry_len:
+            self._scan(''.join(self._carry) + '\n')
+            self._carry = []
+            self._carry_len = 0
+        return self
+
+    def _scan(self, block):
+        lower = block.lower()
+        absent = set()
+        # Several rules can share a category: collect their lines together
+        found = {}
+        for rank, (sequences, category) in enumerate(_ERROR_TYPE_TABLE):
+            for literals in sequences:
+                for start in _matching_lines(lower, literals, absent):
+                    found.setdefault(category or _daemon_hint(), (rank, set()))[1].add(start)
+        for category, (rank, starts) in found.items():
+            label = self._labels.setdefault(category, {'rank': rank, 'count': 0, 'spans': []})
+            label['rank'] = min(label['rank'], rank)
+            spans = label['spans']
+            newlines, offset = 0, 0
+            for start in sorted(starts):
+                # Lines before this one in the block, counted incrementally
+                newlines += lower.count('\n', offset, start)
+                offset = start
+                line = self.lines + newlines + 1
+                label['count'] += 1
+                if spans and spans[-1][1] >= line - 1:
+                    spans[-1][1] = line
+                elif len(spans) < EVIDENCE_MAX_SPANS:
+                    spans.append([line, line])
+        self.lines += lower.count('\n')
+
+    def labels(self):
+        """[{category, score, count, lines: [[first, last], ...]}] in rule priority order.
+
+        labels()[0] is what categorize_error_type returns for the same text
+        when any rule matches (the local model is not consulted here).
+        score (0-1) combines how specific the rule is (its priority) with how
+        many lines support it.
+        """
+        result = []
+        for category, label in sorted(self._labels.items(), key=lambda item: item[1]['rank']):
+            specificity = 1 - label['rank'] / (2 * len(_ERROR_TYPE_TABLE))
+            strength = 1 - 0.5 ** label['count']
+            result.append({'category': category, 'score': round(specificity * (0.5 + 0.5 * strength), 2),
+                           'count': label['count'], 'lines': [list(span) for span in label['spans']]})
+        return result
+
+@traced('classify')
+def classify_error_labels(text):
+    """Every matching error category with its score and evidence lines (see ErrorEvidence)."""
+    return ErrorEvidence().feed(text).finish().labels()
+
+# Longer error output is sent to the model as evidence spans plus the tail
+PROMPT_ERROR_CHARS = 6000
+EVIDENCE_CONTEXT_LINES = 3
+PROMPT_TAIL_LINES = 20
+PROMPT_LINE_CHARS = 500
+
+def error_excerpt(error, labels=None):
+    """error itself if short, else its evidence lines with context and its last lines."""
+    if len(error) <= PROMPT_ERROR_CHARS:
+        return error
+    if labels is None:
+        labels = classify_error_labels(error)
+    lines = error.split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    # Most important first: the tail, then evidence by rule priority
+    ranges = [(max(0, len(lines) - PROMPT_TAIL_LINES), len(lines))]
+    for label in labels:
+        for first, last in label['lines']:
+            ranges.append((max(0, first - 1 - EVIDENCE_CONTEXT_LINES), min(len(lines), last + EVIDENCE_CONTEXT_LINES)))
+    keep = set()
+    size = 0
+    for start, end in ranges:
+        added = [i for i in range(start, end) if i not in keep]
+        cost = sum(min(len(lines[i]), PROMPT_LINE_CHARS) + 1 for i in added)
+        if keep and size + cost > PROMPT_ERROR_CHARS:
+            continue
+        keep.update(added)
+        size += cost
+    parts = []
+    previous = -1
+    for i in sorted(keep):
+        if i > previous + 1:
+            parts.append(f'[... {i - previous - 1} lines omitted ...]')
+        line = lines[i]
+        parts.append(line if len(line) <= PROMPT_LINE_CHARS else line[:PROMPT_LINE_CHARS] + ' [...]')
+        previous = i
+    if previous < len(lines) - 1:
+        parts.append(f'[... {len(lines) - previous - 1} lines omitted ...]')
+    return '\n'.join(parts)
+
+# --- Local error classifier (patch train) ---
+#
+# The rules above only know the phrasings someone wrote a pattern for, and
+# everything else is "other". patch train fits a naive Bayes model on a
+# labelled corpus (corpus/errors.jsonl ships with the source): words and
+# word pairs of the error, plus the program name, are hashed into a fixed
+# number of buckets, so the model is one (buckets x categories) table of
+# log-probabilities. Classifying is a table lookup per token and a sum, and
+# a batch is one gather plus a cumulative sum over all messages at once.
+# Markers patch writes itself (its timeout line) are recognised first. After
+# them a confident model answer comes first and the rules decide the rest: on
+# the shipped corpus the rules are wrong about one time in seven when they
+# do match, and letting them override the model scored below the model
+# alone (patch train prints all three). NumPy is optional: without it (or
+# without a trained model) only the rules are used.
+CLASSIFIER_MODEL = os.path.join(PATCH_HOME, 'classifier.npz')
+CLASSIFIER_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'errors.jsonl')
+CLASSIFIER_BUCKETS = 1 << 16
+CLASSIFIER_SMOOTHING = 0.1
+# Only the end of long output is looked at, like the rules' evidence tail
+CLASSIFIER_TEXT_CHARS = 4000
+# Below this posterior the model's answer is not used and the rules decide
+CLASSIFIER_MIN_CONFIDENCE = 0.6
+CLASSIFIER_FOLDS = 5
+_CLASSIFIER_TOKEN = re.compile(r'[a-z_][a-z0-9_]+')
+
+
+def _classifier_grams(text, command=''):
+    """Words, adjacent word pairs and $program for one message."""
+    tokens = _CLASSIFIER_TOKEN.findall(text[-CLASSIFIER_TEXT_CHARS:].lower())
+    grams = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    words = command.split()
+    if words:
+        grams.append('$' + os.path.basename(words[0]))
+    return grams
+
+
+class ErrorClassifier:
+    """Hashed word n-gram naive Bayes over error messages (needs NumPy)."""
+
+    def __init__(self, categories, weights, prior):
+        self.categories = list(categories)
+        self.weights = weights      # (buckets, categories) log P(token | category)
+        self.prior = prior          # (categories,) log P(category)
+        self._buckets = weights.shape[0]
+
+    def _indices(self, text, command=''):
+        buckets = self._buckets
+        return [zlib.crc32(gram.encode()) % buckets for gram in _classifier_grams(text, command)]
+
+    @classmethod
+    def train(cls, examples, buckets=CLASSIFIER_BUCKETS, smoothing=CLASSIFIER_SMOOTHING):
+        """Fit on [{'error', 'category', 'command'?}, ...]."""
+        import numpy as np
+        categories = sorted({example['category'] for example in examples})
+        column = {category: i for i, category in enumerate(categories)}
+        counts = np.zeros((buckets, len(categories)))
+        docs = np.zeros(len(categories))
+        for example in examples:
+            j = column[example['category']]
+            docs[j] += 1
+            for gram in _classifier_grams(example['error'], example.get('command', '')):
+                counts[zlib.crc32(gram.encode()) % buckets, j] += 1
+        weights = np.log((counts + smoothing) / (counts.sum(axis=0) + smoothing * buckets))
+        return cls(categories, weights.astype(np.float32), np.log(docs / docs.sum()))
+
+    def _posteriors(self, scores):
+        import numpy as np
+        scores = scores + self.prior
+        scores -= scores.max(axis=-1, keepdims=True)
+        probs = np.exp(scores)
+        return probs / probs.sum(axis=-1, keepdims=True)
+
+    def classify(self, text, command=''):
+        """(category, posterior) for one message."""
+        probs = self._posteriors(self.weights[self._indices(text, command)].sum(axis=0, dtype='float64'))
+        best = int(probs.argmax())
+        return self.categories[best], float(probs[best])
+
+    def classify_batch(self, texts, commands=None):
+        """[(category, posterior), ...] for many messages in one vectorised pass."""
+        import numpy as np
+        commands = commands or [''] * len(texts)
+        indices, ends = [], []
+        for text, command in zip(texts, commands):
+            indices.extend(self._indices(text, command))
+            ends.append(len(indices))
+        # Row sums from one cumulative sum: sum(i..j) = cum[j] - cum[i]
+        cumulative = np.zeros((len(indices) + 1, len(self.categories)))
+        np.cumsum(self.weights[np.array(indices, dtype=np.intp)], axis=0, out=cumulative[1:])
+        ends = np.array(ends, dtype=np.intp)
+        starts = np.concatenate(([0], ends[:-1]))
+        probs = self._posteriors(cumulative[ends] - cumulative[starts])
+        best = probs.argmax(axis=1)
+        return [(self.categories[j], float(probs[i, j])) for i, j in enumerate(best)]
+
+    def save(self, path):
+        """Write the model atomically (a reader never sees a partial file)."""
+        import numpy as np
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.classifier-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, categories=np.array(self.categories), weights=self.weights, prior=self.prior)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path) as data:
+            return cls([str(c) for c in data['categories']], data['weights'], data['prior'])
+
+
+@functools.lru_cache(maxsize=1)
+def local_classifier():
+    """The model written by patch train, or None (no model, no NumPy, or PATCH_CLASSIFIER=0)."""
+    path = os.environ.get('PATCH_CLASSIFIER') or CLASSIFIER_MODEL
+    if path == '0' or not os.path.exists(path):
+        return None
+    try:
+        return ErrorClassifier.load(path)
+    except ImportError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f'[!] Ignoring unreadable classifier model {path}: {e}', file=sys.stderr)
+        return None
+
+def _category_description(category):
+    """'permission_denied' -> the full label the rules use for it."""
+    if category == 'daemon_not_running':
+        return _daemon_hint()
+    for _, description in ERROR_TYPE_RULES:
+        if description and description.split(':')[0] == category:
+            return description
+    return f'{category}: General error' if category == 'other' else category
+
+def model_category(error_message, command=''):
+    """The local model's label for an error, or None if unsure or untrained (then the rules decide)."""
+    classifier = local_classifier()
+    if classifier is None:
+        return None
+    category, confidence = classifier.classify(error_message, command)
+    if category == 'other' or confidence < CLASSIFIER_MIN_CONFIDENCE:
+        return None
+    return _category_description(category)
+
+
+def load_error_corpus(path):
+    """Labelled examples from a JSONL corpus: {"command", "error", "category"} per line."""
+    examples = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                example = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'{path}:{number}: {e}') from None
+            if not isinstance(example, dict) or not example.get('error') or not example.get('category'):
+                raise ValueError(f'{path}:{number}: needs "error" and "category"')
+            examples.append(example)
+    return examples
+
+def _rules_category(example):
+    error_lower = example['error'].lower()
+    absent = set()
+    for sequences, category in _ERROR_TYPE_TABLE:
+        if any(_find_sequence(error_lower, literals, absent) for literals in sequences):
+            return (category or 'daemon_not_running').split(':')[0]
+    return 'other'
+
+def _per_second(func, count):
+    start = time.perf_counter()
+    func()
+    return count / max(time.perf_counter() - start, 1e-9)
+
+def evaluate_classifier(examples, folds=CLASSIFIER_FOLDS, batch=1000):
+    """Cross-validated accuracy and throughput of the rules, the model, and both together (either way round)."""
+    truth = [example['category'] for example in examples]
+    rules = [_rules_category(example) for example in examples]
+    model = [None] * len(examples)
+    for fold in range(folds):
+        held_out = [i for i in range(len(examples)) if i % folds == fold]
+        trained = ErrorClassifier.train([e for i, e in enumerate(examples) if i % folds != fold])
+        predictions = trained.classify_batch([examples[i]['error'] for i in held_out],
+                                             [examples[i].get('command', '') for i in held_out])
+        for i, prediction in zip(held_out, predictions):
+            model[i] = prediction
+    rules_first = [rule if rule != 'other' or confidence < CLASSIFIER_MIN_CONFIDENCE else category
+                   for rule, (category, confidence) in zip(rules, model)]
+    # What model_category then the rules do
+    model_first = [category if category != 'other' and confidence >= CLASSIFIER_MIN_CONFIDENCE else rule
+                   for rule, (category, confidence) in zip(rules, model)]
+
+    def accuracy(predicted):
+        return sum(p == t for p, t in zip(predicted, truth)) / len(truth)
+
+    classifier = ErrorClassifier.train(examples)
+    sample = (examples * (batch // len(examples) + 1))[:batch]
+    texts = [example['error'] for example in sample]
+    commands = [example.get('command', '') for example in sample]
+    return {
+        'examples': len(examples),
+        'categories': sorted(set(truth)),
+        'folds': folds,
+        'accuracy': {'rules': accuracy(rules), 'model': accuracy([c for c, _ in model]),
+                     'rules+model': accuracy(rules_first), 'model+rules': accuracy(model_first)},
+        'per_second': {
+            'rules': _per_second(lambda: [categorize_error_type(t, c) for t, c in zip(texts, commands)], batch),
+            'model': _per_second(lambda: [classifier.classify(t, c) for t, c in zip(texts, commands)], batch),
+            'model_batch': _per_second(lambda: classifier.classify_batch(texts, commands), batch),
+        },
+    }, classifier
+
+def parse_train_options(args):
+    """Options for patch train: --corpus, --output and --json."""
+    options = {'corpus': CLASSIFIER_CORPUS, 'output': os.environ.get('PATCH_CLASSIFIER') or CLASSIFIER_MODEL,
+               'json': False}
+    args = list(args)
+    while args:
+        name, has_value, value = args.pop(0).partition('=')
+        if name == '--json' and not has_value:
+            options['json'] = True
+            continue
+        if name not in ('--corpus', '--output'):
+            print(f'[!] Unknown option for patch train: {name}')
+            sys.exit(1)
+        if not has_value:
+            value = args.pop(0) if args else ''
+        if not value:
+            print(f'[!] {name} expects a file name')
+            sys.exit(1)
+        options[name[2:]] = value
+    return options
+
+def train_main(args):
+    """Entry point for patch train: report accuracy and speed, then save the model."""
+    options = parse_train_options(args)
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print('[!] patch train needs NumPy: pip install numpy')
+        sys.exit(1)
+    try:
+        examples = load_error_corpus(options['corpus'])
+    except (OSError, ValueError) as e:
+        print(f'[!] Cannot read corpus: {e}')
+        sys.exit(1)
+    if len({example['category'] for example in examples}) < 2 or len(examples) < CLASSIFIER_FOLDS:
+        print(f'[!] The corpus needs at least {CLASSIFIER_FOLDS} examples in two or more categories')
+        sys.exit(1)
+    report, classifier = evaluate_classifier(examples)
+    try:
+        classifier.save(options['output'])
+    except OSError as e:
+        print(f"[!] Cannot write {options['output']}: {e}")
+        sys.exit(1)
+    report['model'] = options['output']
+    if options['json']:
+        print(json.dumps(report, indent=2))
+        sys.exit(0)
+    accuracy, speed = report['accuracy'], report['per_second']
+    print(f"[*] Corpus: {report['examples']} examples in {len(report['categories'])} categories ({options['corpus']})")
+    print(f"[*] Accuracy ({report['folds']}-fold cross-validation):")
+    print(f"    rules only             {accuracy['rules']:6.1%}")
+    print(f"    model only             {accuracy['model']:6.1%}")
+    print(f"    rules, then model      {accuracy['rules+model']:6.1%}")
+    print(f"    model, then rules      {accuracy['model+rules']:6.1%}   (what patch uses)")
+    print(f"[*] Throughput (messages per second):")
+    print(f"    rules                  {speed['rules']:>10,.0f}")
+    print(f"    model, one at a time   {speed['model']:>10,.0f}   ({1e6 / speed['model']:.0f} us each)")
+    print(f"    model, batched         {speed['model_batch']:>10,.0f}")
+    print(f"[+] Saved model to {options['output']}")
+    sys.exit(0)
+
+SYSTEM_PROMPT = """You are a helpful CLI assistant. Fix shell commands based on errors.
 
 CRITICAL INSTRUCTION - MUST FOLLOW THIS EXACT ORDER:
 
@@ -397,6 +2356,33 @@ Return ONLY the fixed command, confidence percentage (1-100), reason, and explan
 Format: command:::confidence:::reason:::explanation
 Use ::: as separators. No labels like FIXED_COMMAND:."""
 
+REMOTE_FILE_SYSTEM_CONTEXT = 'Not available: the command ran on another machine.'
+
+@traced('prompt')
+def build_fix_prompt(error, cmd, previous_error=None, previous_fix=None, rejected=None, context=None,
+                     avoid=None, local=True):
+    """Assemble the user message: file system context, error and classification.
+
+    rejected is a list of (suggestion, problems) that failed local validation.
+    context is extra text supplied by the caller (e.g. a patch serve client).
+    avoid is a fixes_to_avoid map of fixes known to fail here.
+    local is False when cmd ran on another machine (patch serve): this
+    machine's file system says nothing about it, so it is not probed.
+    """
+    platform_info = get_platform_info()
+    app_info = get_app_info(cmd)
+    labels = classify_error_labels(error)
+    error_type = (patch_marker_category(error) or model_category(error, cmd)
+                  or (labels[0]['category'] if labels else 'other: General error'))
+    # Long output goes in as evidence spans and tail rather than whole
+    excerpt = error_excerpt(error, labels)
+    
+    # Gather file system context
+    if local:
+        file_system_context = get_file_system_context(cmd)
+    else:
+        file_system_context = REMOTE_FILE_SYSTEM_CONTEXT
+    
     if previous_error and previous_fix and error == previous_error:
         # RETRY case: previous suggestion failed with same error
         context_parts = [
@@ -412,7 +2398,7 @@ Use ::: as separators. No labels like FIXED_COMMAND:."""
             f"\n",
             f"--- ERROR ---\n",
             f"Platform: {platform_info}\n",
-            f"Error message: {error}\n",
+            f"Error message: {excerpt}\n",
         ]
         
         if app_info:
@@ -430,78 +2416,144 @@ Use ::: as separators. No labels like FIXED_COMMAND:."""
             f"--- ERROR ---\n",
             f"Command that failed: {cmd}\n",
             f"Platform: {platform_info}\n",
-            f"Error: {error}\n",
+            f"Error: {excerpt}\n",
         ]
         if app_info:
             context_parts.append(f"Application: {app_info}\n")
         if error_type != 'other':
             context_parts.append(f"Error type: {error_type}\n")
             context_parts.append("Suggested approach: Focus on error type related issues.\n")
+        if len(labels) > 1:
+            context_parts.append("Other error types: " + "; ".join(
+                f"{label['category']} (lines {', '.join(f'{a}-{b}' if a != b else str(a) for a, b in label['lines'])})"
+                for label in labels[1:]) + "\n")
         user_msg = "".join(context_parts)
     
+    if context:
+        user_msg += f"\n--- CALLER CONTEXT ---\n{context}\n"
+    
+    if rejected:
+        lines = ["\n--- REJECTED SUGGESTIONS (failed local checks before running, do not repeat) ---\n"]
+        for suggestion, problems in rejected:
+            lines.append(f"{suggestion} -> {'; '.join(problems)}\n")
+        user_msg += "".join(lines)
+    
+    if avoid:
+        lines = ["\n--- DO NOT SUGGEST (already failed on this machine) ---\n"]
+        for fix, why in list(avoid.items())[:NEGATIVE_CACHE_PROMPT_FIXES]:
+            lines.append(f"{fix} -> {why}\n")
+        user_msg += "".join(lines)
+    
+    return user_msg
+
+def create_fix_completions(client, user_msg, n=1, temperature=0.3):
+    """Send the prompt and return the n response texts; API errors propagate.
+
+    While tracing the response is streamed, so the span records the time to
+    the first token; the texts returned are the same.
+    """
+    messages = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': user_msg}
+    ]
+    with trace_span('llm', model='gpt-4o-mini', n=n, prompt_chars=len(user_msg)) as attrs:
+        try:
+            if TRACER is None:
+                response = client.chat.completions.create(model='gpt-4o-mini', messages=messages,
+                                                          temperature=temperature, n=n)
+                contents = [choice.message.content for choice in response.choices]
+                usage = getattr(response, 'usage', None)
+            else:
+                contents, usage = _stream_fix_completions(client, messages, n, temperature, attrs)
+        except Exception as e:
+            count_metric('patch_llm_calls_total', outcome='error')
+            if isinstance(e, RateLimitError):
+                count_metric('patch_rate_limit_events_total', source='openai')
+            raise
+        count_metric('patch_llm_calls_total', outcome='ok')
+        if METRICS is not None:
+            prompt_tokens = getattr(usage, 'prompt_tokens', None)
+            if not isinstance(prompt_tokens, int):
+                # Roughly four characters per token
+                prompt_tokens = (len(SYSTEM_PROMPT) + len(user_msg)) // 4
+            observe_metric('patch_prompt_tokens', prompt_tokens)
+        return contents
+
+def _stream_fix_completions(client, messages, n, temperature, attrs):
+    """Streamed create_fix_completions for tracing: (texts, usage), timing the first token into attrs."""
+    started = time.perf_counter()
+    stream = client.chat.completions.create(model='gpt-4o-mini', messages=messages, temperature=temperature,
+                                            n=n, stream=True, stream_options={'include_usage': True})
+    parts = [[] for _ in range(n)]
+    usage = None
+    for chunk in stream:
+        usage = getattr(chunk, 'usage', None) or usage
+        for choice in chunk.choices:
+            if not choice.delta.content:
+                continue
+            if 'time_to_first_token_ms' not in attrs:
+                attrs['time_to_first_token_ms'] = round((time.perf_counter() - started) * 1000, 1)
+                trace_event('first_token')
+            parts[choice.index].append(choice.delta.content)
+    attrs['response_chars'] = sum(len(part) for texts in parts for part in texts)
+    return [''.join(texts) for texts in parts], usage
+
+class FixRequestError(Exception):
+    """Asking the model for a fix failed; lines holds the user-facing explanation."""
+
+    def __init__(self, lines):
+        super().__init__(' '.join(lines))
+        self.lines = lines
+
+def describe_api_error(e):
+    """User-facing lines explaining why an OpenAI request failed."""
+    if isinstance(e, AuthenticationError):
+        return ['Error: Invalid OpenAI API key.',
+                'Please check your API key and try again.',
+                'Set it with: export OPENAI_API_KEY="your-key-here"',
+                'Get a new key at: https://platform.openai.com/api-keys']
+    if isinstance(e, RateLimitError):
+        return ['Error: OpenAI API rate limit exceeded.',
+                'You have reached your request limit or exceeded your quota.',
+                'Please check your usage at: https://platform.openai.com/usage',
+                'Ensure you have sufficient credits on your OpenAI account.']
+    if isinstance(e, APITimeoutError):
+        return ['Error: OpenAI API request timed out.',
+                'Please check your internet connection and try again.']
+    if isinstance(e, APIConnectionError):
+        return ['Error: Could not connect to OpenAI servers.',
+                f'Details: {str(e)}',
+                'Please check your internet connection and try again.']
+    if isinstance(e, APIError):
+        return ['Error: OpenAI API error occurred.',
+                f'Details: {str(e)}',
+                'This might be an issue with OpenAI services. Please try again later.']
+    return [f'Unexpected error: {str(e)}',
+            'Please try again or check your setup.']
+
+def request_fix_completions(user_msg, n=1, temperature=0.3, api_key=None):
+    """Send the prompt to OpenAI with a spinner; returns the n response texts.
+
+    api_key defaults to OPENAI_API_KEY; this never prompts for one. Raises
+    FixRequestError if there is no key or the request fails.
+    """
     global stop_cursor
+    api_key = api_key or os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise FixRequestError(['OpenAI API key not found.',
+                               'Set it with: export OPENAI_API_KEY="your-key-here"'])
     stop_cursor = False
     cursor_thread = threading.Thread(target=show_blinking_cursor)
     cursor_thread.start()
     
-    response = None
-    try:
-        response = client.chat.completions.create(
-            model='gpt-4o-mini',
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': user_msg}
-            ],
-            temperature=0.3
-        )
-    except AuthenticationError:
-        stop_cursor = True
-        cursor_thread.join()
-        print('\r[*] Analyzing error       ', end='', flush=True)
-        print('\n[!] Error: Invalid OpenAI API key.')
-        print('[!] Please check your API key and try again.')
-        print('[!] Set it with: export OPENAI_API_KEY="your-key-here"')
-        print('[!] Get a new key at: https://platform.openai.com/api-keys')
-        sys.exit(1)
-    except RateLimitError:
-        stop_cursor = True
-        cursor_thread.join()
-        print('\r[*] Analyzing error       ', end='', flush=True)
-        print('\n[!] Error: OpenAI API rate limit exceeded.')
-        print('[!] You have reached your request limit or exceeded your quota.')
-        print('[!] Please check your usage at: https://platform.openai.com/usage')
-        print('[!] Ensure you have sufficient credits on your OpenAI account.')
-        sys.exit(1)
-    except APITimeoutError:
-        stop_cursor = True
-        cursor_thread.join()
-        print('\r[*] Analyzing error       ', end='', flush=True)
-        print('\n[!] Error: OpenAI API request timed out.')
-        print('[!] Please check your internet connection and try again.')
-        sys.exit(1)
-    except APIConnectionError as e:
-        stop_cursor = True
-        cursor_thread.join()
-        print('\r[*] Analyzing error       ', end='', flush=True)
-        print(f'\n[!] Error: Could not connect to OpenAI servers.')
-        print(f'[!] Details: {str(e)}')
-        print('[!] Please check your internet connection and try again.')
-        sys.exit(1)
-    except APIError as e:
-        stop_cursor = True
-        cursor_thread.join()
-        print('\r[*] Analyzing error       ', end='', flush=True)
-        print(f'\n[!] Error: OpenAI API error occurred.')
-        print(f'[!] Details: {str(e)}')
-        print('[!] This might be an issue with OpenAI services. Please try again later.')
-        sys.exit(1)
+    try:
+        client = OpenAI(api_key=api_key)
+        contents = create_fix_completions(client, user_msg, n, temperature)
     except Exception as e:
         stop_cursor = True
         cursor_thread.join()
         print('\r[*] Analyzing error       ', end='', flush=True)
-        print(f'\n[!] Unexpected error: {str(e)}')
-        print('[!] Please try again or check your setup.')
-        sys.exit(1)
+        raise FixRequestError(describe_api_error(e)) from e
     finally:
         if not stop_cursor:
             stop_cursor = True
@@ -509,7 +2561,11 @@ Use ::: as separators. No labels like FIXED_COMMAND:."""
             print('\r[*] Analyzing error       ', end='', flush=True)
             print('\n[+] Done')
     
-    content = response.choices[0].message.content
+    return contents
+
+@traced('parse')
+def parse_fix_response(content):
+    """Parse a "command:::confidence:::reason:::explanation" reply into its fields."""
     fix = content.strip() if content else ''
     confidence = 50
     reason = ''
@@ -602,140 +2658,3109 @@ Use ::: as separators. No labels like FIXED_COMMAND:."""
     
     return fix, str(confidence), reason, explanation
 
-def interactive_menu():
-    options = ['Apply suggested fix', 'Retry (get alternative suggestion)', 'Enter custom command', 'Explain the error', 'Exit']
-    
-    while True:
-        print('\nWhat do you want to do?')
-        for i, option in enumerate(options):
-            print(f'  [{i+1}] {option}')
-        
-        try:
-            choice = input('[?] Select option (1-5): ').strip()
-            if choice.isdigit() and 1 <= int(choice) <= 5:
-                return int(choice) - 1
-            print('[!] Invalid selection. Please try again.')
-        except (KeyboardInterrupt, EOFError):
-            print('\n[!] Exiting.')
-            sys.exit(0)
 
-def show_logo():
-    logo = r"""
-██████╗  █████╗ ████████╗ ██████╗██╗  ██╗
-██╔══██╗██╔══██╗╚══██╔══╝██╔════╝██║  ██║
-██████╔╝███████║   ██║   ██║     ███████║
-██╔═══╝ ██╔══██║   ██║   ██║     ██╔══██║
-██║     ██║  ██║   ██║   ╚██████╗██║  ██║
-╚═╝     ╚═╝  ╚═╝   ╚═╝    ╚═════╝╚═╝  ╚═╝
+# The interactive ask helpers: get_api_key() prompts for a missing key here,
+# only once the model is actually needed (history, fix packs or the team
+# cache may have answered without one)
 
+def ask_openai_for_fix(error, cmd, previous_error=None, previous_fix=None, rejected=None, avoid=None):
+    user_msg = build_fix_prompt(error, cmd, previous_error, previous_fix, rejected, avoid=avoid)
+    return parse_fix_response(request_fix_completions(user_msg, api_key=get_api_key())[0])
 
-> your broken command has been patched
+def ask_openai_for_fixes(error, cmd, count, previous_error=None, previous_fix=None, rejected=None, avoid=None):
+    """Ask for up to count distinct candidate fixes, best confidence first."""
+    user_msg = build_fix_prompt(error, cmd, previous_error, previous_fix, rejected, avoid=avoid)
+    # Higher temperature so the n samples actually differ
+    candidates = []
+    seen = set()
+    for content in request_fix_completions(user_msg, n=count, temperature=0.8, api_key=get_api_key()):
+        fix, confidence, reason, explanation = parse_fix_response(content)
+        if fix and fix not in seen:
+            seen.add(fix)
+            candidates.append((fix, confidence, reason, explanation))
+    candidates.sort(key=lambda candidate: -int(candidate[1]))
+    return candidates
+
+# --- Sandboxed validation of candidate fixes ---
+#
+# With --sandbox, several candidate fixes are tried at once before any of them
+# is offered. Each runs in a fresh user+mount namespace (no root needed)
+# where every mount is remounted read-only, the working directory is a
+# throwaway overlay of the real one and /tmp is a private tmpfs. If any
+# mount cannot be made read-only the candidate is not run. Without namespace
+# support nothing is trial-run: a temporary working directory alone would
+# not stop rm, pip install or git push from acting on the real system. A
+# suggestion that did not pass is offered as unvalidated and never
+# auto-applied by --yes.
+
+SANDBOX_CANDIDATES = 3
+SANDBOX_TIMEOUT = 30.0
+
+_SANDBOX_SETUP = r"""
+for m in $(awk '{print $2}' /proc/self/mounts); do
+    mount -o remount,bind,ro "$(printf '%b' "$m")" || exit 125
+done
+mount -t tmpfs tmpfs "$PATCH_SANDBOX_SCRATCH" || exit 125
+mkdir -p "$PATCH_SANDBOX_SCRATCH/upper" "$PATCH_SANDBOX_SCRATCH/work" "$PATCH_SANDBOX_SCRATCH/cwd"
+W="$PATCH_SANDBOX_CWD"
+mount -t overlay overlay -o lowerdir="$W",upperdir="$PATCH_SANDBOX_SCRATCH/upper",workdir="$PATCH_SANDBOX_SCRATCH/work" "$W" 2>/dev/null || W="$PATCH_SANDBOX_SCRATCH/cwd"
+case "$W" in /tmp|/tmp/*) ;; *) mount -t tmpfs tmpfs /tmp 2>/dev/null ;; esac
+cd "$W" || exit 125
+exec /bin/sh -c "$1"
 """
-    print(logo)
 
-def print_help():
-    print("""
-Patch CLI - Fix Broken Shell Commands using AI
 
-USAGE:
-    patch <command>         Fix a broken shell command
-    patch --help            Show this help message
-    patch --version         Show version information
+@functools.lru_cache(maxsize=1)
+def sandbox_namespaces_available():
+    """True if unprivileged user+mount namespaces work on this host."""
+    if not sys.platform.startswith('linux') or not shutil.which('unshare'):
+        return False
+    try:
+        result = subprocess.run(['unshare', '--user', '--map-root-user', '--mount', 'true'],
+                                capture_output=True, timeout=5)
+        return result.returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
 
-EXAMPLES:
-    patch "sudo adduser yoda"
-    patch "docker ps"
-    patch "cd /home/yoda"
+def sandbox_unsafe_reason(cmd):
+    """Why cmd should not be trial-run in a sandbox, or None if it can be."""
+    analysis = parse_command(cmd)
+    if any(p in ('sudo', 'doas') for c in analysis.commands for p in c.prefixes):
+        return 'needs root'
+    if is_pipe_to_shell(cmd):
+        return 'runs a piped script'
+    if is_interactive_command(cmd):
+        return 'interactive'
+    return None
 
-FEATURES:
-    - AI-powered command fixing using OpenAI GPT-4o-mini
-    - Confidence scoring (High/Medium/Low)
-    - Platform-aware fixes (macOS/Linux)
-    - Interactive command suggestions
-    - Error explanations
-    - File system context awareness
+def run_in_sandbox(cmd, timeout=SANDBOX_TIMEOUT):
+    """Trial-run cmd in a throwaway sandbox; returns a result dict."""
+    result = {'command': cmd, 'status': 'skipped', 'returncode': None, 'output': '', 'usage': None}
+    if not sandbox_namespaces_available():
+        reason = 'Linux user namespaces unavailable'
+    else:
+        reason = sandbox_unsafe_reason(cmd)
+    if reason:
+        result['output'] = f'not sandboxed: {reason}'
+        return result
+    scratch = tempfile.mkdtemp(prefix='patch-sandbox-')
+    try:
+        env = dict(os.environ, PATCH_SANDBOX_SCRATCH=scratch, PATCH_SANDBOX_CWD=os.getcwd())
+        wrapped = ('unshare --user --map-root-user --mount --net --fork /bin/sh -c '
+                   f'{shlex.quote(_SANDBOX_SETUP)} sandbox {shlex.quote(cmd)}')
+        capture = run_streaming(wrapped, tee=False, timeout=timeout, foreground=False,
+                                env=env, stdin=subprocess.DEVNULL)
+        result['returncode'] = capture.returncode
+        result['output'] = capture.failure_context()
+        result['usage'] = capture.usage
+        capture.close()
+        if capture.timed_out:
+            result['status'] = 'timeout'
+        elif capture.returncode == 125:
+            # The sandbox could not be set up (or the fix itself exited 125): not a pass either way
+            result['status'] = 'error'
+        else:
+            result['status'] = 'passed' if capture.returncode == 0 else 'failed'
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return result
 
-INSTALLATION:
-    pip install --break-system-packages git+https://github.com/steliosot/patch-cli.git
+def validate_candidates(commands, timeout=SANDBOX_TIMEOUT):
+    """Trial-run all candidate commands concurrently; results keep input order."""
+    if not commands:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as pool:
+        return list(pool.map(lambda c: run_in_sandbox(c, timeout), commands))
 
-REQUIREMENTS:
-    - Python 3.8+
-    - OpenAI API key (set with: export OPENAI_API_KEY="sk-...")
+def unvalidated_fix(candidate, why):
+    """candidate marked as not validated: confidence 0 and a reason saying why."""
+    fix, _, reason, explanation = candidate
+    return fix, '0', f'it is unvalidated ({why})' + (f'; {reason}' if reason else ''), explanation
 
-For more information: https://github.com/steliosot/patch-cli
-""")
+def choose_validated_fix(candidates, options):
+    """Validate candidates in parallel and return the best one that passed.
 
-def main():
-    # Check for help flag
-    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h', 'help']:
-        print_help()
-        sys.exit(0)
-    
-    show_logo()
-    
-    if len(sys.argv) < 2:
-        print('[!] Usage: patch <command>')
-        print('[!] Run: patch --help for more information')
-        sys.exit(1)
-    
-    api_key = get_api_key()
-    if not api_key:
-        print('[!] OpenAI API key required')
-        sys.exit(1)
-    
-    original_cmd = ' '.join(sys.argv[1:])
-    cmd = original_cmd
-    max_attempts = 5
-    max_retries = 3
-    attempt = 0
-    retry_count = 0
-    previous_error = None
-    previous_fix = None
-    
-    while attempt < max_attempts:
-        attempt += 1
-        returncode, output, is_interactive = execute_command(cmd, check_for_sudo=True)
-        
-        # If user aborted early (returncode is None or output is None), exit
-        if returncode is None or output is None:
-            print('[!] Command aborted by user.')
-            return
-        
-        if returncode == 0:
-            print('[+] Success!')
-            if output:
-                print(output)
-            return
-        
-        # For interactive commands, we can't analyze the output safely
-        if is_interactive:
+    If none passed, the highest-confidence one is returned marked by
+    unvalidated_fix().
+    """
+    if not sandbox_namespaces_available():
+        print('[!] Linux user namespaces unavailable: candidates cannot be trial-run safely.')
+        return unvalidated_fix(candidates[0], 'no sandbox on this host')
+    print(f'\n[*] Validating {len(candidates)} candidate fix(es) in parallel sandboxes...')
+    results = validate_candidates([c[0] for c in candidates], options.get('sandbox_timeout', SANDBOX_TIMEOUT))
+    for candidate, result in zip(candidates, results):
+        print(f"  [{result['status']:>7}] ({candidate[1]}%) {candidate[0]}")
+    for candidate, result in zip(candidates, results):
+        if result['status'] == 'passed':
+            print('[+] Validated in sandbox')
+            return candidate
+    print('[!] No candidate passed in the sandbox; showing the highest-confidence one, UNVALIDATED.')
+    return unvalidated_fix(candidates[0], 'no candidate passed in the sandbox')
+
+# --- Local pre-validation of suggested fixes ---
+#
+# Cheap checks run on every suggestion before it is shown: shell syntax
+# (bash -n), that each program resolves on PATH or is installed by an earlier
+# step of the same fix, and that long options exist in the installed tool's
+# own --help output. A rejected suggestion is re-asked with the reasons,
+# without using up one of the user's attempts. git SUB -h runs SUB if it is
+# an alias, and an alias can be any shell command (!cmd), so git aliases are
+# never asked for their help.
+
+MAX_VALIDATION_REASKS = 2
+
+SHELL_BUILTINS = {
+    'cd', 'echo', 'export', 'source', '.', 'alias', 'unalias', 'set', 'unset', 'exit', 'return',
+    'read', 'eval', 'exec', 'test', '[', '[[', ']]', 'true', 'false', 'printf', 'pwd', 'type', 'hash',
+    'ulimit', 'umask', 'wait', 'trap', 'shift', 'let', 'local', 'declare', 'typeset', 'readonly',
+    'if', 'then', 'else', 'elif', 'fi', 'for', 'while', 'until', 'do', 'done', 'case', 'esac',
+    'function', 'select', 'time', '{', '}', '!', 'history', 'jobs', 'fg', 'bg', 'kill', 'builtin',
+    'command', 'getopts', 'times', 'shopt', 'complete', 'pushd', 'popd', 'dirs', 'disown',
+    'mapfile', 'readarray', 'bind', 'enable', 'help', 'fc', 'coproc', 'compgen', 'newgrp',
+}
+# (program, subcommand) pairs that install software for later steps
+INSTALL_STEPS = {
+    ('apt-get', 'install'), ('apt', 'install'), ('dnf', 'install'), ('yum', 'install'),
+    ('brew', 'install'), ('pip', 'install'), ('pip3', 'install'), ('npm', 'install'),
+    ('snap', 'install'), ('apk', 'add'), ('pacman', '-s'), ('zypper', 'install'),
+    ('port', 'install'), ('gem', 'install'), ('cargo', 'install'), ('go', 'install'),
+}
+# Tools whose long options are checked against their own help output.
+# '' = `tool --help`, 'sub' = `tool SUB --help`, 'sub-h' = `tool SUB -h`
+FLAG_CHECKED_TOOLS = {
+    'ls': '', 'cp': '', 'mv': '', 'rm': '', 'mkdir': '', 'ln': '', 'chmod': '', 'chown': '',
+    'cat': '', 'head': '', 'tail': '', 'sort': '', 'uniq': '', 'wc': '', 'du': '', 'df': '',
+    'grep': '', 'sed': '', 'tar': '', 'systemctl': '',
+    'docker': 'sub', 'pip': 'sub', 'pip3': 'sub', 'git': 'sub-h',
+}
+_LONG_OPTION_RE = re.compile(r'--(\[no-\])?([a-z0-9][a-z0-9-]*)')
+
+
+def check_fix_syntax(fix):
+    """Return bash's syntax error for fix, or None if it parses."""
+    shell = shutil.which('bash') or '/bin/sh'
+    try:
+        result = subprocess.run([shell, '-n', '-c', fix], capture_output=True, text=True, timeout=5,
+                                stdin=subprocess.DEVNULL)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()
+        return message[0] if message else 'syntax error'
+    return None
+
+@functools.lru_cache(maxsize=128)
+def known_long_options(path, subcommand=None, help_flag='--help'):
+    """Long option names listed in a tool's help output (empty if unavailable)."""
+    argv = [path] + ([subcommand] if subcommand else []) + [help_flag]
+    env = dict(os.environ, PAGER='cat', GIT_PAGER='cat', MANPAGER='cat', LC_ALL='C')
+    try:
+        result = subprocess.run(argv, capture_output=True, text=True, timeout=3,
+                                stdin=subprocess.DEVNULL, env=env)
+    except (OSError, subprocess.TimeoutExpired):
+        return frozenset()
+    options = set()
+    for negatable, name in _LONG_OPTION_RE.findall(result.stdout + result.stderr):
+        options.add(name)
+        if negatable:
+            options.add('no-' + name)
+    return frozenset(options)
+
+def _is_git_alias(path, subcommand):
+    """True if subcommand is a git alias here (or if that cannot be told)."""
+    try:
+        result = subprocess.run([path, 'config', '--get', f'alias.{subcommand}'], capture_output=True,
+                                timeout=3, stdin=subprocess.DEVNULL)
+    except (OSError, subprocess.TimeoutExpired):
+        return True
+    # 1 means unset; anything else (e.g. a broken config) is not worth the risk
+    return result.returncode != 1
+
+def _unknown_long_options(command, path):
+    mode = FLAG_CHECKED_TOOLS.get(command.name)
+    if mode is None:
+        return []
+    args = command.args
+    subcommand = None
+    if mode:
+        if not args or args[0].startswith('-'):
+            return []
+        subcommand, args = args[0], args[1:]
+        if command.name == 'git' and _is_git_alias(path, subcommand):
+            return []
+    options = known_long_options(path, subcommand, '-h' if mode == 'sub-h' else '--help')
+    if len(options) < 3:
+        # Help output unavailable or too terse to judge (e.g. BSD tools)
+        return []
+    unknown = []
+    for arg in args:
+        if arg == '--':
+            break
+        if not arg.startswith('--') or len(arg) == 2:
+            continue
+        name = arg[2:].split('=', 1)[0]
+        if name in options or (name.startswith('no-') and name[3:] in options):
+            continue
+        if any(option.startswith(name) for option in options):
+            # getopt_long accepts unambiguous abbreviations
+            continue
+        close = difflib.get_close_matches(name, options, n=1)
+        unknown.append(f'--{name}' + (f' (did you mean --{close[0]}?)' if close else ''))
+    return unknown
+
+@traced('validate')
+def validate_fix(fix, local=True):
+    """Return a list of problems that mean fix cannot work as written (empty if none).
+
+    With local=False (a fix for another machine, patch serve) only the shell
+    syntax is checked: this machine's PATH and --help say nothing about it.
+    """
+    if not fix or not fix.strip():
+        return ['empty suggestion']
+    problems = []
+    syntax_error = check_fix_syntax(fix)
+    if syntax_error:
+        return [f'shell syntax error: {syntax_error}']
+    if not local:
+        return []
+    analysis = parse_command(fix)
+    installs_software = False
+    changed_dir = False
+    made_executable = False
+    seen_command = False
+    for pipeline in analysis.pipelines:
+        for command in pipeline.commands:
+            program = command.argv[0] if command.argv else ''
+            if not program:
+                continue
+            if command.name == 'cd':
+                changed_dir = True
+            elif command.name == 'chmod':
+                made_executable = True
+            if command.name in SHELL_BUILTINS or any(c in program for c in '$`*?'):
+                continue
+            if '/' in program:
+                if changed_dir and not program.startswith('/'):
+                    # Relative to a directory we cannot see from here
+                    continue
+                if os.path.isfile(program) and not os.access(program, os.X_OK) and not made_executable:
+                    problems.append(f"'{program}' is not executable (needs chmod +x)")
+                    continue
+                path = program if os.path.isfile(program) else None
+            else:
+                path = shutil.which(program)
+            if path is None:
+                if '/' in program:
+                    # Earlier steps (make, git clone, ...) may create it
+                    if not seen_command:
+                        problems.append(f"'{program}' does not exist")
+                elif not installs_software:
+                    problems.append(f"'{program}' is not installed or not on PATH")
+            else:
+                unknown = _unknown_long_options(command, path)
+                if unknown:
+                    problems.append(f"{command.name} does not accept {', '.join(unknown)}")
+            if tuple(a.lower() for a in command.argv[:2]) in INSTALL_STEPS:
+                installs_software = True
+        seen_command = True
+        if any(c.name in detector_tables().shells for c in pipeline.commands[1:]):
+            # curl ... | sh installers provide programs for later steps
+            installs_software = True
+    return problems
+
+def get_validated_fix(output, cmd, previous_error, previous_fix, options, tried=()):
+    """Ask for a fix, re-asking (without using an attempt) while local validation rejects it.
+
+    tried lists fixes that already failed in this run; they and the ones the
+    attempt history saw fail are neither asked for nor accepted.
+    """
+    if previous_fix is None:
+        known = remembered_fix(cmd, output)
+        if known:
+            count_metric('patch_cache_hits_total', cache='history')
+            print(f'[+] Known fix from your attempt history ({known[2]})')
+            return known
+    avoid = fixes_to_avoid(cmd, output, tried)
+    packed = packed_fix(cmd, output, avoid)
+    if packed:
+        count_metric('patch_cache_hits_total', cache='fixpack')
+        print(f'[+] Known fix for this error ({packed[3]})')
+        return packed
+    shared = shared_fix(cmd, output, avoid)
+    if shared and not validate_fix(shared[0]):
+        count_metric('patch_cache_hits_total', cache='team_cache')
+        print('[+] Fix from the team cache')
+        return shared
+    rejected = []
+    candidates = []
+    for _ in range(MAX_VALIDATION_REASKS + 1):
+        if options.get('sandbox'):
+            candidates = ask_openai_for_fixes(output, cmd, options['sandbox'], previous_error, previous_fix, rejected,
+                                              avoid)
+        else:
+            candidates = [ask_openai_for_fix(output, cmd, previous_error, previous_fix, rejected, avoid)]
+        valid = []
+        for candidate in candidates:
+            known_failure = avoid.get(normalize_fix(candidate[0]))
+            problems = [known_failure] if known_failure else validate_fix(candidate[0])
+            if problems:
+                print(f'[!] Rejected before running: {candidate[0]}')
+                for problem in problems:
+                    print(f'    - {problem}')
+                rejected.append((candidate[0], problems))
+            else:
+                valid.append(candidate)
+        if valid:
+            fix = choose_validated_fix(valid, options) if options.get('sandbox') else valid[0]
+            if fix[1] != '0':
+                share_fix(cmd, output, fix)
+            return fix
+        print('[*] Asking again with the validation errors (does not use an attempt)...')
+    print('[!] Suggestions kept failing local validation; showing the last one for manual review.')
+    return candidates[0] if candidates else ('', '50', '', '')
+
+# --- Attempt history ---
+#
+# Every suggestion is appended to PATCH_HOME/history/attempts.jsonl with the
+# command, a fingerprint of its error, whether it was applied and the exit
+# code it got. index.bin aggregates the log per (key, suggestion) into
+# fixed-size records sorted by key, a hash of the command and the error
+# fingerprint. A lookup is a binary search in the memory-mapped index plus a
+# scan of the few rows appended since it was last rebuilt, so it stays well
+# under a millisecond with millions of rows. Fixes that worked before are then served without
+# asking the model. PATCH_HISTORY=0 disables it.
+
+HISTORY_ENABLED = os.environ.get('PATCH_HISTORY', '1') != '0'
+# The index is rebuilt once this much log has been appended since
+HISTORY_TAIL_BYTES = 256 * 1024
+# A remembered fix is served at this (Laplace-smoothed) success rate: two
+# successes out of two, four out of five. Keys include the command:
+# "gti: command not found" from gti status and from gti log want different
+# fixes.
+HISTORY_MIN_SUCCESS_RATE = 0.7
+HISTORY_MAGIC = b'PHX1'
+HISTORY_HEADER = struct.Struct('<4sQQ')          # magic, log bytes covered, entries
+HISTORY_ENTRY = struct.Struct('<8s8sQIIId')     # key, fix hash, row offset, suggested, applied, succeeded, last success
+
+
+def _history_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
+def failure_fingerprint(output):
+    """error_fingerprint of a failure: its evidence lines, else its last non-blank lines."""
+    lines = output.split('\n')
+    labels = classify_error_labels(output)
+    if labels:
+        first, last = labels[0]['lines'][0]
+        chosen = lines[first - 1:min(last, first - 1 + LOG_FINGERPRINT_LINES)]
+    else:
+        chosen = [line for line in lines if line.strip()][-LOG_FINGERPRINT_LINES:]
+    return error_fingerprint(chosen)
+
+def normalize_fix(command):
+    return ' '.join(command.split())
+
+def history_key(command, fingerprint):
+    """Index key for a command (whitespace-normalised) failing with an error fingerprint."""
+    return _history_hash(normalize_fix(command) + '\0' + fingerprint)
+
+
+class AttemptHistory:
+    """Append-only attempt log with a sorted, memory-mapped index of outcomes per fix."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log_path = os.path.join(directory, 'attempts.jsonl')
+        self.index_path = os.path.join(directory, 'index.bin')
+        self._index = None     # (stat identity, mmap, covered, count)
+
+    def record(self, command, output, suggestion, applied, returncode, latency_ms):
+        """Append one suggestion and what happened to it."""
+        fingerprint = failure_fingerprint(output)
+        row = {'ts': round(time.time(), 3), 'command': command, 'fingerprint': fingerprint,
+               'suggestion': suggestion, 'applied': bool(applied), 'returncode': returncode,
+               'latency_ms': round(latency_ms, 1), 'key': history_key(command, fingerprint).hex()}
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # One write of a whole line: concurrent patch processes never interleave
+            os.write(fd, (json.dumps(row) + '\n').encode())
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size - self._load()[1] > HISTORY_TAIL_BYTES:
+            self.compact()
+
+    def _load(self):
+        """(mmap of index.bin or None, log bytes it covers, entry count), reopened when replaced.
+
+        A damaged index is deleted and treated as missing: lookups then read
+        the log itself, and the next record() rebuilds the index from it.
+        """
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            self._index = None
+            return None, 0, 0
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._index is None or self._index[0] != identity:
+            mm = None
+            try:
+                with open(self.index_path, 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, covered, count = HISTORY_HEADER.unpack_from(mm)
+                if magic != HISTORY_MAGIC or len(mm) != HISTORY_HEADER.size + count * HISTORY_ENTRY.size:
+                    raise ValueError('bad header or size')
+            except (struct.error, ValueError) as e:
+                # ValueError also covers mmap of an empty (truncated to nothing) file
+                print(f'[!] Rebuilding damaged history index {self.index_path}: {e}', file=sys.stderr)
+                if mm is not None:
+                    mm.close()
+                try:
+                    os.unlink(self.index_path)
+                except FileNotFoundError:
+                    pass
+                self._index = None
+                return None, 0, 0
+            self._index = (identity, mm, covered, count)
+        return self._index[1:]
+
+    @staticmethod
+    def _bisect(mm, count, target, lo=0):
+        """First entry whose (key, fix hash) is >= target."""
+        hi = count
+        size, base = HISTORY_ENTRY.size, HISTORY_HEADER.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * size
+            if mm[start:start + 16] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _tail_rows(self, start, needle=None):
+        """(offset, row) for complete rows after start, only those containing needle if given."""
+        try:
+            with open(self.log_path, 'rb') as f:
+                f.seek(start)
+                tail = f.read()
+        except FileNotFoundError:
+            return
+        end = tail.rfind(b'\n') + 1
+        if needle is None:
+            offset = 0
+            while offset < end:
+                newline = tail.index(b'\n', offset)
+                yield start + offset, json.loads(tail[offset:newline])
+                offset = newline + 1
+            return
+        found = tail.find(needle, 0, end)
+        while found != -1:
+            line_start = tail.rfind(b'\n', 0, found) + 1
+            line_end = tail.index(b'\n', found)
+            yield start + line_start, json.loads(tail[line_start:line_end])
+            found = tail.find(needle, line_end, end)
+
+    def _suggestion_at(self, offset):
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())['suggestion']
+
+    def lookup(self, key):
+        """{fix hash: [row offset, suggested, applied, succeeded, last success]} for one key."""
+        found = {}
+        mm, covered, count = self._load()
+        if mm is not None:
+            i = self._bisect(mm, count, key + bytes(8))
+            while i < count:
+                entry = HISTORY_ENTRY.unpack_from(mm, HISTORY_HEADER.size + i * HISTORY_ENTRY.size)
+                if entry[0] != key:
+                    break
+                found[entry[1]] = list(entry[2:])
+                i += 1
+        hex_key = key.hex()
+        for offset, row in self._tail_rows(covered, hex_key.encode()):
+            if row['key'] == hex_key:
+                _accumulate(found, offset, row)
+        return found
+
+    def ranked(self, command, output):
+        """Past suggestions for this command failing this way, best first."""
+        key = history_key(command, failure_fingerprint(output))
+        results = [{'offset': offset, 'suggested': suggested, 'applied': applied, 'succeeded': succeeded,
+                    'last_success': last_success, 'score': (succeeded + 1) / (applied + 2)}
+                   for offset, suggested, applied, succeeded, last_success in self.lookup(key).values()]
+        results.sort(key=lambda e: (e['score'], e['succeeded'], e['last_success']), reverse=True)
+        for entry in results:
+            entry['fix'] = self._suggestion_at(entry.pop('offset'))
+        return results
+
+    def known_fix(self, command, output):
+        """The best past fix if it has worked often enough to skip the model, else None."""
+        for entry in self.ranked(command, output):
+            if entry['succeeded'] and entry['score'] >= HISTORY_MIN_SUCCESS_RATE:
+                return entry
+        return None
+
+    def failed_fixes(self, command, output):
+        """Fixes that were run for this failure and never worked, most often tried first."""
+        failed = [e for e in self.ranked(command, output) if e['applied'] and not e['succeeded']]
+        failed.sort(key=lambda e: e['applied'], reverse=True)
+        return failed
+
+    def compact(self):
+        """Fold the rows appended since the last rebuild into index.bin (skipped if another process is at it)."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'index.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            mm, covered, count = self._load()
+            updates = {}
+            end = covered
+            for offset, row in self._tail_rows(covered):
+                _accumulate(updates.setdefault(bytes.fromhex(row['key']), {}), offset, row)
+                end = offset
+            if not updates:
+                return
+            with open(self.log_path, 'rb') as f:
+                f.seek(end)
+                end += len(f.readline())
+            # Merge: copy runs of untouched entries, rewrite or insert the changed ones
+            base, size = HISTORY_HEADER.size, HISTORY_ENTRY.size
+            parts, position, total = [], 0, count
+            for target in sorted(key + fix_hash for key, fixes in updates.items() for fix_hash in fixes):
+                i = self._bisect(mm, count, target, position) if mm is not None else 0
+                if i > position:
+                    parts.append(mm[base + position * size:base + i * size])
+                values = updates[target[:8]][target[8:]]
+                if i < count and mm[base + i * size:base + i * size + 16] == target:
+                    old = HISTORY_ENTRY.unpack_from(mm, base + i * size)
+                    values = [old[2], old[3] + values[1], old[4] + values[2], old[5] + values[3],
+                              max(old[6], values[4])]
+                    position = i + 1
+                else:
+                    position = i
+                    total += 1
+                parts.append(HISTORY_ENTRY.pack(target[:8], target[8:], *values))
+            if mm is not None and position < count:
+                parts.append(mm[base + position * size:base + count * size])
+            fd, tmp = tempfile.mkstemp(prefix='.index-', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(HISTORY_HEADER.pack(HISTORY_MAGIC, end, total))
+                    f.writelines(parts)
+                os.replace(tmp, self.index_path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+def _accumulate(found, offset, row):
+    """Add one log row to a {fix hash: [row offset, suggested, applied, succeeded, last success]} map."""
+    counts = found.setdefault(_history_hash(normalize_fix(row['suggestion'])), [offset, 0, 0, 0, 0.0])
+    counts[1] += 1
+    # Applied but never run (refused, interrupted) is only a suggestion
+    if row['applied'] and row['returncode'] is not None:
+        counts[2] += 1
+        if row['returncode'] == 0:
+            counts[3] += 1
+            counts[4] = max(counts[4], row['ts'])
+
+_attempt_histories = {}
+
+def attempt_history():
+    """The AttemptHistory under PATCH_HOME, or None when PATCH_HISTORY=0."""
+    if not HISTORY_ENABLED:
+        return None
+    directory = os.path.join(PATCH_HOME, 'history')
+    if directory not in _attempt_histories:
+        _attempt_histories[directory] = AttemptHistory(directory)
+    return _attempt_histories[directory]
+
+def record_attempt(command, output, suggestion, applied, returncode, latency_ms):
+    """Record a suggestion's outcome in the attempt history (and team cache); never fails the caller."""
+    if applied and returncode is not None:
+        count_metric('patch_attempts_total')
+        if returncode == 0:
+            count_metric('patch_successes_total')
+    if applied and returncode is not None and suggestion:
+        share_fix(command, output, suggestion, 'success' if returncode == 0 else 'failure')
+    history = attempt_history()
+    if history is None or not suggestion:
+        return
+    try:
+        history.record(command, output, suggestion, applied, returncode, latency_ms)
+    except (OSError, ValueError):
+        pass
+
+@traced('lookup.history')
+def remembered_fix(command, output):
+    """A (fix, confidence, reason, explanation) tuple from history, or None if nothing has proven itself."""
+    history = attempt_history()
+    if history is None:
+        return None
+    try:
+        entry = history.known_fix(command, output)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    return (entry['fix'], str(min(99, round(entry['score'] * 100))),
+            f"it fixed this error {entry['succeeded']} of {entry['applied']} times before",
+            'Served from your local attempt history without asking the model.')
+
+# --- Negative cache ---
+#
+# The retry prompt only names the last fix, so the model happily comes back
+# to one that failed two attempts (or two days) ago. Fixes that the attempt
+# history on this machine saw fail for this command and error, plus the
+# ones that failed earlier in this run, are sent as a "do not suggest" list
+# and rejected locally, like validation failures, if suggested anyway. A fix
+# that worked even once is not avoided.
+
+# At most this many are listed in the prompt; all of them are filtered
+NEGATIVE_CACHE_PROMPT_FIXES = 10
+
+def fixes_to_avoid(command, output, tried=(), local=True):
+    """{normalised fix: why not} for fixes known to fail here: from history, then tried this run.
+
+    The history is only consulted for a command run on this machine (local).
+    """
+    avoid = {}
+    history = attempt_history() if local else None
+    if history is not None:
+        try:
+            for entry in history.failed_fixes(command, output):
+                times = 'once' if entry['applied'] == 1 else f"{entry['applied']} times"
+                avoid[normalize_fix(entry['fix'])] = f'already failed here {times}'
+        except (OSError, ValueError):
+            pass
+    for fix in tried:
+        avoid.setdefault(normalize_fix(fix), 'already failed in this run')
+    return avoid
+
+# --- Fix packs ---
+#
+# Many failures have one stable answer that needs no model: a typo'd git
+# subcommand, a binary that is not installed, a Python module to pip install,
+# the Docker daemon being down. A fix pack is a versioned, prebuilt table of
+# them, installed into PATCH_HOME/fixpacks and consulted (after the attempt
+# history, before the model) for each of the last lines of the output.
+#
+# On disk a pack is a header, fixed-size index entries sorted by the hash of
+# a fingerprinted error line, then the fix records: fix, confidence, reason,
+# explanation and the program the fix needs on PATH, NUL-separated. Lookups
+# binary-search the memory-mapped file, so opening a pack does no parsing.
+# In a fix, {args} is replaced by the failed command's arguments and
+# {subargs} by the arguments after its subcommand. They are taken from the
+# parsed command, and only when it is a single command that the error line
+# names (its program for {args}, its subcommand for {subargs}); wrappers
+# such as sudo, env and VAR=value, and redirections, are kept around the
+# fix. Otherwise the entry is skipped. Answers are checked with validate_fix
+# like any other suggestion. PATCH_FIXPACKS=0 disables them.
+
+FIXPACK_DIR = os.path.join(PATCH_HOME, 'fixpacks')
+FIXPACK_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixpacks', 'common.jsonl')
+FIXPACK_MAGIC = b'PFP1'
+FIXPACK_HEADER = struct.Struct('<4s16sIII')    # magic, name, version, entries, records offset
+FIXPACK_ENTRY = struct.Struct('<8sII')         # error line key, record offset, record length
+# Only the end of the output is looked up: that is where the error is
+FIXPACK_SCAN_LINES = 20
+
+
+def fixpack_key(line):
+    """Index key of one error line, with the same noise masking as error_fingerprint."""
+    return _history_hash(error_fingerprint([line]))
+
+def build_fix_pack(source, path):
+    """Compile a JSONL fix pack source into the binary format; returns its (name, version, entries).
+
+    The first line is {"pack": name, "version": N}; each other line is
+    {"errors": [lines...], "fix": ..., "confidence": N, "reason": ...,
+    "explanation": ..., "requires": program or null}. When several fixes
+    share an error line the first one whose program is installed wins.
+    """
+    with open(source) as f:
+        rows = [(number, line) for number, line in enumerate(f, 1) if line.strip()]
+    try:
+        meta = json.loads(rows[0][1]) if rows else {}
+        name, version = meta['pack'], int(meta['version'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'{source}:1: expected {{"pack": name, "version": N}}') from e
+    if not name or len(name.encode()) > 16 or not re.fullmatch(r'[\w.-]+', name):
+        raise ValueError(f'{source}:1: pack name must be 1-16 letters, digits, dots or dashes')
+    entries, records = [], bytearray()
+    for number, line in rows[1:]:
+        try:
+            item = json.loads(line)
+            fields = [item['fix'], str(int(item['confidence'])), item.get('reason') or '',
+                      item.get('explanation') or '', item.get('requires') or '']
+            errors = item['errors']
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f'{source}:{number}: {e}') from e
+        if not errors or any('\0' in field for field in fields):
+            raise ValueError(f'{source}:{number}: needs at least one error line and no NUL characters')
+        record = '\0'.join(fields).encode()
+        for error in errors:
+            entries.append((fixpack_key(error), len(entries), len(records), len(record)))
+        records += record
+    # Stable on ties, so earlier source lines are tried first
+    entries.sort()
+    offset = FIXPACK_HEADER.size + len(entries) * FIXPACK_ENTRY.size
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.fixpack-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(FIXPACK_HEADER.pack(FIXPACK_MAGIC, name.encode(), version, len(entries), offset))
+            f.writelines(FIXPACK_ENTRY.pack(key, start, length) for key, _, start, length in entries)
+            f.write(records)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return name, version, len(entries)
+
+
+class FixPack:
+    """A memory-mapped binary fix pack."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < FIXPACK_HEADER.size:
+            raise ValueError(f'{path} is not a fix pack')
+        magic, name, self.version, self.count, self._records = FIXPACK_HEADER.unpack_from(self._mm)
+        if magic != FIXPACK_MAGIC or self._records != FIXPACK_HEADER.size + self.count * FIXPACK_ENTRY.size:
+            raise ValueError(f'{path} is not a fix pack')
+        self.name = name.rstrip(b'\0').decode()
+
+    def lookup(self, key):
+        """(fix, confidence, reason, explanation, requires) records for one error line key, in pack order."""
+        mm, base, size = self._mm, FIXPACK_HEADER.size, FIXPACK_ENTRY.size
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[base + mid * size:base + mid * size + 8] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count:
+            entry_key, start, length = FIXPACK_ENTRY.unpack_from(mm, base + lo * size)
+            if entry_key != key:
+                break
+            start += self._records
+            found.append(tuple(mm[start:start + length].decode().split('\0')))
+            lo += 1
+        return found
+
+
+@functools.lru_cache(maxsize=1)
+def fix_packs():
+    """Installed fix packs by name, or none with PATCH_FIXPACKS=0."""
+    if os.environ.get('PATCH_FIXPACKS') == '0' or not os.path.isdir(FIXPACK_DIR):
+        return ()
+    packs = []
+    for name in sorted(os.listdir(FIXPACK_DIR)):
+        if not name.endswith('.pfp'):
+            continue
+        try:
+            packs.append(FixPack(os.path.join(FIXPACK_DIR, name)))
+        except (OSError, ValueError) as e:
+            print(f'[!] Ignoring unreadable fix pack {name}: {e}', file=sys.stderr)
+    return tuple(packs)
+
+def _names_word(line, word):
+    return re.search(r'(?<![\w./-])' + re.escape(word) + r'(?![\w/-])', line) is not None
+
+def fix_pack_arguments(command, line):
+    """(wrapper text, {placeholder: value}, redirection text) for filling in a fix for command.
+
+    Placeholders are only given when command is one simple command named by
+    the error line, and every word can be requoted without changing it;
+    entries that need a missing one are skipped.
+    """
+    analysis = parse_command(command)
+    if len(analysis.commands) != 1:
+        return '', {}, ''
+    simple = analysis.commands[0]
+    words = simple.words + [w for _, _, w in simple.redirects] + [v for _, v in simple.assignments]
+    if not simple.argv or any(c in w for w in words for c in '$`'):
+        return '', {}, ''
+    quote = lambda words: ' '.join(shlex.quote(w) for w in words)
+    args = {}
+    if _names_word(line, simple.argv[0]):
+        args['{args}'] = quote(simple.argv[1:])
+    if len(simple.argv) > 1 and not simple.argv[1].startswith('-') and _names_word(line, simple.argv[1]):
+        args['{subargs}'] = quote(simple.argv[2:])
+    # env's own VAR=value words are already among the prefix words
+    leading = [f'{name}={shlex.quote(value)}' for name, value in simple.assignments
+               if f'{name}={value}' not in simple.prefix_words]
+    wrappers = ' '.join(leading + [shlex.quote(w) for w in simple.prefix_words])
+    redirects = ' '.join(f"{fd or ''}{op}{'' if op.endswith('&') else ' '}{shlex.quote(target)}"
+                         for fd, op, target in simple.redirects)
+    return wrappers, args, redirects
+
+@traced('lookup.fixpack')
+def packed_fix(command, output, avoid=(), local=True):
+    """A (fix, confidence, reason, explanation) tuple from an installed fix pack, or None.
+
+    With local=False the program an entry requires is not looked for here
+    and the fix is only syntax-checked (see validate_fix).
+    """
+    packs = fix_packs()
+    if not packs:
+        return None
+    lines = [line for line in output.split('\n') if line.strip()][-FIXPACK_SCAN_LINES:]
+    for line in reversed(lines):
+        key = fixpack_key(line)
+        arguments = None
+        for pack in packs:
+            for fix, confidence, reason, explanation, requires in pack.lookup(key):
+                if requires and local and not shutil.which(requires):
+                    continue
+                placeholders = [p for p in ('{args}', '{subargs}') if p in fix]
+                if placeholders:
+                    if arguments is None:
+                        arguments = fix_pack_arguments(command, line)
+                    wrappers, args, redirects = arguments
+                    if any(p not in args for p in placeholders):
+                        continue
+                    for placeholder in placeholders:
+                        fix = fix.replace(placeholder, args[placeholder])
+                    fix = ' '.join(part for part in (wrappers, fix.strip(), redirects) if part)
+                fix = fix.strip()
+                if (fix and normalize_fix(fix) not in avoid and normalize_fix(fix) != normalize_fix(command)
+                        and not validate_fix(fix, local)):
+                    return fix, confidence, reason, f'{explanation} (from the {pack.name} fix pack)'.lstrip()
+    return None
+
+def install_fix_pack(path):
+    """Validate (building it first if it is a JSONL source) and install a pack; returns the FixPack."""
+    os.makedirs(FIXPACK_DIR, exist_ok=True)
+    if path.endswith('.jsonl'):
+        fd, built = tempfile.mkstemp(prefix='.fixpack-', suffix='.pfp', dir=FIXPACK_DIR)
+        os.close(fd)
+        try:
+            build_fix_pack(path, built)
+            pack = FixPack(built)
+            os.replace(built, os.path.join(FIXPACK_DIR, f'{pack.name}.pfp'))
+        except BaseException:
+            if os.path.exists(built):
+                os.unlink(built)
+            raise
+    else:
+        pack = FixPack(path)
+        fd, copy = tempfile.mkstemp(prefix='.fixpack-', suffix='.pfp', dir=FIXPACK_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f, open(path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+            os.replace(copy, os.path.join(FIXPACK_DIR, f'{pack.name}.pfp'))
+        except BaseException:
+            os.unlink(copy)
+            raise
+    fix_packs.cache_clear()
+    return FixPack(os.path.join(FIXPACK_DIR, f'{pack.name}.pfp'))
+
+def pack_main(args):
+    """Entry point for patch pack: build, install or list fix packs."""
+    action, rest = (args[0], args[1:]) if args else ('list', [])
+    try:
+        if action == 'build' and len(rest) in (1, 2):
+            output = rest[1] if len(rest) == 2 else os.path.splitext(rest[0])[0] + '.pfp'
+            name, version, entries = build_fix_pack(rest[0], output)
+            print(f'[+] Built {name} v{version} ({entries} error lines) into {output}')
+        elif action == 'install' and len(rest) <= 1:
+            pack = install_fix_pack(rest[0] if rest else FIXPACK_SOURCE)
+            print(f'[+] Installed {pack.name} v{pack.version} ({pack.count} error lines) into {pack.path}')
+        elif action == 'list' and not rest:
+            packs = fix_packs()
+            if not packs:
+                print(f'[*] No fix packs installed in {FIXPACK_DIR} (install one with: patch pack install)')
+            for pack in packs:
+                print(f'    {pack.name:<16} v{pack.version:<5} {pack.count:>7} error lines   {pack.path}')
+        else:
+            print('[!] Usage: patch pack build SOURCE.jsonl [OUTPUT] | install [FILE] | list')
+            sys.exit(1)
+    except (OSError, ValueError) as e:
+        print(f'[!] {e}')
+        sys.exit(1)
+    sys.exit(0)
+
+# --- Batch mode ---
+#
+# patch --batch FILE (or - for stdin) diagnoses many failing commands with no
+# prompts at all. Each line is run in the background and, if it fails, sent
+# for a suggestion; at most --jobs commands are in flight. One JSON object per
+# command is streamed to stdout, in input order by default or as each finishes
+# with --order=completion. Suggestions are reported, never applied.
+
+BATCH_JOBS = 8
+BATCH_TIMEOUT = 300.0
+BATCH_OUTPUT_CHARS = 2000
+# Finished results held back for input order, as a multiple of --jobs
+BATCH_REORDER_WINDOW = 4
+
+def read_batch_commands(stream):
+    """Yield (index, command) for every non-blank, non-comment line."""
+    index = 0
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield index, line
+        index += 1
+
+@traced('execute')
+def run_unattended(cmd, options, tee=False):
+    """Run cmd in the background with no terminal or stdin; returns (returncode, output, capture).
+
+    The capture is already closed; its timed_out and usage are still set.
+    """
+    capture = run_streaming(cmd, tee=tee, foreground=False, stdin=subprocess.DEVNULL,
+                            timeout=options['timeout'] or BATCH_TIMEOUT,
+                            idle_timeout=options['idle_timeout'])
+    output = capture.failure_context()
+    capture.close()
+    return capture.returncode, output, capture
+
+def suggest_fix(client, output, cmd, previous_error=None, previous_fix=None, context=None, tried=(), local=True):
+    """Prompt-free get_validated_fix: returns (fix tuple, rejected list, source).
+
+    source says where the fix came from: 'history', 'fixpack', 'team_cache'
+    or 'model'.
+
+    A fix that has proven itself in the attempt history, is in a fix pack or
+    is in the team cache is returned without calling the model (client may
+    then be None); ones known to fail are rejected like invalid ones. If
+    every suggestion was rejected, the last one is also the last entry of
+    rejected. local=False (patch serve: cmd ran on another machine) leaves this
+    machine out entirely: no file system in the prompt, no attempt history,
+    and answers are only syntax-checked.
+    """
+    if previous_fix is None and local:
+        known = remembered_fix(cmd, output)
+        if known:
+            count_metric('patch_cache_hits_total', cache='history')
+            return known, [], 'history'
+    avoid = fixes_to_avoid(cmd, output, tried, local)
+    packed = packed_fix(cmd, output, avoid, local)
+    if packed:
+        count_metric('patch_cache_hits_total', cache='fixpack')
+        return packed, [], 'fixpack'
+    # Answers given with caller context are neither taken from nor shared with the team
+    shared = None if context else shared_fix(cmd, output, avoid)
+    if shared and not validate_fix(shared[0], local):
+        count_metric('patch_cache_hits_total', cache='team_cache')
+        return shared, [], 'team_cache'
+    rejected = []
+    fix = ('', '50', '', '')
+    for _ in range(MAX_VALIDATION_REASKS + 1):
+        user_msg = build_fix_prompt(output, cmd, previous_error, previous_fix, rejected, context, avoid, local)
+        fix = parse_fix_response(create_fix_completions(client, user_msg)[0])
+        if not fix[0]:
+            problems = ['empty suggestion']
+        elif normalize_fix(fix[0]) in avoid:
+            problems = [avoid[normalize_fix(fix[0])]]
+        else:
+            problems = validate_fix(fix[0], local)
+        if not problems:
+            if not context:
+                share_fix(cmd, output, fix)
+            break
+        rejected.append((fix[0], problems))
+    return fix, rejected, 'model'
+
+def diagnose_batch_command(client, index, cmd, options):
+    """Run one batch command and ask for a fix if it fails; returns a JSON-ready dict."""
+    result = {'index': index, 'command': cmd}
+    # Both of these need a person at the terminal in normal mode
+    if is_interactive_command(cmd):
+        return dict(result, status='skipped', reason='interactive command')
+    if is_pipe_to_shell(cmd):
+        return dict(result, status='skipped', reason='pipes a script into a shell')
+    try:
+        returncode, output, capture = run_unattended(cmd, options)
+    except Exception as e:
+        return dict(result, status='error', error=str(e))
+    result.update(status='ok' if returncode == 0 else 'failed', returncode=returncode,
+                  timed_out=capture.timed_out, usage=capture.usage)
+    record_telemetry('batch', command=cmd, returncode=returncode, **capture.usage)
+    if returncode == 0:
+        return result
+    result.update(output=output[-BATCH_OUTPUT_CHARS:], error_type=categorize_error_type(output, cmd),
+                  labels=capture.labels())
+    started = time.monotonic()
+    try:
+        (fix, confidence, reason, explanation), rejected, source = suggest_fix(client, output, cmd)
+    except Exception as e:
+        result['llm_error'] = f'{type(e).__name__}: {e}'
+        return result
+    result.update(fix=fix, confidence=int(confidence), reason=reason, explanation=explanation, source=source)
+    if rejected:
+        result['rejected'] = [{'fix': f, 'problems': p} for f, p in rejected]
+    if not rejected or rejected[-1][0] != fix:
+        # Batch mode only reports: the suggestion is remembered as not applied
+        record_attempt(cmd, output, fix, False, None, (time.monotonic() - started) * 1000)
+    return result
+
+def _diagnose_batch_safely(client, index, cmd, options):
+    try:
+        return diagnose_batch_command(client, index, cmd, options)
+    except Exception as e:
+        return {'index': index, 'command': cmd, 'status': 'error', 'error': str(e)}
+
+def run_batch(options, stream, out=None, client=None):
+    """Diagnose every command read from stream, writing one JSON line per command to out.
+
+    Returns a Counter of result statuses. Commands are read lazily and the
+    number of running plus held-back results is bounded, so arbitrarily long
+    inputs (e.g. a pipe) run in constant memory.
+    """
+    out = out or sys.stdout
+    client = client or OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+    jobs = options['jobs']
+    in_order = options['order'] == 'input'
+    window = jobs * BATCH_REORDER_WINDOW
+    summary = collections.Counter()
+    running = set()
+    held = {}
+    next_index = 0
+
+    def emit(result):
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+        summary[result['status']] += 1
+
+    def collect(done):
+        nonlocal next_index
+        for future in done:
+            running.discard(future)
+            result = future.result()
+            if in_order:
+                held[result['index']] = result
+            else:
+                emit(result)
+        while next_index in held:
+            emit(held.pop(next_index))
+            next_index += 1
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for index, cmd in read_batch_commands(stream):
+            while len(running) >= jobs or len(running) + len(held) >= window:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            running.add(executor.submit(_diagnose_batch_safely, client, index, cmd, options))
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return summary
+
+def batch_main(options):
+    """Entry point for --batch: no logo, no prompts, JSONL on stdout and progress on stderr."""
+    if not validate_api_key(os.environ.get('OPENAI_API_KEY')):
+        print('[!] Batch mode needs OPENAI_API_KEY set; it never prompts.', file=sys.stderr)
+        sys.exit(1)
+    path = options['batch']
+    try:
+        stream = sys.stdin if path == '-' else open(path)
+    except OSError as e:
+        print(f'[!] Cannot read batch file: {e}', file=sys.stderr)
+        sys.exit(1)
+    start = time.monotonic()
+    try:
+        summary = run_batch(options, stream)
+    except KeyboardInterrupt:
+        print('\n[!] Batch interrupted.', file=sys.stderr)
+        sys.exit(130)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    elapsed = time.monotonic() - start
+    total = sum(summary.values())
+    counts = ', '.join(f'{count} {status}' for status, count in sorted(summary.items()))
+    print(f'[+] Batch done: {total} command(s) in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f}/s)'
+          f'{": " + counts if counts else ""}', file=sys.stderr)
+    sys.exit(1 if summary['error'] else 0)
+
+# --- Shell integration ---
+#
+# eval "$(patch --shell-init bash)" (or zsh) installs hooks that tee each
+# command's stderr into a per-shell spool directory and, when the command
+# exits non-zero, record its exit code, working directory and command line.
+# `patch` with no arguments then diagnoses that failure straight away instead
+# of running the command a second time.
+#
+# Spool layout ($PATCH_SPOOL, one directory per shell pid):
+#   stderr        stderr of the command currently running
+#   last          "<status>\0<cwd>\0<command>" of the last failed command
+#   last.stderr   that command's stderr (renamed from stderr, read tail-only)
+
+SPOOL_DIR = os.path.join(PATCH_HOME, 'spool')
+SPOOL_TAIL_BYTES = 32 * 1024
+# Exit codes from Ctrl-C and Ctrl-Z are not failures worth diagnosing
+SPOOL_IGNORED_STATUSES = {130, 148}
+
+_BASH_HOOK = r"""
+# patch shell integration for bash; load with: eval "$(patch --shell-init bash)"
+if [[ -n "$BASH_VERSION" && $- == *i* && -z "$__patch_hooked" ]]; then
+__patch_hooked=1
+export PATCH_SPOOL="@SPOOL@/$$"
+mkdir -p "$PATCH_SPOOL" && chmod 700 "$PATCH_SPOOL"
+exec {__patch_stderr}>&2
+__patch_ready= __patch_ran= __patch_capturing= __patch_histcmd= __patch_out=
+__patch_tee() {
+    # The DEBUG trap runs after pipeline pipes exist; holding one open would hang the pipeline
+    local fd
+    for fd in /dev/fd/*; do
+        fd=${fd##*/}
+        (( fd > 2 && fd != __patch_stderr && fd != __patch_out )) && eval "exec $fd>&-" 2>/dev/null
+    done
+    exec tee -a "/dev/fd/$__patch_out" >&$__patch_stderr
+}
+__patch_preexec() {
+    [[ -n "$__patch_ready" ]] || return 0
+    case "$BASH_COMMAND" in __patch_*) return 0;; esac
+    __patch_ready=
+    local first=${BASH_COMMAND%% *}
+    [[ ${first##*/} == patch ]] && return 0
+    __patch_ran=1
+    case " @SKIP@ " in *" ${first##*/} "*) return 0;; esac
+    # Opened here, not by tee, so a fast failure can't be renamed away before tee starts
+    exec {__patch_out}>"$PATCH_SPOOL/stderr"
+    exec 2> >(__patch_tee)
+    exec {__patch_out}>&-
+    __patch_capturing=1
+}
+__patch_precmd() {
+    local status=$? captured=$__patch_capturing
+    if [[ -n "$captured" ]]; then
+        exec 2>&$__patch_stderr
+        __patch_capturing=
+    fi
+    # ( ... ) never reaches the DEBUG trap; notice it from the history number instead
+    [[ -n "$__patch_ran" || ( -n "$__patch_ready" && "$HISTCMD" != "$__patch_histcmd" ) ]] || return $status
+    __patch_ran=
+    case " @IGNORED@ 0 " in *" $status "*) return $status;; esac
+    if [[ -n "$captured" ]]; then
+        command mv -f "$PATCH_SPOOL/stderr" "$PATCH_SPOOL/last.stderr"
+    else
+        command rm -f "$PATCH_SPOOL/last.stderr"
+    fi
+    { printf '%s\0%s\0' "$status" "$PWD"; builtin fc -ln -1; } > "$PATCH_SPOOL/last.tmp" 2>/dev/null &&
+        command mv -f "$PATCH_SPOOL/last.tmp" "$PATCH_SPOOL/last"
+    return $status
+}
+__patch_arm() { __patch_ready=1; __patch_histcmd=$HISTCMD; }
+trap '__patch_preexec' DEBUG
+PROMPT_COMMAND="__patch_precmd${PROMPT_COMMAND:+; $PROMPT_COMMAND}; __patch_arm"
+fi
+"""
+
+_ZSH_HOOK = r"""
+# patch shell integration for zsh; load with: eval "$(patch --shell-init zsh)"
+if [[ -o interactive && -z "$__patch_hooked" ]]; then
+typeset -g __patch_hooked=1 __patch_ran= __patch_capturing= __patch_cmd= __patch_stderr __patch_out
+typeset -ga __patch_skip=(@SKIP@)
+export PATCH_SPOOL="@SPOOL@/$$"
+mkdir -p "$PATCH_SPOOL" && chmod 700 "$PATCH_SPOOL"
+exec {__patch_stderr}>&2
+__patch_preexec() {
+    local first=${${(z)1}[1]}
+    [[ ${first:t} == patch ]] && return 0
+    __patch_ran=1
+    __patch_cmd=$1
+    (( ${__patch_skip[(Ie)${first:t}]} )) && return 0
+    exec {__patch_out}>|"$PATCH_SPOOL/stderr"
+    exec 2> >(exec tee -a "/dev/fd/$__patch_out" >&$__patch_stderr)
+    exec {__patch_out}>&-
+    __patch_capturing=1
+}
+__patch_precmd() {
+    local exit_status=$? captured=$__patch_capturing
+    if [[ -n "$captured" ]]; then
+        exec 2>&$__patch_stderr
+        __patch_capturing=
+    fi
+    [[ -n "$__patch_ran" ]] || return 0
+    __patch_ran=
+    [[ " @IGNORED@ 0 " == *" $exit_status "* ]] && return 0
+    if [[ -n "$captured" ]]; then
+        command mv -f "$PATCH_SPOOL/stderr" "$PATCH_SPOOL/last.stderr"
+    else
+        command rm -f "$PATCH_SPOOL/last.stderr"
+    fi
+    print -rn -- "$exit_status"$'\0'"$PWD"$'\0'"$__patch_cmd" >| "$PATCH_SPOOL/last.tmp" &&
+        command mv -f "$PATCH_SPOOL/last.tmp" "$PATCH_SPOOL/last"
+}
+autoload -Uz add-zsh-hook
+add-zsh-hook preexec __patch_preexec
+add-zsh-hook precmd __patch_precmd
+fi
+"""
+
+SHELL_HOOKS = {'bash': _BASH_HOOK, 'zsh': _ZSH_HOOK}
+
+def shell_init_script(shell):
+    """Return the hook script for shell, or None if it is not supported."""
+    script = SHELL_HOOKS.get(shell)
+    if script is None:
+        return None
+    # Full-screen and prompting programs keep a real terminal on stderr;
+    # configured names are pasted into shell code, so only plain ones count
+    skip = ' '.join(sorted(name for name in detector_tables().interactive if re.fullmatch(r'[\w.+-]+', name)))
+    ignored = ' '.join(str(status) for status in sorted(SPOOL_IGNORED_STATUSES))
+    # The spool path is substituted inside double quotes
+    spool = re.sub(r'([\\"$`])', r'\\\1', SPOOL_DIR)
+    return script.replace('@SPOOL@', spool).replace('@SKIP@', skip).replace('@IGNORED@', ignored).lstrip('\n')
+
+def prune_spools():
+    """Remove spool directories left behind by shells that have exited."""
+    try:
+        entries = os.listdir(SPOOL_DIR)
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            os.kill(int(entry), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(SPOOL_DIR, entry), ignore_errors=True)
+        except OSError:
+            pass
+
+def _read_tail(path, limit):
+    """Return the last limit bytes of path as text, starting on a line boundary."""
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - limit))
+        data = f.read()
+    if size > limit:
+        data = data.split(b'\n', 1)[-1]
+    return data.decode('utf-8', errors='replace')
+
+def read_spooled_failure(spool=None):
+    """Load the last failed command recorded by the shell hooks, or None.
+
+    Returns a dict with command, returncode, cwd, output (stderr tail) and
+    age in seconds.
+    """
+    spool = spool or os.environ.get('PATCH_SPOOL')
+    if not spool:
+        return None
+    record_path = os.path.join(spool, 'last')
+    try:
+        with open(record_path, 'rb') as f:
+            status, cwd, command = f.read().split(b'\0', 2)
+        age = time.time() - os.stat(record_path).st_mtime
+        returncode = int(status)
+    except (OSError, ValueError):
+        return None
+    command = command.decode('utf-8', errors='replace').strip()
+    if not command:
+        return None
+    try:
+        output = _read_tail(os.path.join(spool, 'last.stderr'), SPOOL_TAIL_BYTES)
+    except OSError:
+        output = ''
+    return {'command': command, 'returncode': returncode, 'age': age,
+            'cwd': cwd.decode('utf-8', errors='replace'), 'output': output}
+
+def clear_spooled_failure(spool=None):
+    """Forget the recorded failure once it has been fixed."""
+    spool = spool or os.environ.get('PATCH_SPOOL')
+    for name in ('last', 'last.stderr'):
+        try:
+            os.remove(os.path.join(spool, name))
+        except (OSError, TypeError):
+            pass
+
+# --- Unattended mode (--yes / --json) ---
+#
+# For scripts and CI: nothing reads the terminal. Commands run in the
+# background with stdin closed, and a policy decides what may run and which
+# suggestions are applied. --yes applies fixes at or above --min-confidence,
+# except ones from the team cache; without it suggestions are only reported. --json prints exactly one result
+# document on stdout and nothing else. The exit code tells the outcome apart.
+
+UNATTENDED_EXIT_CODES = {
+    'ok': 0,          # the command succeeded as given
+    'fixed': 10,      # an applied fix succeeded
+    'suggested': 11,  # a fix was found but policy kept it from being applied
+    'unfixed': 12,    # attempts ran out, or no usable suggestion
+    'refused': 13,    # policy forbids running the command at all
+    'error': 14,      # patch itself failed (API, missing key, ...)
+}
+AUTO_APPLY_CONFIDENCE = 85
+UNATTENDED_ERROR_CHARS = 4000
+
+def uses_sudo(cmd):
+    """True if any command in cmd is run through sudo or doas."""
+    return any(name in ('sudo', 'doas') for command in parse_command(cmd).commands
+               for name in command.prefixes + [command.name])
+
+def policy_refusal(cmd, options):
+    """Why the unattended policy forbids running cmd, or None if it may run."""
+    if is_interactive_command(cmd):
+        return 'interactive command'
+    if is_pipe_to_shell(cmd) and not options['allow_pipe_to_shell']:
+        return 'pipes a script into a shell (allow with --allow-pipe-to-shell)'
+    if uses_sudo(cmd) and not options['allow_sudo']:
+        return 'uses sudo (allow with --allow-sudo)'
+    return None
+
+def run_unattended_fix(options, cmd, initial=None, client=None):
+    """Fix loop with no prompts, driven by options' policy; returns the result document.
+
+    initial is an already known (returncode, output) for cmd, as in run_fix_loop.
+    """
+    say = (lambda message: None) if options['json'] else print
+    doc = {'command': cmd, 'status': None, 'exit_code': None, 'final_command': cmd,
+           'returncode': None, 'reason': None, 'suggestion': None, 'attempts': []}
+
+    # The last suggestion, recorded in the attempt history once its outcome is known
+    pending = {}
+    # Applied fixes, none of which worked (or the loop would have ended)
+    tried = []
+
+    def finish(status, reason=None):
+        if pending:
+            record_attempt(returncode=None, **pending)
+        doc.update(status=status, exit_code=UNATTENDED_EXIT_CODES[status], reason=reason)
+        return doc
+
+    previous_error = None
+    previous_fix = None
+    source = 'original'
+    for attempt in range(1, options['max_attempts'] + 1):
+        doc['final_command'] = cmd
+        if initial:
+            returncode, output = initial
+            initial = None
+            capture = None
+            record = {'attempt': attempt, 'source': source, 'command': cmd, 'returncode': returncode}
+        else:
+            refusal = policy_refusal(cmd, options)
+            if refusal:
+                return finish('refused' if source == 'original' else 'suggested', refusal)
+            say(f'\n$ {cmd}')
+            returncode, output, capture = run_unattended(cmd, options, tee=not options['json'])
+            record = dict(attempt=attempt, source=source, command=cmd, returncode=returncode,
+                          timed_out=capture.timed_out, **capture.usage)
+            record_telemetry('attempt', **record)
+            if pending:
+                record_attempt(returncode=returncode, **pending)
+                pending.clear()
+        doc['attempts'].append(record)
+        doc['returncode'] = returncode
+        if returncode == 0:
+            say('[+] Success!')
+            return finish('ok' if source == 'original' else 'fixed')
+        doc['error'] = output[-UNATTENDED_ERROR_CHARS:]
+        doc['error_type'] = categorize_error_type(output, cmd)
+        doc['labels'] = capture.labels() if capture else classify_error_labels(output)
+        say(f'[-] Error (attempt {attempt}/{options["max_attempts"]}): exit code {returncode}')
+        if attempt >= options['max_attempts']:
+            return finish('unfixed', 'max attempts reached')
+        has_key = client is not None or os.environ.get('OPENAI_API_KEY')
+        avoid = fixes_to_avoid(cmd, output, tried)
+        if not has_key and not ((previous_fix is None and remembered_fix(cmd, output))
+                                or packed_fix(cmd, output, avoid) or shared_fix(cmd, output, avoid)):
+            return finish('error', 'OPENAI_API_KEY is not set')
+        started = time.monotonic()
+        try:
+            if has_key:
+                client = client or OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+            (fix, confidence, reason, explanation), rejected, source = suggest_fix(
+                client, output, cmd, previous_error, previous_fix, tried=tried)
+        except Exception as e:
+            return finish('error', ' '.join(describe_api_error(e)))
+        doc['suggestion'] = {'command': fix, 'confidence': int(confidence), 'reason': reason,
+                             'explanation': explanation, 'source': source}
+        if rejected:
+            doc['suggestion']['rejected'] = [{'command': f, 'problems': p} for f, p in rejected]
+        if not fix or (rejected and rejected[-1][0] == fix):
+            return finish('unfixed', 'no suggestion passed local validation')
+        pending.update(command=cmd, output=output, suggestion=fix, applied=False,
+                       latency_ms=(time.monotonic() - started) * 1000)
+        say(f'[*] Suggested fix: {fix} ({confidence}%)')
+        if not options['yes']:
+            return finish('suggested', 'auto-apply is off (use --yes)')
+        if options['sandbox']:
+            trial = validate_candidates([fix], options.get('sandbox_timeout', SANDBOX_TIMEOUT))[0]
+            doc['suggestion']['sandbox'] = trial['status']
+            if trial['status'] != 'passed':
+                return finish('suggested', f"not auto-applied: sandbox validation {trial['status']}")
+        if source == 'team_cache':
+            # Anyone who can reach the cache can vouch for an entry: never run one unattended
+            return finish('suggested', 'not auto-applied: fixes from the team cache are never applied unattended')
+        if int(confidence) < options['min_confidence']:
+            return finish('suggested', f'confidence {confidence}% is below --min-confidence {options["min_confidence"]}%')
+        say('[*] Applying fix...')
+        pending['applied'] = True
+        tried.append(fix)
+        previous_error = output
+        previous_fix = fix
+        cmd = fix
+        source = 'fix'
+    return finish('unfixed', 'max attempts reached')
+
+def unattended_main(options, cmd, initial=None, spooled=False):
+    """Entry point for --yes/--json: run the policy-driven loop and exit with its outcome code."""
+    try:
+        doc = run_unattended_fix(options, cmd, initial)
+    except KeyboardInterrupt:
+        doc = {'command': cmd, 'status': 'error', 'exit_code': UNATTENDED_EXIT_CODES['error'],
+               'reason': 'interrupted'}
+    if spooled and doc['status'] == 'fixed':
+        clear_spooled_failure()
+    if options['json']:
+        print(json.dumps(doc, indent=2))
+    else:
+        print(f"\n[*] Result: {doc['status']}" + (f" ({doc['reason']})" if doc.get('reason') else ''))
+    sys.exit(doc['exit_code'])
+
+# --- Log diagnosis (--from-stdin) ---
+#
+# `make 2>&1 | patch --from-stdin [command]` diagnoses a log without running
+# anything. LogScanner reads it once, in large chunks, with constant memory:
+# chunks that contain no error line are only counted, and only lines near
+# ERROR_TYPE_RULES (plus generic error markers) matches are kept. The first
+# region (usually the root cause) and the last few (where it finally died)
+# are sent to the model.
+
+LOG_CHUNK_BYTES = 1024 * 1024
+LOG_LINE_MAX_BYTES = 2000
+LOG_CONTEXT_BEFORE = 5
+LOG_CONTEXT_AFTER = 10
+LOG_REGION_MAX_LINES = 60
+LOG_MAX_REGIONS = 4
+LOG_TAIL_LINES = 40
+LOG_PROMPT_CHARS = 12000
+# Error lines per region that identify it (see error_fingerprint)
+LOG_FINGERPRINT_LINES = 3
+# Generic failure markers that categorize_error_type has no rule for:
+# (text, must start a word, must end a word)
+LOG_ERROR_MARKERS = [
+    ('error', True, True), ('fatal', True, True), ('failed', True, True), ('failure', True, True),
+    ('exception', True, True), ('panic:', True, False), ('traceback (most recent call last)', False, False),
+    ('npm err!', False, False), ('*** [', False, False),
+] + [(f'exit {word} {digit}', False, False) for word in ('code', 'status') for digit in '123456789']
+# Words that every rule sequence and marker above contains. Each search
+# runs over the whole block, so a sequence is only looked for when its
+# trigger word occurs at all; most blocks contain none of these.
+LOG_TRIGGER_WORDS = [
+    '[patch]', 'daemon', 'connect', 'no such file', 'denied', 'unauthorized', 'hostname', 'servname',
+    'unreachable', 'module', 'package', 'config', 'file not found', 'option', 'unrecognized',
+    'command not found', 'usage:', 'is not a', 'error', 'fatal', 'fail', 'exception', 'panic:',
+    'traceback', 'npm err', '*** [', 'exit ',
+]
+_WORD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789_')
+_ANSI_ESCAPE_BYTES_RE = re.compile(_ANSI_ESCAPE_RE.pattern.encode())
+
+def _marker_lines(text, marker, word_start, word_end):
+    """Yield the start offset of each line of text containing marker (on word boundaries if asked)."""
+    pos = text.find(marker)
+    while pos != -1:
+        end = pos + len(marker)
+        if ((word_start and pos and text[pos - 1] in _WORD_CHARS)
+                or (word_end and end < len(text) and text[end] in _WORD_CHARS)):
+            pos = text.find(marker, pos + 1)
+            continue
+        yield text.rfind('\n', 0, pos) + 1
+        line_end = text.find('\n', end)
+        if line_end == -1:
+            return
+        pos = text.find(marker, line_end)
+
+def _build_log_matchers():
+    """(trigger word, rule literals, marker) for every rule sequence and marker; the word is None if none fits."""
+    matchers = [(literals, None) for sequences, _ in _ERROR_TYPE_TABLE for literals in sequences]
+    matchers += [(None, marker) for marker in LOG_ERROR_MARKERS]
+    return [(next((w for w in LOG_TRIGGER_WORDS if any(w in text for text in literals or marker[:1])), None),
+             literals, marker) for literals, marker in matchers]
+
+_LOG_MATCHERS = _build_log_matchers()
+
+def _error_line_indexes(block):
+    """Indexes of the lines in block that match an error rule or marker (block is lowercased).
+
+    Uses the same literal-sequence matching as categorize_error_type rather
+    than the rule regexes: every check is a str.find bounded by the line,
+    so time stays linear even in a megabyte-long minified line, where a
+    backtracking .* alternation goes cubic.
+    """
+    # latin-1 maps bytes to characters one to one, so offsets and newlines are unchanged
+    text = block.decode('latin-1')
+    starts = set()
+    absent = set()
+    present = {}
+    for word, literals, marker in _LOG_MATCHERS:
+        if word is not None:
+            if word not in present:
+                present[word] = word in text
+            if not present[word]:
+                continue
+        starts.update(_matching_lines(text, literals, absent) if literals else _marker_lines(text, *marker))
+    matched = set()
+    index = previous = 0
+    for start in sorted(starts):
+        index += text.count('\n', previous, start)
+        previous = start
+        matched.add(index)
+    return matched
+
+class LogScanner:
+    """Single-pass error region finder; feed() raw chunks, then finish().
+
+    on_region, if given, is called with each region as soon as it closes.
+    """
+
+    def __init__(self, on_region=None):
+        self.on_region = on_region
+        self.lines = 0
+        self.bytes = 0
+        self.error_lines = 0
+        self.region_count = 0
+        self.first_region = None
+        self.last_regions = collections.deque(maxlen=LOG_MAX_REGIONS - 1)
+        self.tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        self._before = collections.deque(maxlen=LOG_CONTEXT_BEFORE)
+        self._region = None
+        self._after = 0
+        self._carry = b''
+
+    def feed(self, data):
+        self.bytes += len(data)
+        data = self._carry + data
+        cut = data.rfind(b'\n') + 1
+        if not cut:
+            if len(data) < LOG_CHUNK_BYTES:
+                self._carry = data
+                return
+            # A single enormous line: cut it rather than buffer it
+            cut = len(data)
+        self._carry = data[cut:]
+        self._scan(data[:cut])
+
+    def finish(self):
+        if self._carry:
+            self._scan(self._carry)
+            self._carry = b''
+        if self._region is not None:
+            self._close_region()
+        return self
+
+    def flush(self):
+        """Close the open region now instead of waiting for more context lines."""
+        if self._region is not None:
+            self._close_region()
+
+    @property
+    def pending(self):
+        return self._region is not None
+
+    @property
+    def regions(self):
+        return ([self.first_region] if self.first_region else []) + list(self.last_regions)
+
+    def _scan(self, block):
+        if b'\x1b' in block:
+            block = _ANSI_ESCAPE_BYTES_RE.sub(b'', block)
+        lines = block.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        matched = _error_line_indexes(block.lower())
+        if self._region is None and not matched:
+            # Fast path: nothing to keep except the last few lines
+            self.lines += len(lines)
+            recent = [line[:LOG_LINE_MAX_BYTES] for line in lines[-LOG_TAIL_LINES:]]
+            self.tail.extend(recent)
+            self._before.extend(recent)
+            return
+        for index, line in enumerate(lines):
+            self._scan_line(line[:LOG_LINE_MAX_BYTES], index in matched)
+
+    def _scan_line(self, line, is_error):
+        self.lines += 1
+        self.tail.append(line)
+        if is_error:
+            self.error_lines += 1
+            if self._region is None:
+                self._region = {'start': self.lines - len(self._before), 'end': self.lines,
+                                'lines': list(self._before), 'omitted': 0, 'errors': []}
+            if len(self._region['errors']) < LOG_FINGERPRINT_LINES:
+                self._region['errors'].append(line.decode('utf-8', errors='replace'))
+            self._add_to_region(line)
+            self._after = LOG_CONTEXT_AFTER
+        elif self._region is not None:
+            self._add_to_region(line)
+            self._after -= 1
+            if not self._after:
+                self._close_region()
+        else:
+            self._before.append(line)
+
+    def _add_to_region(self, line):
+        region = self._region
+        region['end'] = self.lines
+        if len(region['lines']) < LOG_REGION_MAX_LINES:
+            region['lines'].append(line)
+        else:
+            region['omitted'] += 1
+
+    def _close_region(self):
+        region = self._region
+        self._region = None
+        self._before.clear()
+        region['text'] = b'\n'.join(region.pop('lines')).decode('utf-8', errors='replace')
+        region['category'] = categorize_error_type(region['text'], '')
+        self.region_count += 1
+        if self.first_region is None:
+            self.first_region = region
+        else:
+            self.last_regions.append(region)
+        if self.on_region:
+            self.on_region(region)
+
+def scan_log(stream, chunk_size=LOG_CHUNK_BYTES):
+    """Scan a binary stream to the end; returns the finished LogScanner."""
+    scanner = LogScanner()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        scanner.feed(chunk)
+    return scanner.finish()
+
+def log_excerpt(scanner):
+    """Text sent to the model: the kept error regions, within LOG_PROMPT_CHARS."""
+    regions = scanner.regions
+    if not regions:
+        return ''
+    budget = LOG_PROMPT_CHARS // len(regions)
+    parts = [f'Log of {scanner.lines} lines; {scanner.error_lines} error lines in {scanner.region_count} region(s), '
+             f'showing {len(regions)}.']
+    for region in regions:
+        text = region['text']
+        if len(text) > budget:
+            text = text[:budget // 3] + '\n[...]\n' + text[-(budget - budget // 3):]
+        parts.append(f"--- log lines {region['start']}-{region['end']} ---\n{text}")
+        if region['omitted']:
+            parts.append(f"[... {region['omitted']} more lines in this region omitted ...]")
+    return '\n'.join(parts)
+
+def build_log_prompt(excerpt, cmd=None):
+    """User message for a log diagnosis; with the producing command if it is known."""
+    if cmd:
+        return build_fix_prompt(excerpt, cmd)
+    error_type = categorize_error_type(excerpt, '')
+    parts = [
+        "--- ERROR ---\n",
+        "Command that failed: unknown (error regions of a log read from stdin; suggest the command that fixes it)\n",
+        f"Platform: {get_platform_info()}\n",
+        f"Error: {excerpt}\n",
+    ]
+    if not error_type.startswith('other'):
+        parts.append(f"Error type: {error_type}\n")
+    return "".join(parts)
+
+def request_log_fix(options, user_msg):
+    """Ask for a fix for a log excerpt, with the spinner unless --json. Raises FixRequestError."""
+    if not options['json']:
+        return parse_fix_response(request_fix_completions(user_msg)[0])
+    try:
+        client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+        return parse_fix_response(create_fix_completions(client, user_msg)[0])
+    except Exception as e:
+        raise FixRequestError(describe_api_error(e)) from e
+
+def log_main(options, cmd=None, stream=None):
+    """Entry point for --from-stdin: scan, ask once, report. Never executes anything."""
+    stream = stream or sys.stdin.buffer
+    say = (lambda message: None) if options['json'] else print
+    doc = {'command': cmd, 'status': None, 'exit_code': None, 'reason': None, 'suggestion': None}
+
+    def finish(status, reason=None):
+        doc.update(status=status, exit_code=UNATTENDED_EXIT_CODES[status], reason=reason)
+        if options['json']:
+            print(json.dumps(doc, indent=2))
+        elif reason:
+            print(f'[!] {reason}')
+        sys.exit(doc['exit_code'])
+
+    if stream.isatty():
+        finish('error', 'Nothing piped in. Usage: make 2>&1 | patch --from-stdin [command]')
+    start = time.monotonic()
+    try:
+        scanner = scan_log(stream)
+    except KeyboardInterrupt:
+        finish('error', 'interrupted')
+    doc.update(lines=scanner.lines, bytes=scanner.bytes, error_lines=scanner.error_lines,
+               region_count=scanner.region_count,
+               regions=[{k: r[k] for k in ('start', 'end', 'category')} for r in scanner.regions])
+    say(f'[*] Scanned {scanner.lines} lines ({scanner.bytes / 1e6:.1f} MB) in {time.monotonic() - start:.1f}s: '
+        f'{scanner.error_lines} error lines in {scanner.region_count} region(s)')
+    if not scanner.regions:
+        say('[+] No error lines found; nothing to diagnose.')
+        finish('ok')
+    for region in scanner.regions:
+        say(f"    lines {region['start']}-{region['end']}: {region['category']}")
+    user_msg = build_log_prompt(log_excerpt(scanner), cmd)
+    try:
+        fix, confidence, reason, explanation = request_log_fix(options, user_msg)
+    except FixRequestError as e:
+        finish('error', ' '.join(e.lines))
+    doc['suggestion'] = {'command': fix, 'confidence': int(confidence), 'reason': reason,
+                         'explanation': explanation}
+    if not fix:
+        finish('unfixed', 'no suggestion')
+    say(f'\n[*] Suggested fix: {fix}')
+    say(f'[*] Confidence: {confidence}%')
+    if reason:
+        say(f'[*] Why: {reason}')
+    if explanation:
+        say(f'[*] Explanation: {explanation}')
+    say('[*] Nothing was executed; run the fix yourself if it looks right.')
+    finish('suggested')
+
+# --- Follow mode (--follow) ---
+#
+# patch --follow PATH... tails log files like tail -F and diagnoses errors as
+# they appear. Parent directories are watched with inotify (or polled with
+# os.stat where it is unavailable), so a quiet log costs no CPU: the loop
+# sleeps in select() until the kernel reports a change. Rotation by rename
+# or delete-and-recreate is followed by inode, copytruncate by size. Each
+# error region gets a fingerprint with numbers and ids masked out; only new
+# fingerprints are sent to the model (at most FOLLOW_DIAGNOSES_PER_MINUTE),
+# and repeats are counted and reported at most once per FOLLOW_REPEAT_SECONDS.
+
+FOLLOW_POLL_SECONDS = 1.0
+# Close an error region this long after its last line if no more context comes
+FOLLOW_IDLE_FLUSH_SECONDS = 1.0
+FOLLOW_REPEAT_SECONDS = 60.0
+FOLLOW_DIAGNOSES_PER_MINUTE = 6
+FOLLOW_MAX_FINGERPRINTS = 10000
+
+IN_MODIFY = 0x002
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+FOLLOW_WATCH_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+class Inotify:
+    """Minimal ctypes binding to Linux inotify; raises OSError where it is unavailable."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read_events(self):
+        """Return the pending (wd, mask, name) events without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+                offset += length
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+class FollowedFile:
+    """One tailed path, fed into a LogScanner; survives rotation and truncation."""
+
+    def __init__(self, path, on_region, from_start=False):
+        self.path = path
+        self._on_region = on_region
+        self.scanner = LogScanner(on_region)
+        self.handle = None
+        self.inode = None
+        self.last_data = 0.0
+        self._open(at_end=not from_start)
+
+    def _open(self, at_end=False):
+        try:
+            handle = open(self.path, 'rb')
+        except OSError:
+            return False
+        if self.handle:
+            self.handle.close()
+        self.handle = handle
+        self.inode = os.fstat(handle.fileno()).st_ino
+        if at_end:
+            handle.seek(0, os.SEEK_END)
+        return True
+
+    def poll(self):
+        """Feed whatever was appended since the last call; returns the byte count."""
+        read = self._drain()
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Rotated away and not recreated yet; keep the old handle
+            return read
+        if self.handle is None or st.st_ino != self.inode:
+            # The old file was drained above; the new one is read from the top
+            if self._open():
+                self._restart()
+                read += self._drain()
+        elif st.st_size < self.handle.tell():
+            # Truncated in place (copytruncate)
+            self.handle.seek(0)
+            self._restart()
+            read += self._drain()
+        if read:
+            self.last_data = time.monotonic()
+        return read
+
+    def _restart(self):
+        """Finish the old contents so line numbers restart with the new file."""
+        self.scanner.finish()
+        self.scanner = LogScanner(self._on_region)
+
+    def _drain(self):
+        if self.handle is None:
+            return 0
+        total = 0
+        while True:
+            chunk = self.handle.read(LOG_CHUNK_BYTES)
+            if not chunk:
+                return total
+            total += len(chunk)
+            self.scanner.feed(chunk)
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+
+_FINGERPRINT_NOISE_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|0x[0-9a-f]+|'
+                                   r'\b[0-9a-f]*\d[0-9a-f]*\b|\d+')
+
+def error_fingerprint(lines):
+    """Stable id for an error: its error lines with numbers, hex ids and timestamps masked."""
+    text = '\n'.join(_FINGERPRINT_NOISE_RE.sub('#', line.lower()).strip() for line in lines)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+class ErrorTracker:
+    """Deduplicates error fingerprints and rate-limits diagnoses and repeat reports."""
+
+    def __init__(self, clock=time.monotonic):
+        self.seen = collections.OrderedDict()
+        self._clock = clock
+        self._tokens = float(FOLLOW_DIAGNOSES_PER_MINUTE)
+        self._refilled = clock()
+
+    def observe(self, fingerprint):
+        """Count one occurrence; returns (action, state).
+
+        action is 'diagnose' (not diagnosed yet and within the rate limit),
+        'limited' (new, but over the rate limit), 'repeat' (time to report
+        state['unreported'] repeats) or None (suppressed).
+        """
+        now = self._clock()
+        state = self.seen.get(fingerprint)
+        new = state is None
+        if new:
+            state = {'count': 0, 'unreported': 0, 'reported': now, 'diagnosed': False}
+            self.seen[fingerprint] = state
+            if len(self.seen) > FOLLOW_MAX_FINGERPRINTS:
+                self.seen.popitem(last=False)
+        else:
+            self.seen.move_to_end(fingerprint)
+        state['count'] += 1
+        if not state['diagnosed']:
+            if self._take_token(now):
+                state.update(diagnosed=True, reported=now, unreported=0)
+                return 'diagnose', state
+            if new:
+                return 'limited', state
+        state['unreported'] += 1
+        if now - state['reported'] >= FOLLOW_REPEAT_SECONDS:
+            state['reported'] = now
+            return 'repeat', state
+        return None, state
+
+    def _take_token(self, now):
+        rate = FOLLOW_DIAGNOSES_PER_MINUTE / 60.0
+        self._tokens = min(FOLLOW_DIAGNOSES_PER_MINUTE, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+def _watch_dirs(path):
+    """Directories whose events can affect path (its own, and its symlink target's)."""
+    dirs = {os.path.dirname(os.path.abspath(path))}
+    dirs.add(os.path.dirname(os.path.realpath(path)))
+    return dirs
+
+def follow_main(options, paths):
+    """Entry point for --follow: tail paths until Ctrl-C, diagnosing each new error once."""
+    json_mode = options['json']
+
+    def emit(event, message=None):
+        if json_mode:
+            print(json.dumps(event), flush=True)
+        elif message:
+            print(message, flush=True)
+
+    if not paths:
+        print('[!] Usage: patch --follow LOGFILE [LOGFILE ...]')
+        sys.exit(1)
+    regions = []
+    followed = [FollowedFile(path, functools.partial(lambda p, r: regions.append((p, r)), path))
+                for path in paths]
+    tracker = ErrorTracker()
+    inotify = None
+    watched = {}
+    try:
+        inotify = Inotify()
+        for dir_path in set().union(*(_watch_dirs(path) for path in paths)):
+            watched[inotify.add_watch(dir_path, FOLLOW_WATCH_MASK)] = dir_path
+    except OSError as e:
+        if inotify:
+            inotify.close()
+            inotify = None
+        if not json_mode:
+            print(f'[!] inotify unavailable ({e}); polling every {FOLLOW_POLL_SECONDS:g}s instead.')
+    emit({'event': 'start', 'paths': paths, 'inotify': inotify is not None},
+         f"[*] Following {len(paths)} file(s){' with inotify' if inotify else ''}. Press Ctrl-C to stop.")
+    stats = collections.Counter()
+
+    def handle(path, region):
+        fingerprint = error_fingerprint(region['errors'])
+        action, state = tracker.observe(fingerprint)
+        stats['errors'] += 1
+        event = {'event': 'error', 'path': path, 'fingerprint': fingerprint, 'category': region['category'],
+                 'lines': [region['start'], region['end']], 'first_error': region['errors'][0] if region['errors'] else ''}
+        if action == 'repeat':
+            emit(dict(event, event='repeat', repeats=state['unreported'], total=state['count']),
+                 f"[*] Seen again {state['unreported']}x in {path} ({fingerprint}, {state['count']} total): {event['first_error']}")
+            state['unreported'] = 0
+            return
+        if action is None:
+            return
+        if not json_mode:
+            print(f"\n[-] New error in {path} lines {region['start']}-{region['end']} ({fingerprint}, {region['category']}):")
+            print(f"    {event['first_error']}")
+        if action == 'limited':
+            count_metric('patch_rate_limit_events_total', source='follow')
+            emit(dict(event, diagnosed=False), '[!] Diagnosis rate limit reached; it will be diagnosed if it recurs.')
+            return
+        stats['diagnosed'] += 1
+        excerpt = f"Log file: {path}\n--- log lines {region['start']}-{region['end']} ---\n{region['text']}"
+        try:
+            fix, confidence, reason, explanation = request_log_fix(options, build_log_prompt(excerpt))
+        except FixRequestError as e:
+            emit(dict(event, diagnosed=False, error=' '.join(e.lines)),
+                 '\n'.join(f'[!] {line}' for line in e.lines))
+            return
+        emit(dict(event, diagnosed=True, suggestion={'command': fix, 'confidence': int(confidence),
+                                                     'reason': reason, 'explanation': explanation}),
+             f'[*] Suggested fix: {fix}\n[*] Confidence: {confidence}%' + (f'\n[*] Explanation: {explanation}' if explanation else ''))
+
+    try:
+        while True:
+            pending = [f for f in followed if f.scanner.pending]
+            timeout = FOLLOW_IDLE_FLUSH_SECONDS if pending else None
+            if inotify is None:
+                timeout = min(timeout or FOLLOW_POLL_SECONDS, FOLLOW_POLL_SECONDS)
+                time.sleep(timeout)
+                touched = followed
+            elif select.select([inotify], [], [], timeout)[0]:
+                events = inotify.read_events()
+                names = {name for _, mask, name in events}
+                overflow = any(mask & IN_Q_OVERFLOW for _, mask, _ in events)
+                touched = [f for f in followed if overflow or
+                           os.path.basename(f.path) in names or os.path.basename(os.path.realpath(f.path)) in names]
+            else:
+                touched = []
+            for f in touched:
+                f.poll()
+            now = time.monotonic()
+            for f in followed:
+                if f.scanner.pending and now - f.last_data >= FOLLOW_IDLE_FLUSH_SECONDS:
+                    f.scanner.flush()
+            while regions:
+                handle(*regions.pop(0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for f in followed:
+            f.close()
+        if inotify:
+            inotify.close()
+    emit({'event': 'stop', 'errors': stats['errors'], 'distinct': len(tracker.seen), 'diagnosed': stats['diagnosed']},
+         f"\n[*] Stopped: {stats['errors']} error(s), {len(tracker.seen)} distinct, {stats['diagnosed']} diagnosed.")
+    sys.exit(0)
+
+# --- Fix service (patch serve) ---
+#
+# patch serve exposes the diagnosis over HTTP/JSON for bots and web terminals,
+# without the CLI's logo, prompts and sys.exit per call. It only suggests
+# fixes and never runs commands, and it listens on localhost by default.
+# The commands it is asked about ran on the caller's machine, so nothing about
+# the server's own machine is used: prompts leave out its file system, its
+# attempt history is not consulted, and answers are only syntax-checked
+# (not against its PATH or its tools' --help). Callers can describe their
+# machine in "context".
+#
+#   POST /fix     {"command": "...", "error": "...", "context": "..." | {...}, "timeout": 30}
+#                 -> 200 {"fix", "confidence", "reason", "explanation", "error_type", "cached", ...}
+#   GET  /health  -> 200 {"status": "ok", "workers", "in_flight", "cache_size", counters...}
+#
+# Model calls run on SERVE_JOBS workers that share one OpenAI client and so
+# one keep-alive connection pool. At most jobs + queue requests are admitted;
+# beyond that the answer is 503 with Retry-After, which keeps a flood from
+# queueing unbounded work. Identical requests in flight share one model call,
+# and answers are cached for SERVE_CACHE_TTL. A request that outlives its
+# timeout gets 504, but the model call keeps running and its answer is cached,
+# so a retry is usually instant.
+
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8765
+SERVE_JOBS = 8
+SERVE_QUEUE = 32
+SERVE_TIMEOUT = 60.0
+SERVE_MAX_BODY = 1 << 20
+SERVE_ERROR_CHARS = 8000
+SERVE_CONTEXT_CHARS = 4000
+SERVE_CACHE_SIZE = 1024
+SERVE_CACHE_TTL = 600.0
+
+def parse_fix_request(body):
+    """Validate a POST /fix body; returns (request, None) or (None, problem)."""
+    if not isinstance(body, dict):
+        return None, 'body must be a JSON object'
+    command = body.get('command')
+    if not isinstance(command, str) or not command.strip():
+        return None, 'command must be a non-empty string'
+    error = body.get('error', '')
+    if not isinstance(error, str):
+        return None, 'error must be a string'
+    context = body.get('context') or ''
+    if isinstance(context, dict):
+        context = '\n'.join(f'{key}: {value}' for key, value in context.items())
+    if not isinstance(context, str):
+        return None, 'context must be a string or an object'
+    timeout = body.get('timeout', SERVE_TIMEOUT)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout <= SERVE_TIMEOUT:
+        return None, f'timeout must be a number of seconds up to {SERVE_TIMEOUT:g}'
+    return {'command': command.strip(), 'error': error[-SERVE_ERROR_CHARS:],
+            'context': context[:SERVE_CONTEXT_CHARS], 'timeout': float(timeout)}, None
+
+class FixService:
+    """Worker pool, admission control and answer cache behind patch serve."""
+
+    def __init__(self, client, jobs=SERVE_JOBS, queue=SERVE_QUEUE):
+        self.client = client
+        self.jobs = jobs
+        self.pool = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix='patch-serve')
+        self.slots = threading.BoundedSemaphore(jobs + queue)
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()   # key -> (expires, result)
+        self.in_flight = {}                      # key -> future
+        self.stats = collections.Counter()
+
+    def submit(self, request):
+        """Return (future, cached) for a parsed request, or (None, False) when saturated."""
+        key = hashlib.sha1(json.dumps([request['command'], request['error'], request['context']]).encode()).hexdigest()
+        with self.lock:
+            self.stats['requests'] += 1
+            hit = self.cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                future = concurrent.futures.Future()
+                future.set_result(hit[1])
+                return future, True
+            future = self.in_flight.get(key)
+            if future:
+                self.stats['coalesced'] += 1
+                return future, False
+            if not self.slots.acquire(blocking=False):
+                self.stats['rejected'] += 1
+                return None, False
+            future = self.pool.submit(self._diagnose, key, request)
+            self.in_flight[key] = future
+        future.add_done_callback(functools.partial(self._done, key))
+        return future, False
+
+    def _diagnose(self, key, request):
+        cmd, error = request['command'], request['error']
+        # The command ran on the client's machine, not here
+        (fix, confidence, reason, explanation), rejected, source = suggest_fix(
+            self.client, error, cmd, context=request['context'], local=False)
+        result = {'fix': fix, 'confidence': int(confidence), 'reason': reason, 'explanation': explanation,
+                  'source': source, 'error_type': categorize_error_type(error, cmd)}
+        if rejected:
+            result['rejected'] = [{'fix': f, 'problems': p} for f, p in rejected]
+        # Cached before the future resolves, so a client retrying right away hits it
+        with self.lock:
+            self.cache[key] = (time.monotonic() + SERVE_CACHE_TTL, result)
+            self.cache.move_to_end(key)
+            if len(self.cache) > SERVE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return result
+
+    def _done(self, key, future):
+        self.slots.release()
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if future.exception() is not None:
+                self.stats['failed'] += 1
+
+    def health(self):
+        with self.lock:
+            return dict(self.stats, status='ok', workers=self.jobs, in_flight=len(self.in_flight),
+                        cache_size=len(self.cache))
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    """JSON replies and request bodies over keep-alive HTTP/1.1; one thread per connection."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, keep-alive
+    # clients wait for a delayed ACK (~40ms) on every response
+    disable_nagle_algorithm = True
+
+    def reply(self, status, doc, headers=()):
+        body = json.dumps(doc).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        """(True, parsed request body), or (False, None) after replying with the problem."""
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 < length <= SERVE_MAX_BODY:
+            # The body is left unread, so this connection cannot be reused
+            self.close_connection = True
+            self.reply(413 if length > SERVE_MAX_BODY else 400,
+                       {'error': f'a JSON body of at most {SERVE_MAX_BODY} bytes is required'})
+            return False, None
+        try:
+            return True, json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.reply(400, {'error': f'invalid JSON: {e}'})
+            return False, None
+
+    def log_message(self, *args):
+        # One stderr line per request would dominate the cost of a cache hit
+        pass
+
+class FixRequestHandler(JSONRequestHandler):
+    """HTTP front end for FixService."""
+
+    server_version = 'patch-serve'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, self.server.service.health())
+        else:
+            self.reply(404, {'error': f'no such endpoint: GET {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/fix':
+            self.close_connection = True
+            return self.reply(404, {'error': f'no such endpoint: POST {self.path}'})
+        ok, body = self.read_json()
+        if not ok:
+            return
+        request, problem = parse_fix_request(body)
+        if problem:
+            return self.reply(400, {'error': problem})
+        start = time.monotonic()
+        future, cached = self.server.service.submit(request)
+        if future is None:
+            return self.reply(503, {'error': 'too many requests in progress, retry shortly'},
+                              headers=[('Retry-After', '1')])
+        try:
+            result = future.result(timeout=request['timeout'])
+        except concurrent.futures.TimeoutError:
+            return self.reply(504, {'error': f"no answer within {request['timeout']:g}s; retry to pick up the cached result"})
+        except Exception as e:
+            return self.reply(502, {'error': ' '.join(describe_api_error(e))})
+        self.reply(200, dict(result, command=request['command'], cached=cached,
+                             elapsed_ms=round((time.monotonic() - start) * 1000, 1)))
+
+class FixHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 drops connections under bursts
+    request_queue_size = 128
+
+def make_fix_server(service, host=SERVE_HOST, port=SERVE_PORT):
+    """Bind a FixHTTPServer for service; call serve_forever() on the result."""
+    server = FixHTTPServer((host, port), FixRequestHandler)
+    server.service = service
+    return server
+
+def parse_serve_options(args):
+    """Options for patch serve: --host, --port, --jobs and --queue."""
+    options = {'host': SERVE_HOST, 'port': SERVE_PORT, 'jobs': SERVE_JOBS, 'queue': SERVE_QUEUE}
+    args = list(args)
+    while args:
+        name, has_value, value = args.pop(0).partition('=')
+        if name not in ('--host', '--port', '--jobs', '--queue'):
+            print(f'[!] Unknown option for patch serve: {name}')
+            sys.exit(1)
+        if not has_value:
+            value = args.pop(0) if args else ''
+        if name == '--host':
+            options['host'] = value
+        elif not value.isdigit() or (name == '--jobs' and int(value) < 1) or (name == '--port' and int(value) > 65535):
+            print(f'[!] {name} expects a whole number, got: {value!r}')
+            sys.exit(1)
+        else:
+            options[name[2:]] = int(value)
+    return options
+
+def serve_main(args):
+    """Entry point for patch serve: answer fix requests until Ctrl-C."""
+    options = parse_serve_options(args)
+    if not os.environ.get('OPENAI_API_KEY'):
+        print('[!] patch serve needs OPENAI_API_KEY in the environment')
+        sys.exit(1)
+    client = OpenAI(api_key=os.environ['OPENAI_API_KEY'], timeout=SERVE_TIMEOUT)
+    service = FixService(client, options['jobs'], options['queue'])
+    try:
+        server = make_fix_server(service, options['host'], options['port'])
+    except OSError as e:
+        print(f"[!] Cannot listen on {options['host']}:{options['port']}: {e}")
+        sys.exit(1)
+    print(f"[*] Serving fixes on http://{options['host']}:{server.server_port} "
+          f"({options['jobs']} workers, queue {options['queue']}). Press Ctrl-C to stop.", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    stats = service.health()
+    print(f"\n[*] Stopped after {stats.get('requests', 0)} request(s), {stats.get('cache_hits', 0)} cache hit(s), "
+          f"{stats.get('rejected', 0)} rejected.")
+    sys.exit(0)
+
+# --- Team fix cache (PATCH_TEAM_CACHE, patch cache serve) ---
+#
+# Every engineer's patch pays for the same model answers. With
+# PATCH_TEAM_CACHE=http://host:8766 answers are shared: a lookup goes to the
+# team cache after the local history and fix packs and before the model
+# (read-through), and each model answer and each applied fix's outcome is
+# sent back (write-back). A fix is only served once someone's run of it has
+# succeeded, and not if it failed more often than it worked: an answer
+# nobody has tried stays on the machine that asked for it. Anyone who can
+# reach the cache can report a success, so its answers are only ever shown:
+# --yes never applies one.
+#
+#   POST /cache/get   {"keys": [...]}             -> 200 {"hits": {key: {"fix", "confidence", ...}}}
+#   POST /cache/put   {"entries": [{"key", "fix", "confidence", "reason",
+#                                   "explanation", "outcome": null | "success" | "failure"}]}
+#                                                 -> 200 {"stored": N}
+#   GET  /health                                  -> 200 {"status": "ok", "keys", counters...}
+#
+# Keys hash the platform, the command and its error fingerprint, so nothing
+# else about the machine leaves it. Lookups that arrive while one is in
+# flight go out together in the next request, and writes are sent in the
+# background in batches. Every request has a short timeout; after any
+# failure, including a server that answers with garbage, the cache is
+# skipped for a while and patch works local-only. patch cache
+# serve is a small reference server that keeps the cache in memory and,
+# with --store, in an append-only JSONL file.
+
+TEAM_CACHE_TIMEOUT = 0.5
+TEAM_CACHE_BACKOFF = 60.0
+TEAM_CACHE_BATCH = 64
+TEAM_CACHE_PORT = 8766
+# Keys kept by the reference server, least recently used dropped first
+TEAM_CACHE_KEYS = 100_000
+
+
+def team_cache_key(command, output):
+    return _history_hash(get_platform_info() + '\0' + history_key(command, failure_fingerprint(output)).hex()).hex()
+
+class HTTPFixCacheBackend:
+    """Team cache backend speaking the /cache/get and /cache/put protocol."""
+
+    def __init__(self, url, timeout=TEAM_CACHE_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, path, doc):
+        request = urllib.request.Request(self.url + path, json.dumps(doc).encode(),
+                                         {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def get_many(self, keys):
+        hits = self._post('/cache/get', {'keys': keys}).get('hits')
+        if not isinstance(hits, dict):
+            raise ValueError('malformed /cache/get reply')
+        return hits
+
+    def put_many(self, entries):
+        self._post('/cache/put', {'entries': entries})
+
+# URL scheme -> backend class taking the URL; get_many(keys) and put_many(entries)
+TEAM_CACHE_BACKENDS = {'http': HTTPFixCacheBackend, 'https': HTTPFixCacheBackend}
+
+class TeamFixCache:
+    """Batching, fail-soft client in front of a team cache backend."""
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.lock = threading.Lock()
+        self.reads = {}              # key -> future, for the next lookup request
+        self.reading = False
+        self.writes = []
+        self.writer = None
+        self.down_until = None
+
+    def available(self):
+        return self.down_until is None or time.monotonic() >= self.down_until
+
+    def _failed(self, e):
+        with self.lock:
+            first = self.down_until is None
+            self.down_until = time.monotonic() + TEAM_CACHE_BACKOFF
+        if first:
+            print(f'[!] Team fix cache {self.name} unavailable ({e}); working local-only for now', file=sys.stderr)
+
+    def get(self, key):
+        """The cached answer for key, or None on a miss or any problem."""
+        if not self.available():
+            return None
+        with self.lock:
+            future = self.reads.setdefault(key, concurrent.futures.Future())
+            # One caller at a time sends requests, each with every key queued while the last was out
+            leader, self.reading = not self.reading, True
+        if leader:
+            self._send_reads()
+        try:
+            return future.result(timeout=TEAM_CACHE_TIMEOUT * 2)
+        except concurrent.futures.TimeoutError:
+            return None
+
+    def _send_reads(self):
+        """Send the queued lookups until none are left, resolving every future whatever happens."""
+        finished = False
+        try:
+            while True:
+                with self.lock:
+                    batch = {k: self.reads.pop(k) for k in list(self.reads)[:TEAM_CACHE_BATCH]}
+                    if not batch:
+                        self.reading = False
+                        finished = True
+                        return
+                hits = {}
+                try:
+                    hits = self.backend.get_many(list(batch))
+                except Exception as e:
+                    # http.client.HTTPException and anything else a broken server causes: a miss
+                    self._failed(e)
+                finally:
+                    for batch_key, waiting in batch.items():
+                        waiting.set_result(hits.get(batch_key))
+        finally:
+            if not finished:
+                with self.lock:
+                    self.reading = False
+                    waiting = list(self.reads.values())
+                    self.reads.clear()
+                for future in waiting:
+                    future.set_result(None)
+
+    def put(self, entry):
+        """Queue an entry for the background writer."""
+        if not self.available():
+            return
+        with self.lock:
+            self.writes.append(entry)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write, name='patch-team-cache', daemon=True)
+                self.writer.start()
+
+    def _write(self):
+        finished = False
+        try:
+            while True:
+                with self.lock:
+                    batch, self.writes = self.writes[:TEAM_CACHE_BATCH], self.writes[TEAM_CACHE_BATCH:]
+                    if not batch:
+                        self.writer = None
+                        finished = True
+                        return
+                try:
+                    self.backend.put_many(batch)
+                except Exception as e:
+                    self._failed(e)
+                    with self.lock:
+                        self.writes.clear()
+        finally:
+            if not finished:
+                with self.lock:
+                    self.writer = None
+
+    def flush(self, timeout=TEAM_CACHE_TIMEOUT * 2):
+        """Wait (briefly) for queued writes to go out."""
+        writer = self.writer
+        if writer is not None:
+            writer.join(timeout)
+
+@functools.lru_cache(maxsize=1)
+def team_cache():
+    """The TeamFixCache for PATCH_TEAM_CACHE, or None when it is not set."""
+    url = os.environ.get('PATCH_TEAM_CACHE')
+    if not url:
+        return None
+    backend = TEAM_CACHE_BACKENDS.get(url.partition('://')[0].lower())
+    if backend is None:
+        print(f'[!] Ignoring PATCH_TEAM_CACHE={url}: supported schemes are {", ".join(TEAM_CACHE_BACKENDS)}',
+              file=sys.stderr)
+        return None
+    cache = TeamFixCache(backend(url), url)
+    atexit.register(cache.flush)
+    return cache
+
+@traced('lookup.team_cache')
+def shared_fix(command, output, avoid=()):
+    """A (fix, confidence, reason, explanation) tuple from the team cache, or None."""
+    cache = team_cache()
+    if cache is None:
+        return None
+    hit = cache.get(team_cache_key(command, output))
+    if not isinstance(hit, dict) or not isinstance(hit.get('fix'), str) or not hit['fix'].strip():
+        return None
+    if normalize_fix(hit['fix']) in avoid:
+        return None
+    try:
+        confidence = str(int(hit.get('confidence', 50)))
+    except (TypeError, ValueError):
+        confidence = '50'
+    explanation = str(hit.get('explanation') or '')
+    return (hit['fix'], confidence, str(hit.get('reason') or ''),
+            f'{explanation} (from the team fix cache)'.lstrip())
+
+def share_fix(command, output, fix, outcome=None):
+    """Send a model answer (a fix tuple) or an outcome for a fix string to the team cache."""
+    cache = team_cache()
+    if cache is None:
+        return
+    if outcome is None:
+        entry = dict(zip(('fix', 'confidence', 'reason', 'explanation'), fix))
+        entry['confidence'] = int(entry['confidence'])
+    else:
+        entry = {'fix': fix}
+    entry.update(key=team_cache_key(command, output), outcome=outcome)
+    cache.put(entry)
+
+
+class TeamCacheStore:
+    """The reference server's cache: outcome counts per fix per key, LRU-bounded, optionally persisted."""
+
+    def __init__(self, path=None, size=TEAM_CACHE_KEYS):
+        self.size = size
+        self.lock = threading.Lock()
+        self.keys = collections.OrderedDict()   # key -> {normalised fix: record}
+        self.stats = collections.Counter()
+        self.log = None
+        if path:
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            self._apply(json.loads(line))
+                        except (ValueError, TypeError, KeyError, AttributeError):
+                            continue
+            self.log = open(path, 'a')
+
+    def _apply(self, entry):
+        fixes = self.keys.setdefault(entry['key'], {})
+        self.keys.move_to_end(entry['key'])
+        record = fixes.get(normalize_fix(entry['fix']))
+        if entry.get('outcome') is None:
+            if record is None:
+                record = fixes[normalize_fix(entry['fix'])] = {'suggested': 0, 'succeeded': 0, 'failed': 0}
+            record.update(fix=entry['fix'], confidence=int(entry.get('confidence', 50)),
+                          reason=str(entry.get('reason') or ''), explanation=str(entry.get('explanation') or ''))
+            record['suggested'] += 1
+        elif record is not None:
+            # Outcomes of fixes nobody suggested through the cache are not kept
+            record['succeeded' if entry['outcome'] == 'success' else 'failed'] += 1
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+    def get_many(self, keys):
+        hits = {}
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['lookups'] += len(keys)
+            for key in keys:
+                fixes = self.keys.get(key)
+                # Unverified answers (no recorded success) are not pushed to the whole team
+                usable = [r for r in (fixes or {}).values() if r['succeeded'] and r['failed'] <= r['succeeded']]
+                if usable:
+                    hits[key] = max(usable, key=lambda r: (r['succeeded'] - r['failed'], r['suggested']))
+                    self.keys.move_to_end(key)
+            self.stats['hits'] += len(hits)
+        return hits
+
+    def put_many(self, entries):
+        with self.lock:
+            for entry in entries:
+                self._apply(entry)
+            self.stats['stored'] += len(entries)
+            if self.log:
+                self.log.writelines(json.dumps(entry) + '\n' for entry in entries)
+                self.log.flush()
+        return len(entries)
+
+    def health(self):
+        with self.lock:
+            return dict(self.stats, status='ok', keys=len(self.keys))
+
+    def close(self):
+        if self.log:
+            self.log.close()
+
+def parse_cache_entries(body):
+    """Validate a POST /cache/put body; returns (entries, None) or (None, problem)."""
+    entries = body.get('entries') if isinstance(body, dict) else None
+    if not isinstance(entries, list) or len(entries) > TEAM_CACHE_BATCH:
+        return None, f'entries must be a list of at most {TEAM_CACHE_BATCH} objects'
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('key'), str) \
+                or not isinstance(entry.get('fix'), str) or not entry['fix'].strip():
+            return None, 'each entry needs a string key and a non-empty string fix'
+        if entry.get('outcome') not in (None, 'success', 'failure'):
+            return None, 'outcome must be null, "success" or "failure"'
+        confidence = entry.get('confidence', 50)
+        if isinstance(confidence, bool) or not isinstance(confidence, int) or not 0 <= confidence <= 100:
+            return None, 'confidence must be a whole number from 0 to 100'
+    return entries, None
+
+class TeamCacheRequestHandler(JSONRequestHandler):
+    """HTTP front end for a TeamCacheStore."""
+
+    server_version = 'patch-cache'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, self.server.store.health())
+        else:
+            self.reply(404, {'error': f'no such endpoint: GET {self.path}'})
+
+    def do_POST(self):
+        if self.path not in ('/cache/get', '/cache/put'):
+            self.close_connection = True
+            return self.reply(404, {'error': f'no such endpoint: POST {self.path}'})
+        ok, body = self.read_json()
+        if not ok:
+            return
+        if self.path == '/cache/put':
+            entries, problem = parse_cache_entries(body)
+            if problem:
+                return self.reply(400, {'error': problem})
+            return self.reply(200, {'stored': self.server.store.put_many(entries)})
+        keys = body.get('keys') if isinstance(body, dict) else None
+        if not isinstance(keys, list) or len(keys) > TEAM_CACHE_BATCH or not all(isinstance(k, str) for k in keys):
+            return self.reply(400, {'error': f'keys must be a list of at most {TEAM_CACHE_BATCH} strings'})
+        self.reply(200, {'hits': self.server.store.get_many(keys)})
+
+def make_cache_server(store, host=SERVE_HOST, port=TEAM_CACHE_PORT):
+    """Bind a team cache server for store; call serve_forever() on the result."""
+    server = FixHTTPServer((host, port), TeamCacheRequestHandler)
+    server.store = store
+    return server
+
+def cache_main(args):
+    """Entry point for patch cache serve: run the reference team cache until Ctrl-C."""
+    if not args or args[0] != 'serve':
+        print('[!] Usage: patch cache serve [--host HOST] [--port PORT] [--store FILE]')
+        sys.exit(1)
+    options = {'host': SERVE_HOST, 'port': TEAM_CACHE_PORT, 'store': None}
+    args = list(args[1:])
+    while args:
+        name, has_value, value = args.pop(0).partition('=')
+        if name not in ('--host', '--port', '--store'):
+            print(f'[!] Unknown option for patch cache serve: {name}')
+            sys.exit(1)
+        if not has_value:
+            value = args.pop(0) if args else ''
+        if name == '--port' and (not value.isdigit() or int(value) > 65535):
+            print(f'[!] --port expects a whole number, got: {value!r}')
+            sys.exit(1)
+        options[name[2:]] = int(value) if name == '--port' else value
+    try:
+        store = TeamCacheStore(options['store'])
+        server = make_cache_server(store, options['host'], options['port'])
+    except OSError as e:
+        print(f'[!] Cannot start the team cache: {e}')
+        sys.exit(1)
+    print(f"[*] Team fix cache on http://{options['host']}:{server.server_port}"
+          f"{' storing to ' + options['store'] if options['store'] else ' (in memory)'}. "
+          f"Use PATCH_TEAM_CACHE=http://{options['host']}:{server.server_port}. Press Ctrl-C to stop.", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+    stats = store.health()
+    print(f"\n[*] Stopped with {stats['keys']} key(s) after {stats.get('lookups', 0)} lookup(s), "
+          f"{stats.get('hits', 0)} hit(s).")
+    sys.exit(0)
+
+def interactive_menu():
+    options = ['Apply suggested fix', 'Retry (get alternative suggestion)', 'Enter custom command', 'Explain the error', 'Exit']
+    
+    while True:
+        print('\nWhat do you want to do?')
+        for i, option in enumerate(options):
+            print(f'  [{i+1}] {option}')
+        
+        try:
+            choice = user_input('[?] Select option (1-5): ').strip()
+            if choice.isdigit() and 1 <= int(choice) <= 5:
+                return int(choice) - 1
+            print('[!] Invalid selection. Please try again.')
+        except (KeyboardInterrupt, EOFError):
+            print('\n[!] Exiting.')
+            sys.exit(0)
+
+def show_logo():
+    logo = r"""
+██████╗  █████╗ ████████╗ ██████╗██╗  ██╗
+██╔══██╗██╔══██╗╚══██╔══╝██╔════╝██║  ██║
+██████╔╝███████║   ██║   ██║     ███████║
+██╔═══╝ ██╔══██║   ██║   ██║     ██╔══██║
+██║     ██║  ██║   ██║   ╚██████╗██║  ██║
+╚═╝     ╚═╝  ╚═╝   ╚═╝    ╚═════╝╚═╝  ╚═╝
+
+
+> your broken command has been patched
+"""
+    print(logo)
+
+def print_help():
+    print("""
+Patch CLI - Fix Broken Shell Commands using AI
+
+USAGE:
+    patch [options] <command>   Fix a broken shell command
+    patch --help                Show this help message
+    patch --version             Show version information
+    patch                       Fix the last failed command recorded by the shell hooks
+    patch --shell-init SHELL    Print bash/zsh hooks: eval "$(patch --shell-init bash)"
+    patch --from-stdin [cmd]    Diagnose a log piped on stdin (nothing is executed)
+    patch --follow LOG...       Tail log files and diagnose each new kind of error as it appears
+    patch --batch FILE          Diagnose one command per line (FILE or - for stdin), JSONL output
+    patch serve [options]       Serve fix suggestions over HTTP/JSON (POST /fix, GET /health)
+    patch train [options]       Train the local error classifier (needs NumPy) and report its accuracy
+    patch pack install [FILE]   Install a fix pack (default: the bundled common pack), no API key needed
+    patch pack build SRC [OUT]  Compile a JSONL fix pack source; patch pack list shows installed packs
+    patch cache serve [options] Run a team fix cache for PATCH_TEAM_CACHE (--host, --port 8766, --store FILE)
+
+OPTIONS:
+    --timeout SECONDS       Kill the command after SECONDS of wall time (env: PATCH_TIMEOUT)
+    --idle-timeout SECONDS  Kill the command after SECONDS without output (env: PATCH_IDLE_TIMEOUT);
+                            for interactive commands, keystrokes also count as activity
+    --sandbox[=N]           Trial-run N (default 3) candidate fixes in parallel read-only sandboxes
+                            (Linux user namespaces; with --yes only a fix that passed is applied)
+    --jobs N                Batch mode: commands run and diagnosed concurrently (default 8)
+    --order input|completion
+                            Batch mode: emit results in input order (default) or as they finish
+    --max-attempts N        Give up after N runs of the command and its fixes (default 5)
+    --trace FILE            Write a timeline of the run's phases: Chrome trace JSON (chrome://tracing,
+                            Perfetto), or OTLP/JSON if FILE ends in .otlp.json (env: PATCH_TRACE)
+    --profile FILE          Write cProfile stats for the whole run (env: PATCH_PROFILE)
+
+SERVE OPTIONS (patch serve; to fix a command named serve, use: patch -- serve):
+    --host HOST             Address to listen on (default 127.0.0.1)
+    --port PORT             Port to listen on (default 8765, 0 picks a free one)
+    --jobs N                Concurrent model calls (default 8)
+    --queue N               Requests waiting for a worker before answering 503 (default 32)
+
+TRAIN OPTIONS (patch train):
+    --corpus FILE           Labelled JSONL corpus (default: corpus/errors.jsonl next to patch.py)
+    --output FILE           Where to save the model (default ~/.patch/classifier.npz)
+    --json                  Print the accuracy and throughput report as JSON
+
+UNATTENDED MODE (scripts and CI; never prompts):
+    --json                  Print one JSON result document and nothing else
+    --yes                   Apply fixes automatically when policy allows (otherwise only suggest);
+                            fixes from the team cache are only ever suggested
+    --min-confidence N      Only auto-apply fixes with at least N% confidence (default 85)
+    --allow-sudo            Allow running commands that use sudo/doas
+    --allow-pipe-to-shell   Allow running commands that pipe a script into a shell
+    Exit codes: 0 ok, 10 fixed, 11 fix suggested but not applied, 12 unfixed,
+                13 refused by policy, 14 patch error
+
+CONFIGURATION:
+    ~/.patch/detectors.json Extra interactive programs, apps, shells and non-interactive
+                            alternatives for the command detectors (env: PATCH_DETECTORS)
+    ~/.patch/classifier.npz Model from patch train, used for errors no rule recognises
+                            (env: PATCH_CLASSIFIER, 0 to disable)
+    ~/.patch/history/       Suggestions and their outcomes; proven fixes skip the model
+                            (env: PATCH_HISTORY=0 to disable)
+    ~/.patch/fixpacks/      Installed fix packs, answered before the model
+                            (env: PATCH_FIXPACKS=0 to disable)
+    PATCH_TEAM_CACHE=URL    Share model answers and fix outcomes through a team cache
+                            (e.g. http://cache.internal:8766 running patch cache serve)
+    PATCH_METRICS_DIR=DIR   Keep Prometheus counters and latency histograms in DIR/patch.prom
+                            (point it at node_exporter's --collector.textfile.directory)
+
+EXAMPLES:
+    patch "sudo adduser yoda"
+    patch "docker ps"
+    patch "cd /home/yoda"
+    patch --batch failing.txt --jobs 16 > fixes.jsonl
+    patch --yes --json --min-confidence 90 "npm run build" > result.json
+    patch --trace run.json --profile run.prof "npm run build"
+    kubectl logs deploy/api | patch --from-stdin
+    curl -s localhost:8765/fix -d '{"command": "gti status", "error": "gti: command not found"}'
+
+FEATURES:
+    - AI-powered command fixing using OpenAI GPT-4o-mini
+    - Confidence scoring (High/Medium/Low)
+    - Platform-aware fixes (macOS/Linux)
+    - Interactive command suggestions
+    - Error explanations
+    - File system context awareness
+
+INSTALLATION:
+    pip install --break-system-packages git+https://github.com/steliosot/patch-cli.git
+
+REQUIREMENTS:
+    - Python 3.8+
+    - OpenAI API key (set with: export OPENAI_API_KEY="sk-...")
+
+For more information: https://github.com/steliosot/patch-cli
+""")
+
+def parse_cli_options(args):
+    """Split leading patch options (--timeout, --sandbox, --batch, --yes, ...) from the command."""
+    options = {'timeout': COMMAND_TIMEOUT, 'idle_timeout': IDLE_TIMEOUT, 'sandbox': 0,
+               'batch': None, 'jobs': BATCH_JOBS, 'order': 'input',
+               'yes': False, 'json': False, 'allow_sudo': False, 'allow_pipe_to_shell': False,
+               'min_confidence': AUTO_APPLY_CONFIDENCE, 'max_attempts': 5, 'from_stdin': False, 'follow': False,
+               'trace': os.environ.get('PATCH_TRACE'), 'profile': os.environ.get('PATCH_PROFILE')}
+    args = list(args)
+    while args and args[0].startswith('--'):
+        flag = args.pop(0)
+        if flag == '--':
+            break
+        name, has_value, value = flag.partition('=')
+        if name in ('--timeout', '--idle-timeout'):
+            if not has_value:
+                value = args.pop(0) if args else ''
+            try:
+                options[name[2:].replace('-', '_')] = float(value) or None
+            except ValueError:
+                print(f'[!] {name} expects a number of seconds, got: {value!r}')
+                sys.exit(1)
+        elif name == '--sandbox':
+            # Count only via --sandbox=N so the flag never swallows the command
+            if not has_value:
+                value = str(SANDBOX_CANDIDATES)
+            if not value.isdigit() or int(value) < 1:
+                print(f'[!] --sandbox expects a positive number of candidates, got: {value!r}')
+                sys.exit(1)
+            options['sandbox'] = int(value)
+        elif name in ('--yes', '--json', '--allow-sudo', '--allow-pipe-to-shell', '--from-stdin',
+                      '--follow') and not has_value:
+            options[name[2:].replace('-', '_')] = True
+        elif name in ('--min-confidence', '--max-attempts'):
+            if not has_value:
+                value = args.pop(0) if args else ''
+            if not value.isdigit() or (name == '--max-attempts' and int(value) < 1) or int(value) > 100:
+                print(f'[!] {name} expects a whole number, got: {value!r}')
+                sys.exit(1)
+            options[name[2:].replace('-', '_')] = int(value)
+        elif name in ('--trace', '--profile'):
+            if not has_value:
+                value = args.pop(0) if args else ''
+            if not value:
+                print(f'[!] {name} expects a file name')
+                sys.exit(1)
+            options[name[2:]] = value
+        elif name in ('--batch', '--jobs', '--order'):
+            if not has_value:
+                value = args.pop(0) if args else ''
+            if name == '--batch':
+                if not value:
+                    print('[!] --batch expects a file of commands, or - for stdin')
+                    sys.exit(1)
+                options['batch'] = value
+            elif name == '--jobs':
+                if not value.isdigit() or int(value) < 1:
+                    print(f'[!] --jobs expects a positive number, got: {value!r}')
+                    sys.exit(1)
+                options['jobs'] = int(value)
+            elif value in ('input', 'completion'):
+                options['order'] = value
+            else:
+                print(f'[!] --order expects input or completion, got: {value!r}')
+                sys.exit(1)
+        else:
+            args.insert(0, flag)
+            break
+    return options, args
+
+def main():
+    # Check for help flag
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h', 'help']:
+        print_help()
+        sys.exit(0)
+    
+    # From the environment first, so patch serve/train/pack/cache are covered too
+    start_tracing(os.environ.get('PATCH_TRACE'), os.environ.get('PATCH_PROFILE'))
+    start_metrics(METRICS_DIR)
+    
+    if len(sys.argv) == 3 and sys.argv[1] == '--shell-init':
+        script = shell_init_script(sys.argv[2])
+        if script is None:
+            print(f'[!] Unsupported shell: {sys.argv[2]} (supported: {", ".join(SHELL_HOOKS)})', file=sys.stderr)
+            sys.exit(1)
+        prune_spools()
+        print(script, end='')
+        sys.exit(0)
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == 'train':
+        train_main(sys.argv[2:])
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == 'pack':
+        pack_main(sys.argv[2:])
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == 'cache':
+        cache_main(sys.argv[2:])
+    
+    options, command_args = parse_cli_options(sys.argv[1:])
+    start_tracing(options['trace'], options['profile'])
+    
+    if options['batch']:
+        batch_main(options)
+    
+    unattended = options['yes'] or options['json']
+    if not options['json']:
+        show_logo()
+    
+    if options['from_stdin']:
+        log_main(options, ' '.join(command_args) or None)
+    
+    if options['follow']:
+        follow_main(options, command_args)
+    
+    spooled = None
+    if not command_args:
+        spooled = read_spooled_failure()
+        if not spooled:
+            if options['json']:
+                print(json.dumps({'command': None, 'status': 'error', 'exit_code': 1,
+                                  'reason': 'no command given and no failed command recorded'}, indent=2))
+                sys.exit(1)
+            print('[!] Usage: patch <command>')
+            if os.environ.get('PATCH_SPOOL'):
+                print('[!] No failed command recorded in this shell yet.')
+            else:
+                print('[!] Or enable shell integration to fix the last failed command: eval "$(patch --shell-init bash)"')
+            print('[!] Run: patch --help for more information')
+            sys.exit(1)
+    
+    initial = None
+    if spooled:
+        command_args = [spooled['command']]
+        initial = (spooled['returncode'], spooled['output'])
+    
+    if unattended:
+        if spooled and spooled['cwd'] and os.path.isdir(spooled['cwd']):
+            os.chdir(spooled['cwd'])
+        # Never prompts; a missing key becomes an 'error' result if a fix is needed
+        unattended_main(options, ' '.join(command_args), initial, spooled=bool(spooled))
+    
+    # With fix packs installed common errors need no key; the model asks for one if it is reached
+    if not fix_packs():
+        api_key = get_api_key()
+        if not api_key:
+            print('[!] OpenAI API key required')
+            sys.exit(1)
+    
+    if spooled:
+        print(f"[*] Last failed command ({spooled['age']:.0f}s ago, exit code {spooled['returncode']}):")
+        print(f"$ {spooled['command']}")
+        if spooled['cwd'] and spooled['cwd'] != os.getcwd():
+            try:
+                os.chdir(spooled['cwd'])
+                print(f"[*] Working in {spooled['cwd']}, where it ran.")
+            except OSError:
+                print(f"[!] It ran in {spooled['cwd']}, which is no longer accessible.")
+        if not spooled['output'].strip():
+            print('[!] It wrote nothing to stderr; diagnosing from the command and exit code alone.')
+    
+    original_cmd = ' '.join(command_args)
+    cmd = original_cmd
+    max_attempts = options['max_attempts']
+    attempts = []
+    source = 'original'
+    try:
+        fixed = run_fix_loop(options, cmd, source, attempts, max_attempts, initial=initial)
+    except FixRequestError as e:
+        print('\n' + '\n'.join(f'[!] {line}' for line in e.lines))
+        sys.exit(1)
+    finally:
+        print_attempt_summary(attempts)
+    if fixed and spooled:
+        clear_spooled_failure()
+
+# A working fix slower than this multiple of the original run gets flagged
+SLOW_FIX_RATIO = 5.0
+
+def print_attempt_summary(attempts):
+    """Print exit code and resource usage per attempt, flagging fixes that got much slower."""
+    if not attempts:
+        return
+    print('\n[*] Attempt summary:')
+    for record in attempts:
+        print(f"  [{record['attempt']}] exit {record['returncode']:<4} {format_usage(record)}  ({record['source']}) {record['command']}")
+    first, last = attempts[0], attempts[-1]
+    if len(attempts) > 1 and last['returncode'] == 0 and first['wall_s'] > 0:
+        ratio = last['wall_s'] / first['wall_s']
+        if ratio >= SLOW_FIX_RATIO and last['wall_s'] - first['wall_s'] >= 1:
+            print(f"[!] Warning: the working command took {ratio:.0f}x longer than the original "
+                  f"({last['wall_s']:.1f}s vs {first['wall_s']:.1f}s). Check it is doing what you expect.")
+
+def run_fix_loop(options, cmd, source, attempts, max_attempts=5, initial=None):
+    """Execute/diagnose/fix loop for one command, recording each attempt in attempts.
+
+    initial is an already known (returncode, output) for cmd, e.g. from the
+    shell hooks, used instead of running it the first time. Returns True once
+    a command succeeds.
+    """
+    attempt = 0
+    previous_error = None
+    previous_fix = None
+    tried = []
+    # An applied fix, recorded in the attempt history once it has run
+    pending = None
+    
+    while attempt < max_attempts:
+        attempt += 1
+        usage = {}
+        if initial:
+            returncode, output = initial
+            is_interactive = False
+            initial = None
+        else:
+            returncode, output, is_interactive = execute_command(
+                cmd, check_for_sudo=True, timeout=options['timeout'], idle_timeout=options['idle_timeout'],
+                usage=usage)
+        
+        if pending:
+            record_attempt(applied=True, returncode=returncode, **pending)
+            pending = None
+        
+        # If user aborted early (returncode is None or output is None), exit
+        if returncode is None or output is None:
+            print('[!] Command aborted by user.')
+            return
+        
+        if usage:
+            record = dict(attempt=attempt, source=source, command=cmd, returncode=returncode, **usage)
+            attempts.append(record)
+            record_telemetry('attempt', **record)
+            print(f'\n[*] Resources: {format_usage(usage)}')
+        
+        if returncode == 0:
+            # Output was already streamed to the terminal while it ran
+            print('[+] Success!')
+            return True
+        
+        # Interactive commands with no recorded output leave nothing to analyze
+        if is_interactive and output.strip():
+            print('\n[*] Interactive command failed; analyzing the recorded transcript.')
+        elif is_interactive:
             print('[!] Interactive command failed or was interrupted.')
             print('[!] Cannot automatically fix interactive commands.')
-            response = input('[!] Try a non-interactive alternative? (y/n): ')
+            response = user_input('[!] Try a non-interactive alternative? (y/n): ')
             if response.lower() == 'y':
                 alternatives = get_non_interactive_alternative(cmd)
                 if alternatives:
                     print('\n[+] Available alternatives:')
                     for i, alt in enumerate(alternatives, 1):
                         print(f'  [{i}] {alt}')
-                    choice = input('[?] Select alternative (or Enter custom): ')
+                    choice = user_input('[?] Select alternative (or Enter custom): ')
                     if choice.isdigit() and 1 <= int(choice) <= len(alternatives):
                         cmd = alternatives[int(choice) - 1]
+                        source = 'alternative'
                         continue
                     else:
                         cmd = choice
+                        source = 'custom'
                         continue
             print('[!] Exiting.')
             return
         
-        print(f'\n[-] Error (attempt {attempt}/{max_attempts}):')
-        print(output)
+        print(f'\n[-] Error (attempt {attempt}/{max_attempts}): exit code {returncode}')
         
         if attempt >= max_attempts:
             print('[!] Max attempts reached.')
             return
         
-        fix, confidence, reason, explanation = ask_openai_for_fix(output, cmd, previous_error, previous_fix)
+        started = time.monotonic()
+        fix, confidence, reason, explanation = get_validated_fix(output, cmd, previous_error, previous_fix, options, tried)
+        suggestion = dict(command=cmd, output=output, suggestion=fix,
+                          latency_ms=(time.monotonic() - started) * 1000)
         print(f'\n[*] Suggested fix: {fix}')
         print(f'[*] Confidence: {confidence}%')
         
@@ -751,6 +5776,9 @@ def main():
                 print('[!] Warning: Low confidence fix. Consider manual review.')
         
         choice = interactive_menu()
+        # Retry (1) goes on to the apply path below, which records the suggestion itself
+        if choice in (2, 3, 4):
+            record_attempt(applied=False, returncode=None, **suggestion)
         
         if choice == 4:
             print('[!] Exiting.')
@@ -761,13 +5789,15 @@ def main():
             print('────────────────────────')
             print(explanation if explanation else 'No explanation available.')
             print('────────────────────────')
-            input('\n[Press Enter to continue...] ')
+            user_input('\n[Press Enter to continue...] ')
             continue
         
         if choice == 2:
-            cmd = input('[->] Enter new command: ')
+            cmd = user_input('[->] Enter new command: ')
+            source = 'custom'
             previous_error = None
             previous_fix = None
+            tried = []
             print('\n[*] Trying new command...')
             continue
         
@@ -775,6 +5805,7 @@ def main():
         previous_error = output
         previous_fix = fix
         cmd = fix
+        source = 'fix'
         
         # Show command preview
         print('\nAbout to run:')
@@ -782,11 +5813,14 @@ def main():
         print(f'{fix}')
         print('──────────────')
         
-        response = input('Proceed? (y/n): ')
+        response = user_input('Proceed? (y/n): ')
         if response.lower() != 'y':
+            record_attempt(applied=False, returncode=None, **suggestion)
             print('[!] Aborted.')
             return
         
+        pending = suggestion
+        tried.append(fix)
         print('\n[*] Applying fix...')
     
     print('[!] Could not fix the command.')
@@ -24,6 +24,9 @@ setup(
         "openai",
         "tqdm",
     ],
+    extras_require={
+        "classifier": ["numpy"],
+    },
     entry_points={
         "console_scripts": [
             "patch=patch:main",
@@ -5,8 +5,10 @@ Tests platform detection, error categorization, parsing, etc.
 """
 
 import unittest
+from unittest import mock
 import sys
 import os
+import time
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -16,8 +18,26 @@ from patch import (
     get_app_info,
     categorize_error_type,
     is_pipe_to_shell,
+    is_interactive_command,
+    get_non_interactive_alternative,
+    parse_command,
+    RingBuffer,
+    OutputCapture,
+    run_streaming,
+    parse_cli_options,
+    run_pty,
+    clean_transcript,
+    CommandCapture,
+    print_attempt_summary,
+    parse_fix_response,
+    sandbox_unsafe_reason,
+    sandbox_namespaces_available,
+    validate_candidates,
+    validate_fix,
+    build_fix_prompt,
     validate_api_key
 )
+import patch
 
 
 class TestPlatformDetection(unittest.TestCase):
@@ -184,6 +204,205 @@ class TestErrorCategorization(unittest.TestCase):
                 self.assertIn('configuration', result)
         print(f"[✓] Configuration error detection working")
 
+    def test_rules_compile_to_literal_sequences(self):
+        """Test that rule regexes compile into ordered literal sequences."""
+        self.assertEqual(patch._rule_sequences(r'\[patch\] command (timed out|hung)'),
+                         [('[patch] command timed out',), ('[patch] command hung',)])
+        self.assertEqual(patch._rule_sequences(r'module.*not.*found|docker\.sock'),
+                         [('module', 'not', 'found'), ('docker.sock',)])
+        for unsupported in (r'error\d+', r'a+b', r'[abc]', r'x.y'):
+            with self.subTest(pattern=unsupported):
+                with self.assertRaises(ValueError):
+                    patch._rule_sequences(unsupported)
+        print(f"[✓] Rules compile to literal sequences")
+
+    def test_matches_regex_semantics(self):
+        """Test that the compiled table agrees with re.search, including line bounds."""
+        import re
+        legacy = [(re.compile(p), c) for p, c in patch.ERROR_TYPE_RULES]
+        samples = [
+            'module foo\nwas not found',
+            'module foo was not found',
+            'not found: module',
+            'no module such module here',
+            'Package could\nnot be found',
+            'Cannot connect to the Docker daemon. Is the docker daemon running?',
+            'connection refused\ndocker',
+            'ERROR: config\nfile missing',
+            '[patch] command timed out after 5s',
+        ]
+        for sample in samples:
+            expected = next((c for r, c in legacy if r.search(sample.lower())), 'other: General error')
+            with self.subTest(sample=sample):
+                result = categorize_error_type(sample, '')
+                if expected is None:
+                    self.assertTrue(result.startswith('daemon_not_running'))
+                else:
+                    self.assertEqual(result, expected)
+        print(f"[✓] Compiled table matches regex semantics")
+
+    def test_long_line_is_linear(self):
+        """Test that a long line of near-matches does not backtrack quadratically."""
+        text = 'module x ' * (1 << 17)
+        start = time.perf_counter()
+        self.assertEqual(categorize_error_type(text, ''), 'other: General error')
+        self.assertLess(time.perf_counter() - start, 1.0)
+        print(f"[✓] Long line classified in linear time")
+
+
+class TestErrorEvidence(unittest.TestCase):
+    """Test multi-label classification with evidence line spans."""
+
+    TEXT = ('starting\n'
+            'ModuleNotFoundError: foo\n'
+            'Permission denied: /x\n'
+            'retrying\n'
+            'Permission denied: /y\n'
+            'Permission denied: /z\n')
+
+    def test_every_category_with_lines(self):
+        """Test that all matching categories come back with scores and line ranges."""
+        labels = patch.classify_error_labels(self.TEXT)
+        self.assertEqual([label['category'] for label in labels],
+                         ['permission_denied: User lacks required permissions',
+                          'dependency_missing: Required package not available'])
+        self.assertEqual(labels[0]['category'], categorize_error_type(self.TEXT, ''))
+        self.assertEqual(labels[0]['lines'], [[3, 3], [5, 6]])
+        self.assertEqual(labels[0]['count'], 3)
+        self.assertEqual(labels[1]['lines'], [[2, 2]])
+        self.assertTrue(all(0 < label['score'] <= 1 for label in labels))
+        self.assertEqual(patch.classify_error_labels('all good\n'), [])
+        print(f"[✓] Every category returned with lines")
+
+    def test_incremental_matches_single_feed(self):
+        """Test that feeding arbitrary pieces gives the same labels as one feed."""
+        expected = patch.classify_error_labels(self.TEXT)
+        for size in (1, 3, 7, 40):
+            evidence = patch.ErrorEvidence()
+            for i in range(0, len(self.TEXT), size):
+                evidence.feed(self.TEXT[i:i + size])
+            self.assertEqual(evidence.finish().labels(), expected)
+        print(f"[✓] Incremental feeding matches a single feed")
+
+    def test_stderr_classified_while_streaming(self):
+        """Test that CommandCapture labels all of stderr, including a dropped middle."""
+        capture = CommandCapture(head_bytes=64, tail_bytes=64)
+        for i in range(20):
+            capture.write('stderr', b'noise %d\n' % i)
+        capture.write('stderr', b'Permission denied: /etc/shadow\n')
+        for i in range(100):
+            capture.write('stderr', b'noise %d\n' % i)
+        self.assertNotIn('Permission denied', capture.stderr.text())
+        labels = capture.labels()
+        self.assertEqual(labels[0]['category'], 'permission_denied: User lacks required permissions')
+        self.assertEqual(labels[0]['lines'], [[21, 21]])
+        print(f"[✓] stderr classified while streaming")
+
+    def test_excerpt_keeps_evidence_and_tail(self):
+        """Test that long output is cut to evidence with context plus the tail."""
+        lines = ['build step %d' % i for i in range(2000)]
+        lines[500] = 'Permission denied: /var/lib/thing'
+        error = '\n'.join(lines)
+        excerpt = patch.error_excerpt(error)
+        self.assertLessEqual(len(excerpt), patch.PROMPT_ERROR_CHARS + 200)
+        self.assertIn('Permission denied: /var/lib/thing', excerpt)
+        self.assertIn('build step 499', excerpt)
+        self.assertIn('build step 1999', excerpt)
+        self.assertNotIn('build step 1000', excerpt)
+        self.assertIn('lines omitted ...]', excerpt)
+        self.assertEqual(patch.error_excerpt('short error'), 'short error')
+        print(f"[✓] Excerpt keeps evidence and tail")
+
+    def test_prompt_uses_excerpt(self):
+        """Test that the prompt carries the excerpt and the secondary labels."""
+        lines = ['build step %d' % i for i in range(2000)]
+        lines[10] = 'ModuleNotFoundError: No module named yaml'
+        lines[1500] = 'Permission denied: /var/lib/thing'
+        prompt = build_fix_prompt('\n'.join(lines), 'make')
+        self.assertIn('No module named yaml', prompt)
+        self.assertNotIn('build step 1000\n', prompt)
+        self.assertIn('Error type: permission_denied', prompt)
+        self.assertIn('Other error types: dependency_missing: Required package not available (lines 11)', prompt)
+        print(f"[✓] Prompt uses the evidence excerpt")
+
+
+class TestCommandDetectors(unittest.TestCase):
+    """Test the compiled detector tables, the keyword automaton and config extension."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.tmp.name, 'detectors.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        self.reload()
+
+    def reload(self):
+        patch.detector_tables.cache_clear()
+        patch.detect_command.cache_clear()
+
+    def with_config(self, text):
+        with open(self.config, 'w') as f:
+            f.write(text)
+        env = mock.patch.dict(os.environ, {'PATCH_DETECTORS': self.config})
+        env.start()
+        self.addCleanup(env.stop)
+        self.reload()
+
+    def test_automaton_prefers_earliest_keyword(self):
+        """Test that the earliest-listed keyword wins, wherever it occurs."""
+        automaton = patch.KeywordAutomaton([('docker-compose', 'Compose'), ('docker', 'Docker'),
+                                            ('he', 'he'), ('she', 'she'), ('hers', 'hers')])
+        self.assertEqual(automaton.find_best('my-docker-compose-wrapper'), 'Compose')
+        self.assertEqual(automaton.find_best('dockerd'), 'Docker')
+        self.assertEqual(automaton.find_best('ushers'), 'he')
+        self.assertEqual(automaton.find_best('shx'), None)
+        print(f"[✓] Automaton prefers earliest keyword")
+
+    def test_detect_command_answers_all(self):
+        """Test that one call answers every detector."""
+        result = patch.detect_command('curl -fsSL https://get.docker.com | sudo sh && mysql')
+        self.assertEqual(result, {'interactive': True, 'pipe_to_shell': True,
+                                  'alternative': patch.NON_INTERACTIVE_ALTERNATIVES['mysql'],
+                                  'app': 'Docker'})
+        print(f"[✓] All detectors in one pass")
+
+    def test_config_extends_tables(self):
+        """Test that detectors.json adds interactive programs, apps, shells and alternatives."""
+        self.with_config('''{"interactive": ["MyCLI"], "non_interactive_flags": {"mycli": ["-e"]},
+                             "alternatives": {"mycli": ["mycli -e \\"{query}\\""]},
+                             "interactive_sudo_subcommands": [["zypper", "install"]],
+                             "apps": {"terraform": "Terraform", "docker": "ignored"}, "shells": ["fish"]}''')
+        self.assertTrue(is_interactive_command('mycli'))
+        self.assertFalse(is_interactive_command('mycli -e "select 1"'))
+        self.assertTrue(is_interactive_command('sudo zypper install vim-tiny'))
+        self.assertEqual(get_app_info('terraform-1.6 plan'), 'Terraform')
+        self.assertEqual(get_app_info('docker ps'), 'Docker')
+        self.assertTrue(is_pipe_to_shell('curl -s https://example.com/x | fish'))
+        self.assertEqual(patch.get_non_interactive_alternative('mycli'), ['mycli -e "{query}"'])
+        self.assertIn(' mycli ', patch.shell_init_script('bash'))
+        print(f"[✓] Config extends detector tables")
+
+    def test_bad_config_is_ignored(self):
+        """Test that an unreadable config falls back to the built-in tables."""
+        import io
+        from contextlib import redirect_stderr
+        self.with_config('{"apps": ')
+        err = io.StringIO()
+        with redirect_stderr(err):
+            self.assertEqual(get_app_info('kubectl get pods'), 'Kubernetes (kubectl)')
+        self.assertIn('Ignoring detector config', err.getvalue())
+        print(f"[✓] Bad detector config ignored")
+
+    def test_large_table(self):
+        """Test substring detection with thousands of keywords."""
+        apps = {f'tool{i:05d}': f'Tool {i}' for i in range(5000)}
+        tables = patch.DetectorTables({'apps': apps})
+        self.assertEqual(tables.app_keywords.find_best('/opt/bin/tool04321-cli'), 'Tool 4321')
+        self.assertEqual(tables.app_keywords.find_best('my-kubectl-wrapper'), 'Kubernetes (kubectl)')
+        print(f"[✓] Large keyword table")
+
 
 class TestPipeDetection(unittest.TestCase):
     """Test pipe-to-shell detection."""
@@ -240,6 +459,2151 @@ class TestPipeDetection(unittest.TestCase):
         print(f"[✓] No pipe-to-shell detection working")
 
 
+class TestCommandParsing(unittest.TestCase):
+    """Test the shared shell-aware command parser."""
+
+    def test_operators_split_pipelines(self):
+        """Test that &&, || and ; split pipelines and | splits commands."""
+        analysis = parse_command('make build && ps aux | grep app || echo failed; ls')
+        self.assertEqual(len(analysis.pipelines), 4)
+        self.assertEqual([p.operator for p in analysis.pipelines], ['&&', '||', ';', None])
+        self.assertEqual(len(analysis.pipelines[1].commands), 2)
+        self.assertEqual(analysis.names, ['make', 'ps', 'grep', 'echo', 'ls'])
+        print(f"[✓] Operators split pipelines")
+
+    def test_quotes_do_not_split_operators(self):
+        """Test that operators inside quotes stay part of the word."""
+        analysis = parse_command('echo "a && b | c" \'x;y\'')
+        self.assertEqual(len(analysis.commands), 1)
+        self.assertEqual(analysis.commands[0].argv, ['echo', 'a && b | c', 'x;y'])
+        print(f"[✓] Quoted operators preserved")
+
+    def test_prefixes_and_assignments(self):
+        """Test that sudo/env prefixes and assignments are split off argv."""
+        command = parse_command('FOO=1 sudo -u bob env A=b docker ps').commands[0]
+        self.assertEqual(command.prefixes, ['sudo', 'env'])
+        self.assertEqual(command.assignments, [('FOO', '1'), ('A', 'b')])
+        self.assertEqual(command.name, 'docker')
+        print(f"[✓] Prefixes and assignments parsed")
+
+    def test_redirections(self):
+        """Test that redirections are recorded with fd and target."""
+        command = parse_command('ls /missing 2>&1 >out.log').commands[0]
+        self.assertEqual(command.argv, ['ls', '/missing'])
+        self.assertEqual(command.redirects, [('2', '>&', '1'), (None, '>', 'out.log')])
+        print(f"[✓] Redirections parsed")
+
+    def test_unbalanced_quote_does_not_raise(self):
+        """Test that an unterminated quote is tolerated."""
+        analysis = parse_command('echo "unterminated')
+        self.assertEqual(analysis.commands[0].argv, ['echo', 'unterminated'])
+        print(f"[✓] Unbalanced quote tolerated")
+
+    def test_parse_is_memoized(self):
+        """Test that the same command string is parsed only once."""
+        self.assertIs(parse_command('git status'), parse_command('git status'))
+        print(f"[✓] Parse results memoized")
+
+
+class TestInteractiveDetection(unittest.TestCase):
+    """Test interactive command detection on parsed commands."""
+
+    def test_interactive_commands(self):
+        """Test that interactive programs are detected anywhere in the line."""
+        for cmd in ['psql', 'sudo adduser yoda', 'cd /tmp && vim notes.txt', 'sudo apt-get install nginx']:
+            with self.subTest(cmd=cmd):
+                self.assertTrue(is_interactive_command(cmd))
+        print(f"[✓] Interactive commands detected")
+
+    def test_substrings_are_not_interactive(self):
+        """Test that keywords inside other words do not match."""
+        for cmd in ['docker run -it ubuntu', 'cat review.txt', 'echo ssh', 'psql -c "select 1"']:
+            with self.subTest(cmd=cmd):
+                self.assertFalse(is_interactive_command(cmd))
+        print(f"[✓] Non-interactive commands not flagged")
+
+    def test_non_interactive_alternative(self):
+        """Test alternatives are looked up by command name."""
+        self.assertIn('useradd -m {user}', get_non_interactive_alternative('sudo adduser yoda'))
+        self.assertIsNone(get_non_interactive_alternative('echo adduser'))
+        print(f"[✓] Non-interactive alternatives by name")
+
+
+class TestOutputCapture(unittest.TestCase):
+    """Test bounded streaming capture of command output."""
+
+    def test_ring_buffer_keeps_latest_bytes(self):
+        """Test that the ring buffer wraps and keeps only recent bytes."""
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        ring.write(b'ghijk')
+        self.assertEqual(ring.getvalue(), b'defghijk')
+        ring.write(b'0123456789')
+        self.assertEqual(ring.getvalue(), b'23456789')
+        print(f"[✓] Ring buffer keeps latest bytes")
+
+    def test_small_output_is_kept_whole(self):
+        """Test that output within the budget is returned unchanged."""
+        capture = OutputCapture(head_bytes=4, tail_bytes=8)
+        capture.write(b'hello world')
+        self.assertFalse(capture.truncated)
+        self.assertEqual(capture.getvalue(), b'hello world')
+        self.assertIsNone(capture.mmap())
+        print(f"[✓] Small output kept whole")
+
+    def test_large_output_spills(self):
+        """Test that overflow keeps head and tail and spills the rest to disk."""
+        capture = OutputCapture(head_bytes=4, tail_bytes=8)
+        for i in range(100):
+            capture.write(b'%03d,' % i)
+        value = capture.getvalue()
+        self.assertTrue(capture.truncated)
+        self.assertTrue(value.startswith(b'000,'))
+        self.assertTrue(value.endswith(b'098,099,'))
+        self.assertIn(b'bytes omitted', value)
+        spilled = capture.mmap()
+        self.assertEqual(len(spilled), capture.total - 4)
+        self.assertTrue(spilled[:].endswith(b'099,'))
+        spilled.close()
+        capture.close()
+        print(f"[✓] Large output spills to temp file")
+
+    def test_spill_is_capped(self):
+        """Test that the spill file stops growing at CAPTURE_SPILL_BYTES."""
+        capture = OutputCapture(head_bytes=4, tail_bytes=8)
+        with mock.patch.object(patch, 'CAPTURE_SPILL_BYTES', 40):
+            for i in range(100):
+                capture.write(b'%03d,' % i)
+        spilled = capture.mmap()
+        self.assertEqual(len(spilled), 40)
+        spilled.close()
+        self.assertTrue(capture.getvalue().endswith(b'098,099,'))
+        capture.close()
+        print(f"[✓] Spill file is capped")
+
+    def test_run_streaming_returncode(self):
+        """Test that streaming execution captures output and exit status."""
+        capture = run_streaming('echo out; echo err >&2; exit 3', tee=False)
+        self.assertEqual(capture.returncode, 3)
+        self.assertIn('out', capture.text())
+        self.assertIn('err', capture.text())
+        print(f"[✓] Streaming execution captures exit status")
+
+
+class TestExecutionTimeouts(unittest.TestCase):
+    """Test wall-clock and inactivity timeouts for executed commands."""
+
+    def test_idle_timeout_keeps_partial_output(self):
+        """Test that a silent command is killed and its partial output kept."""
+        capture = run_streaming('echo started; sleep 30', tee=False, idle_timeout=0.3)
+        self.assertEqual(capture.timed_out, 'idle')
+        self.assertEqual(capture.returncode, 124)
+        self.assertIn('started', capture.text())
+        self.assertIn('[patch] Command hung', capture.text())
+        print(f"[✓] Idle timeout keeps partial output")
+
+    def test_wall_timeout_kills_process_group(self):
+        """Test that the wall-clock timeout terminates background children too."""
+        start = time.monotonic()
+        capture = run_streaming('sleep 30 & while true; do echo tick; sleep 0.05; done',
+                                tee=False, timeout=0.4, idle_timeout=5)
+        self.assertEqual(capture.timed_out, 'timeout')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('tick', capture.text())
+        print(f"[✓] Wall timeout kills process group")
+
+    def test_pty_wall_timeout(self):
+        """Test that interactive commands on a PTY honour the wall-clock timeout."""
+        start = time.monotonic()
+        capture = run_pty('sleep 30 & while true; do echo tick; sleep 0.05; done',
+                          tee=False, forward_input=False, timeout=0.4)
+        self.assertEqual(capture.timed_out, 'timeout')
+        self.assertEqual(capture.returncode, 124)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('tick', capture.text())
+        self.assertIn('[patch] Command timed out after 0.4s', capture.text())
+        print(f"[✓] PTY wall timeout")
+
+    def test_pty_idle_timeout(self):
+        """Test that a silent interactive command is killed and its transcript kept."""
+        capture = run_pty('echo started; sleep 30', tee=False, forward_input=False, idle_timeout=0.3)
+        self.assertEqual(capture.timed_out, 'idle')
+        self.assertEqual(capture.returncode, 124)
+        self.assertIn('started', capture.text())
+        self.assertIn('[patch] Command hung', capture.text())
+        print(f"[✓] PTY idle timeout")
+
+    def test_timeout_marker_is_classified(self):
+        """Test that the timeout marker feeds a dedicated error category."""
+        result = categorize_error_type('partial\n[patch] Command timed out after 5s, process group terminated', 'make')
+        self.assertIn('timeout', result)
+        print(f"[✓] Timeout marker classified")
+
+    def test_cli_timeout_options(self):
+        """Test that leading timeout options are split from the command."""
+        options, args = parse_cli_options(['--timeout', '5', '--idle-timeout=2', 'make', '--timeout'])
+        self.assertEqual(options['timeout'], 5.0)
+        self.assertEqual(options['idle_timeout'], 2.0)
+        self.assertEqual(args, ['make', '--timeout'])
+        print(f"[✓] CLI timeout options parsed")
+
+
+class TestPtyExecution(unittest.TestCase):
+    """Test PTY-backed execution of interactive commands."""
+
+    def test_command_sees_a_terminal(self):
+        """Test that the command runs with a terminal on stdout."""
+        capture = run_pty('test -t 1 && echo on-a-tty', tee=False, forward_input=False)
+        self.assertEqual(capture.returncode, 0)
+        self.assertIn('on-a-tty', capture.text())
+        print(f"[✓] PTY command sees a terminal")
+
+    def test_exit_code_and_transcript(self):
+        """Test that failures keep their exit code and printed output."""
+        capture = run_pty('echo "FATAL: role \\"yoda\\" does not exist"; exit 2', tee=False, forward_input=False)
+        self.assertEqual(capture.returncode, 2)
+        self.assertIn('FATAL: role "yoda" does not exist', clean_transcript(capture.text()))
+        print(f"[✓] PTY exit code and transcript recorded")
+
+    def test_clean_transcript(self):
+        """Test that control sequences and carriage-return redraws are removed."""
+        raw = 'progress 10%\rprogress 100%\r\n\x1b[31merror\x1b[0m\r\n'
+        self.assertEqual(clean_transcript(raw), 'progress 100%\nerror\n')
+        print(f"[✓] Transcript cleaned")
+
+
+class TestStreamSeparation(unittest.TestCase):
+    """Test separate, timestamped stdout/stderr capture."""
+
+    def test_streams_captured_separately(self):
+        """Test that stdout and stderr land in their own captures."""
+        capture = run_streaming('echo out; echo err >&2', tee=False)
+        self.assertEqual(capture.stdout.text(), 'out\n')
+        self.assertEqual(capture.stderr.text(), 'err\n')
+        print(f"[✓] Streams captured separately")
+
+    def test_merged_view_is_chronological(self):
+        """Test that the merged view keeps arrival order with timestamps."""
+        capture = run_streaming('echo one; sleep 0.05; echo two >&2; sleep 0.05; echo three', tee=False)
+        self.assertEqual(capture.merged(), 'one\ntwo\nthree\n')
+        timeline = capture.timeline()
+        self.assertEqual([name for _, name, _ in timeline], ['stdout', 'stderr', 'stdout'])
+        self.assertEqual(timeline, sorted(timeline, key=lambda item: item[0]))
+        print(f"[✓] Merged view is chronological")
+
+    def test_failure_context_prefers_stderr(self):
+        """Test that diagnosis gets stderr plus only the last stdout lines before it."""
+        capture = CommandCapture()
+        for i in range(200):
+            capture.write('stdout', b'compiling unit %d\n' % i)
+        capture.write('stderr', b'error: undefined reference to main\n')
+        context = capture.failure_context(stdout_lines=5)
+        self.assertIn('compiling unit 199', context)
+        self.assertNotIn('compiling unit 194', context)
+        self.assertTrue(context.endswith('error: undefined reference to main'))
+        print(f"[✓] Failure context prefers stderr")
+
+    def test_failure_context_keeps_stdout_after_stderr(self):
+        """Test that stdout written after the first error output is not dropped."""
+        capture = CommandCapture()
+        capture.write('stdout', b'running migrations\n')
+        capture.write('stderr', b'warning: deprecated option\n')
+        for i in range(100):
+            capture.write('stdout', b'step %d\n' % i)
+        capture.write('stdout', b'FATAL: relation "users" does not exist\n')
+        context = capture.failure_context(stdout_lines=5)
+        self.assertIn('running migrations', context)
+        self.assertIn('warning: deprecated option', context)
+        self.assertTrue(context.endswith('FATAL: relation "users" does not exist'))
+        self.assertIn('step 99', context)
+        self.assertNotIn('step 95', context)
+        print(f"[✓] Failure context keeps stdout written after stderr")
+
+    def test_failure_context_without_stderr(self):
+        """Test that stdout-only failures fall back to the stdout tail."""
+        capture = CommandCapture()
+        capture.write('stdout', b'FAILED: 3 tests\n')
+        self.assertEqual(capture.failure_context(), 'FAILED: 3 tests')
+        print(f"[✓] Failure context falls back to stdout")
+
+    def test_failure_context_finds_error_scrolled_out_of_stdout(self):
+        """Test that a stdout-only failure keeps an error that scrolled out of the tail."""
+        capture = CommandCapture(head_bytes=64, tail_bytes=256)
+        for i in range(50):
+            capture.write('stdout', b'test %d ok\n' % i)
+        capture.write('stdout', b'ERROR: could not connect to database\n')
+        for i in range(200):
+            capture.write('stdout', b'cleanup %d\n' % i)
+        context = capture.failure_context(stdout_lines=5)
+        self.assertIn('ERROR: could not connect to database', context)
+        self.assertIn('the first error', context)
+        self.assertTrue(context.endswith('cleanup 199'))
+        capture.close()
+        print(f"[✓] Failure context finds an error that scrolled out of stdout")
+
+
+class TestResourceAccounting(unittest.TestCase):
+    """Test per-attempt wall time, CPU and memory accounting."""
+
+    def test_streaming_records_usage(self):
+        """Test that a streamed run reports wall, CPU and peak RSS."""
+        capture = run_streaming('python3 -c "sum(range(3000000))"', tee=False)
+        usage = capture.usage
+        self.assertEqual(set(usage), {'wall_s', 'user_s', 'sys_s', 'max_rss_kb'})
+        self.assertGreater(usage['wall_s'], 0)
+        self.assertGreater(usage['user_s'] + usage['sys_s'], 0)
+        self.assertGreater(usage['max_rss_kb'], 0)
+        print(f"[✓] Streaming run records resource usage")
+
+    def test_pty_records_usage(self):
+        """Test that PTY runs are accounted too."""
+        capture = run_pty('true', tee=False, forward_input=False)
+        self.assertIn('wall_s', capture.usage)
+        print(f"[✓] PTY run records resource usage")
+
+    def test_telemetry_written(self):
+        """Test that telemetry events are appended as JSON lines."""
+        import json
+        import tempfile
+        with tempfile.TemporaryDirectory() as home:
+            old_home, old_enabled = patch.PATCH_HOME, patch.TELEMETRY_ENABLED
+            patch.PATCH_HOME, patch.TELEMETRY_ENABLED = home, True
+            try:
+                patch.record_telemetry('attempt', attempt=1, returncode=2, wall_s=0.5)
+                patch.record_telemetry('attempt', attempt=2, returncode=0, wall_s=0.7)
+            finally:
+                patch.PATCH_HOME, patch.TELEMETRY_ENABLED = old_home, old_enabled
+            with open(os.path.join(home, 'telemetry.jsonl')) as f:
+                events = [json.loads(line) for line in f]
+        self.assertEqual([e['attempt'] for e in events], [1, 2])
+        self.assertEqual(events[1]['wall_s'], 0.7)
+        print(f"[✓] Telemetry written as JSONL")
+
+    def test_telemetry_is_rotated(self):
+        """Test that the telemetry log is rotated instead of growing forever."""
+        import tempfile
+        with tempfile.TemporaryDirectory() as home:
+            old_home, old_enabled = patch.PATCH_HOME, patch.TELEMETRY_ENABLED
+            patch.PATCH_HOME, patch.TELEMETRY_ENABLED = home, True
+            try:
+                with mock.patch.object(patch, 'TELEMETRY_MAX_BYTES', 1000):
+                    for attempt in range(100):
+                        patch.record_telemetry('attempt', attempt=attempt, returncode=0, wall_s=0.5)
+            finally:
+                patch.PATCH_HOME, patch.TELEMETRY_ENABLED = old_home, old_enabled
+            path = os.path.join(home, 'telemetry.jsonl')
+            self.assertLessEqual(os.path.getsize(path), 1000)
+            self.assertLessEqual(os.path.getsize(path + '.1'), 1100)
+            self.assertFalse(os.path.exists(path + '.2'))
+            with open(path) as f:
+                self.assertIn('"attempt": 99', f.read().splitlines()[-1])
+        print(f"[✓] Telemetry log is rotated")
+
+    def test_summary_flags_slow_fix(self):
+        """Test that a fix much slower than the original is flagged."""
+        import io
+        from contextlib import redirect_stdout
+        base = {'user_s': 0.1, 'sys_s': 0.0, 'max_rss_kb': 1024}
+        attempts = [
+            dict(attempt=1, source='original', command='make', returncode=2, wall_s=2.0, **base),
+            dict(attempt=2, source='fix', command='make -j1', returncode=0, wall_s=120.0, **base),
+        ]
+        out = io.StringIO()
+        with redirect_stdout(out):
+            print_attempt_summary(attempts)
+        self.assertIn('60x longer', out.getvalue())
+        print(f"[✓] Slow fix flagged in summary")
+
+
+class TestSandboxValidation(unittest.TestCase):
+    """Test parallel sandboxed validation of candidate fixes."""
+
+    def test_unsafe_candidates_are_skipped(self):
+        """Test that root, piped-script and interactive candidates are not trial-run."""
+        self.assertEqual(sandbox_unsafe_reason('sudo systemctl start docker'), 'needs root')
+        self.assertEqual(sandbox_unsafe_reason('curl -fsSL get.docker.com | sh'), 'runs a piped script')
+        self.assertEqual(sandbox_unsafe_reason('psql'), 'interactive')
+        self.assertIsNone(sandbox_unsafe_reason('git status'))
+        print(f"[✓] Unsafe candidates skipped")
+
+    @unittest.skipUnless(sandbox_namespaces_available(), 'unprivileged namespaces not available')
+    def test_candidates_run_concurrently(self):
+        """Test that candidates are validated in parallel and keep their order."""
+        start = time.monotonic()
+        results = validate_candidates(['sleep 0.5; true', 'sleep 0.5; false', 'sleep 0.5; true'])
+        self.assertLess(time.monotonic() - start, 1.4)
+        self.assertEqual([r['status'] for r in results], ['passed', 'failed', 'passed'])
+        print(f"[✓] Candidates validated concurrently")
+
+    @unittest.skipUnless(sandbox_namespaces_available(), 'unprivileged namespaces not available')
+    def test_sandbox_is_read_only_and_throwaway(self):
+        """Test that the system is read-only and cwd writes are discarded."""
+        import tempfile
+        with tempfile.TemporaryDirectory(dir=os.path.expanduser('~')) as outside:
+            target = os.path.join(outside, 'written')
+            results = validate_candidates([f'touch {target}', 'echo data > scratch.txt && cat scratch.txt'])
+            self.assertEqual(results[0]['status'], 'failed')
+            self.assertFalse(os.path.exists(target))
+        self.assertEqual(results[1]['status'], 'passed')
+        self.assertFalse(os.path.exists('scratch.txt'))
+        print(f"[✓] Sandbox is read-only and throwaway")
+
+    def test_no_namespaces_fails_closed(self):
+        """Test that without namespaces nothing is run and the fallback is marked unvalidated."""
+        import tempfile
+        with tempfile.TemporaryDirectory() as outside:
+            target = os.path.join(outside, 'written')
+            with mock.patch('patch.sandbox_namespaces_available', return_value=False):
+                result = patch.run_in_sandbox(f'touch {target}')
+                fix = patch.choose_validated_fix([(f'touch {target}', '95', '', '')], {'sandbox': 1})
+            self.assertEqual(result['status'], 'skipped')
+            self.assertFalse(os.path.exists(target))
+        self.assertEqual(fix[1], '0')
+        self.assertIn('unvalidated', fix[2])
+        print(f"[✓] Sandbox fails closed without namespaces")
+
+    @unittest.skipUnless(sandbox_namespaces_available(), 'unprivileged namespaces not available')
+    def test_failed_candidates_are_unvalidated(self):
+        """Test that when nothing passes the suggestion offered is marked unvalidated."""
+        fix = patch.choose_validated_fix([('false', '95', 'reason', ''), ('exit 3', '80', '', '')], {'sandbox': 2})
+        self.assertEqual(fix[:2], ('false', '0'))
+        self.assertTrue(fix[2].startswith('it is unvalidated'))
+        print(f"[✓] Unvalidated sandbox fallback marked")
+
+    @unittest.skipUnless(sandbox_namespaces_available(), 'unprivileged namespaces not available')
+    def test_failed_remount_is_an_error(self):
+        """Test that a mount that cannot be made read-only stops the candidate."""
+        setup = patch._SANDBOX_SETUP.replace('"$(printf \'%b\' "$m")"', '/nonexistent-mount-point')
+        with mock.patch('patch._SANDBOX_SETUP', setup):
+            result = patch.run_in_sandbox('true')
+        self.assertEqual((result['status'], result['returncode']), ('error', 125))
+        print(f"[✓] Failed read-only remount stops the candidate")
+
+    def test_yes_never_applies_unvalidated_fix(self):
+        """Test that --yes --sandbox leaves a fix that did not pass as a suggestion."""
+        options, _ = parse_cli_options(['--yes', '--sandbox', 'false'])
+        saved = patch.HISTORY_ENABLED
+        patch.HISTORY_ENABLED = False
+        try:
+            with mock.patch('patch.suggest_fix', return_value=(('rm -rf build', '99', '', ''), [], 'model')), \
+                    mock.patch('patch.validate_candidates', return_value=[{'status': 'skipped'}]) as trial, \
+                    mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test'}):
+                doc = patch.run_unattended_fix(dict(options, json=True), 'false')
+        finally:
+            patch.HISTORY_ENABLED = saved
+        trial.assert_called_once()
+        self.assertEqual(doc['status'], 'suggested')
+        self.assertEqual(doc['suggestion']['sandbox'], 'skipped')
+        self.assertEqual(len(doc['attempts']), 1)
+        print(f"[✓] --yes does not apply a fix that failed sandbox validation")
+
+    def test_cli_sandbox_option(self):
+        """Test that --sandbox only takes a count through --sandbox=N."""
+        options, args = parse_cli_options(['--sandbox', 'make', 'test'])
+        self.assertEqual(options['sandbox'], 3)
+        self.assertEqual(args, ['make', 'test'])
+        options, _ = parse_cli_options(['--sandbox=5', 'make'])
+        self.assertEqual(options['sandbox'], 5)
+        print(f"[✓] CLI sandbox option parsed")
+
+
+class TestFixResponseParser(unittest.TestCase):
+    """Test parse_fix_response on the formats the model returns."""
+
+    def test_four_field_format(self):
+        """Test command:::confidence:::reason:::explanation."""
+        fix = parse_fix_response('curl -fsSL url | bash:::90:::Install script:::Runs the installer')
+        self.assertEqual(fix, ('curl -fsSL url | bash', '90', 'Install script', 'Runs the installer'))
+        print(f"[✓] Four-field format parsed")
+
+    def test_text_confidence_and_prefix(self):
+        """Test textual confidence and label prefixes."""
+        fix, confidence, reason, _ = parse_fix_response('FIXED_COMMAND: git push:::high:::typo')
+        self.assertEqual((fix, confidence, reason), ('git push', '90', 'typo'))
+        print(f"[✓] Text confidence and prefix parsed")
+
+    def test_empty_response(self):
+        """Test that an empty reply yields an empty fix."""
+        self.assertEqual(parse_fix_response(''), ('', '50', '', ''))
+        print(f"[✓] Empty response handled")
+
+
+class TestFixPreValidation(unittest.TestCase):
+    """Test cheap local checks on suggested fixes."""
+
+    def setUp(self):
+        self.history = patch.HISTORY_ENABLED
+        patch.HISTORY_ENABLED = False
+
+    def tearDown(self):
+        patch.HISTORY_ENABLED = self.history
+
+    def test_syntax_errors_rejected(self):
+        """Test that unbalanced quotes and dangling pipes are caught."""
+        for fix in ['echo "unbalanced', 'ls |', 'if true; then echo']:
+            with self.subTest(fix=fix):
+                self.assertIn('syntax error', validate_fix(fix)[0])
+        print(f"[✓] Syntax errors rejected")
+
+    def test_missing_binary_rejected(self):
+        """Test that programs not on PATH are caught."""
+        problems = validate_fix('definitely-not-a-real-binary-xyz --version')
+        self.assertIn('not installed', problems[0])
+        print(f"[✓] Missing binary rejected")
+
+    def test_binary_installed_by_earlier_step(self):
+        """Test that a program installed earlier in the same fix is accepted."""
+        for fix in ['sudo apt-get install -y not-a-real-tool-xyz && not-a-real-tool-xyz --help',
+                    'curl -fsSL https://example.com/install.sh | sh && not-a-real-tool-xyz']:
+            with self.subTest(fix=fix):
+                self.assertEqual(validate_fix(fix), [])
+        print(f"[✓] Binary installed by earlier step accepted")
+
+    def test_git_aliases_are_not_run_for_help(self):
+        """Test that checking a git alias's options never runs the alias."""
+        import shutil
+        import tempfile
+        if not shutil.which('git'):
+            self.skipTest('git not installed')
+        with tempfile.TemporaryDirectory() as tmp:
+            marker = os.path.join(tmp, 'ran')
+            config = os.path.join(tmp, 'gitconfig')
+            with open(config, 'w') as f:
+                f.write(f'[alias]\n\tboom = "!sh -c \'touch {marker}\'"\n')
+            with mock.patch.dict(os.environ, {'GIT_CONFIG_GLOBAL': config}):
+                patch.known_long_options.cache_clear()
+                self.assertEqual(validate_fix('git boom --no-such-option'), [])
+            self.assertFalse(os.path.exists(marker))
+        print(f"[✓] Git aliases are not run for help")
+
+    def test_unknown_long_option_rejected(self):
+        """Test that long options missing from the tool's help are caught."""
+        import shutil
+        if not shutil.which('git'):
+            self.skipTest('git not installed')
+        self.assertEqual(validate_fix('git commit --amend --no-verify'), [])
+        problems = validate_fix('git commit --ammend')
+        self.assertIn('--ammend', problems[0])
+        self.assertIn('did you mean --amend', problems[0])
+        print(f"[✓] Unknown long option rejected")
+
+    def test_builtins_and_valid_commands_pass(self):
+        """Test that builtins and ordinary commands are accepted."""
+        for fix in ['cd /tmp && ls -la', 'export FOO=1; echo $FOO', 'ls --al']:
+            with self.subTest(fix=fix):
+                self.assertEqual(validate_fix(fix), [])
+        print(f"[✓] Valid commands pass")
+
+    def test_rejected_suggestions_reach_prompt(self):
+        """Test that validation errors are sent back to the model."""
+        prompt = build_fix_prompt('bash: dockr: command not found', 'dockr ps',
+                                  rejected=[('dockr ps -a', ["'dockr' is not installed or not on PATH"])])
+        self.assertIn('REJECTED SUGGESTIONS', prompt)
+        self.assertIn("dockr ps -a -> 'dockr' is not installed", prompt)
+        print(f"[✓] Rejected suggestions reach prompt")
+
+    def test_reask_does_not_use_attempt(self):
+        """Test that a rejected suggestion is re-asked with the validation error."""
+        import io
+        from contextlib import redirect_stdout
+        replies = [('echo "broken', '90', '', ''), ('echo fixed', '80', '', '')]
+        calls = []
+
+        def fake_ask(error, cmd, previous_error=None, previous_fix=None, rejected=None, avoid=None):
+            calls.append(list(rejected or []))
+            return replies[len(calls) - 1]
+
+        original = patch.ask_openai_for_fix
+        patch.ask_openai_for_fix = fake_ask
+        try:
+            with redirect_stdout(io.StringIO()):
+                fix = patch.get_validated_fix('error', 'cmd', None, None, {'sandbox': 0})
+        finally:
+            patch.ask_openai_for_fix = original
+        self.assertEqual(fix[0], 'echo fixed')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1][0][0], 'echo "broken')
+        print(f"[✓] Re-ask carries validation error")
+
+
+class TestBatchMode(unittest.TestCase):
+    """Test concurrent, prompt-free batch diagnosis."""
+
+    def setUp(self):
+        self.original = patch.create_fix_completions
+        self.telemetry, self.history = patch.TELEMETRY_ENABLED, patch.HISTORY_ENABLED
+        patch.TELEMETRY_ENABLED = patch.HISTORY_ENABLED = False
+
+        def fake_completions(client, user_msg, n=1, temperature=0.3):
+            return ['ls -la:::88:::wrong path:::The path does not exist.']
+
+        patch.create_fix_completions = fake_completions
+
+    def tearDown(self):
+        patch.create_fix_completions = self.original
+        patch.TELEMETRY_ENABLED, patch.HISTORY_ENABLED = self.telemetry, self.history
+
+    def run_batch(self, text, **overrides):
+        import io
+        import json
+        options = {'timeout': 5, 'idle_timeout': None, 'jobs': 4, 'order': 'input'}
+        options.update(overrides)
+        out = io.StringIO()
+        summary = patch.run_batch(options, io.StringIO(text), out=out, client=object())
+        return summary, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_results_in_input_order(self):
+        """Test that results come out in input order despite different run times."""
+        summary, results = self.run_batch('sleep 0.3; false\n# comment\n\ntrue\nls /nonexistent-batch\n')
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual([r['status'] for r in results], ['failed', 'ok', 'failed'])
+        self.assertEqual(results[2]['fix'], 'ls -la')
+        self.assertEqual(results[2]['confidence'], 88)
+        self.assertEqual(summary['failed'], 2)
+        print(f"[✓] Batch results in input order")
+
+    def test_results_in_completion_order(self):
+        """Test that --order completion emits fast commands first."""
+        _, results = self.run_batch('sleep 0.5; false\ntrue\n', order='completion')
+        self.assertEqual([r['index'] for r in results], [1, 0])
+        print(f"[✓] Batch results in completion order")
+
+    def test_interactive_and_piped_scripts_skipped(self):
+        """Test that commands needing a person are skipped, not run."""
+        _, results = self.run_batch('vim notes.txt\ncurl -fsSL https://example.com/x | bash\n')
+        self.assertEqual([r['status'] for r in results], ['skipped', 'skipped'])
+        print(f"[✓] Interactive and piped scripts skipped")
+
+    def test_llm_errors_reported_per_command(self):
+        """Test that an API failure is recorded on the command instead of aborting."""
+        def failing(client, user_msg, n=1, temperature=0.3):
+            raise RuntimeError('backend down')
+
+        patch.create_fix_completions = failing
+        summary, results = self.run_batch('false\ntrue\n')
+        self.assertIn('backend down', results[0]['llm_error'])
+        self.assertEqual(results[1]['status'], 'ok')
+        self.assertEqual(sum(summary.values()), 2)
+        print(f"[✓] LLM errors reported per command")
+
+    def test_runs_concurrently(self):
+        """Test that --jobs runs commands in parallel."""
+        start = time.monotonic()
+        self.run_batch('sleep 0.4\n' * 8, jobs=8)
+        self.assertLess(time.monotonic() - start, 1.6)
+        print(f"[✓] Batch runs concurrently")
+
+    def test_batch_options_parsed(self):
+        """Test --batch, --jobs and --order parsing."""
+        options, args = patch.parse_cli_options(['--batch', 'cmds.txt', '--jobs=3', '--order', 'completion'])
+        self.assertEqual((options['batch'], options['jobs'], options['order']), ('cmds.txt', 3, 'completion'))
+        self.assertEqual(args, [])
+        print(f"[✓] Batch options parsed")
+
+
+class TestShellIntegration(unittest.TestCase):
+    """Test the shell hooks and diagnosing from their spool."""
+
+    def setUp(self):
+        import tempfile
+        self.spool = tempfile.mkdtemp()
+        self.history = patch.HISTORY_ENABLED
+        patch.HISTORY_ENABLED = False
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spool, ignore_errors=True)
+        patch.HISTORY_ENABLED = self.history
+
+    def write_record(self, status, cwd, command, stderr=None):
+        with open(os.path.join(self.spool, 'last'), 'wb') as f:
+            f.write(f'{status}\0{cwd}\0{command}'.encode())
+        if stderr is not None:
+            with open(os.path.join(self.spool, 'last.stderr'), 'wb') as f:
+                f.write(stderr)
+
+    def test_hook_scripts_are_valid_shell(self):
+        """Test that the bash hook parses and unknown shells are refused."""
+        import subprocess
+        script = patch.shell_init_script('bash')
+        self.assertIn('PROMPT_COMMAND', script)
+        self.assertIn(' vim ', script)
+        self.assertEqual(subprocess.run(['bash', '-n'], input=script, text=True).returncode, 0)
+        self.assertIn('add-zsh-hook precmd', patch.shell_init_script('zsh'))
+        self.assertIsNone(patch.shell_init_script('fish'))
+        print(f"[✓] Hook scripts are valid shell")
+
+    def test_read_spooled_failure(self):
+        """Test loading the recorded command, exit code, cwd and stderr."""
+        self.write_record(127, '/srv/app', '\t dockr ps\n', b'bash: dockr: command not found\n')
+        failure = patch.read_spooled_failure(self.spool)
+        self.assertEqual(failure['command'], 'dockr ps')
+        self.assertEqual(failure['returncode'], 127)
+        self.assertEqual(failure['cwd'], '/srv/app')
+        self.assertIn('command not found', failure['output'])
+        print(f"[✓] Spooled failure loaded")
+
+    def test_spooled_stderr_is_tail_only(self):
+        """Test that a huge stderr is read from its tail, on a line boundary."""
+        lines = b''.join(b'noise line %d\n' % i for i in range(20000)) + b'fatal: the real error\n'
+        self.write_record(1, '/', 'make', lines)
+        output = patch.read_spooled_failure(self.spool)['output']
+        self.assertLessEqual(len(output), patch.SPOOL_TAIL_BYTES)
+        self.assertTrue(output.startswith('noise line'))
+        self.assertTrue(output.endswith('fatal: the real error\n'))
+        print(f"[✓] Spooled stderr read tail-only")
+
+    def test_missing_or_cleared_spool(self):
+        """Test that no record, or a cleared one, means nothing to diagnose."""
+        self.assertIsNone(patch.read_spooled_failure(self.spool))
+        self.write_record(2, '/', 'ls /nope', b'')
+        patch.clear_spooled_failure(self.spool)
+        self.assertIsNone(patch.read_spooled_failure(self.spool))
+        print(f"[✓] Missing or cleared spool ignored")
+
+    def test_fix_loop_skips_first_run(self):
+        """Test that a spooled failure is diagnosed without running the command again."""
+        import io
+        from contextlib import redirect_stdout
+        calls = []
+        originals = (patch.execute_command, patch.get_validated_fix, patch.interactive_menu)
+        patch.execute_command = lambda *args, **kwargs: calls.append(args) or (0, '', False)
+        patch.get_validated_fix = lambda output, *args: calls.append(output) or ('ls', '90', '', '')
+        patch.interactive_menu = lambda: 4
+        try:
+            with redirect_stdout(io.StringIO()):
+                patch.run_fix_loop({'sandbox': 0, 'timeout': None, 'idle_timeout': None},
+                                   'ls /nope', 'original', [], initial=(2, 'ls: cannot access'))
+        finally:
+            patch.execute_command, patch.get_validated_fix, patch.interactive_menu = originals
+        self.assertEqual(calls, ['ls: cannot access'])
+        print(f"[✓] Fix loop skips the first run")
+
+    def test_retry_records_one_attempt(self):
+        """Test that choosing Retry and running the fix is one applied history entry, not two."""
+        import io
+        from contextlib import redirect_stdout
+        results = iter([(2, 'ls: cannot access', False), (0, '', False)])
+        recorded = []
+        with mock.patch.object(patch, 'execute_command', lambda *args, **kwargs: next(results)), \
+                mock.patch.object(patch, 'get_validated_fix', lambda *args: ('ls /', '90', '', '')), \
+                mock.patch.object(patch, 'interactive_menu', lambda: 1), \
+                mock.patch.object(patch, 'user_input', lambda prompt='': 'y'), \
+                mock.patch.object(patch, 'record_attempt', lambda **kwargs: recorded.append(kwargs)), \
+                redirect_stdout(io.StringIO()):
+            fixed = patch.run_fix_loop({'sandbox': 0, 'timeout': None, 'idle_timeout': None},
+                                       'ls /nope', 'original', [])
+        self.assertTrue(fixed)
+        self.assertEqual([(r['suggestion'], r['applied'], r['returncode']) for r in recorded], [('ls /', True, 0)])
+        print(f"[✓] Retry records one attempt")
+
+    def test_bash_hook_records_failure(self):
+        """Test the bash hook in a real interactive shell, including a pipeline."""
+        import pty
+        import select
+        import shutil
+        import subprocess
+        if not shutil.which('bash'):
+            self.skipTest('bash not installed')
+        home = os.path.join(self.spool, 'home')
+        env = dict(os.environ, PATCH_HOME=home, PS1='$ ', HOME=self.spool)
+        script = subprocess.run([sys.executable, patch.__file__, '--shell-init', 'bash'],
+                                capture_output=True, text=True, env=env).stdout
+        init = os.path.join(self.spool, 'init.sh')
+        with open(init, 'w') as f:
+            f.write(script)
+        pid, fd = pty.fork()
+        if pid == 0:
+            try:
+                os.execve(shutil.which('bash'), ['bash', '--norc', '-i'], env)
+            finally:
+                os._exit(127)
+        lines = [f'source {init}', 'cat /nonexistent-hook | grep x', 'echo ok', 'exit 0']
+        for line in lines:
+            os.write(fd, (line + '\n').encode())
+            time.sleep(0.3)
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if select.select([fd], [], [], 0.2)[0]:
+                try:
+                    if not os.read(fd, 4096):
+                        break
+                except OSError:
+                    break
+        os.waitpid(pid, 0)
+        os.close(fd)
+        failure = patch.read_spooled_failure(os.path.join(home, 'spool', str(pid)))
+        self.assertEqual(failure['command'], 'cat /nonexistent-hook | grep x')
+        self.assertEqual(failure['returncode'], 1)
+        self.assertIn('/nonexistent-hook', failure['output'])
+        print(f"[✓] Bash hook records failure")
+
+
+class TestUnattendedMode(unittest.TestCase):
+    """Test the prompt-free --yes/--json fix loop and its policy."""
+
+    def setUp(self):
+        self.original = patch.create_fix_completions
+        self.telemetry, self.history = patch.TELEMETRY_ENABLED, patch.HISTORY_ENABLED
+        patch.TELEMETRY_ENABLED = patch.HISTORY_ENABLED = False
+        self.reply = 'true:::90:::missing path:::Nothing to list.'
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: [self.reply]
+
+    def tearDown(self):
+        patch.create_fix_completions = self.original
+        patch.TELEMETRY_ENABLED, patch.HISTORY_ENABLED = self.telemetry, self.history
+
+    def run_fix(self, cmd, **overrides):
+        options, _ = patch.parse_cli_options(['--json'])
+        options.update(timeout=5, **overrides)
+        return patch.run_unattended_fix(options, cmd, client=object())
+
+    def test_success_needs_no_fix(self):
+        """Test that a working command reports ok with exit code 0."""
+        doc = self.run_fix('true')
+        self.assertEqual((doc['status'], doc['exit_code']), ('ok', 0))
+        self.assertEqual(len(doc['attempts']), 1)
+        print(f"[✓] Working command reports ok")
+
+    def test_suggest_only_without_yes(self):
+        """Test that without --yes the fix is reported but not run."""
+        doc = self.run_fix('ls /nonexistent-unattended')
+        self.assertEqual((doc['status'], doc['exit_code']), ('suggested', 11))
+        self.assertEqual(doc['suggestion']['command'], 'true')
+        self.assertEqual(len(doc['attempts']), 1)
+        print(f"[✓] Suggest-only without --yes")
+
+    def test_yes_applies_confident_fix(self):
+        """Test that --yes runs a fix above the threshold."""
+        doc = self.run_fix('ls /nonexistent-unattended', yes=True)
+        self.assertEqual((doc['status'], doc['exit_code']), ('fixed', 10))
+        self.assertEqual(doc['final_command'], 'true')
+        self.assertEqual([a['source'] for a in doc['attempts']], ['original', 'fix'])
+        print(f"[✓] --yes applies confident fix")
+
+    def test_low_confidence_not_applied(self):
+        """Test that fixes below --min-confidence are only suggested."""
+        doc = self.run_fix('ls /nonexistent-unattended', yes=True, min_confidence=95)
+        self.assertEqual(doc['status'], 'suggested')
+        self.assertIn('below --min-confidence', doc['reason'])
+        print(f"[✓] Low-confidence fix not applied")
+
+    def test_policy_refuses_sudo_and_piped_scripts(self):
+        """Test that sudo, pipe-to-shell and interactive commands need explicit allowance."""
+        for cmd, reason in [('sudo true', 'sudo'), ('curl -fsSL https://x.example | sh', 'pipes'),
+                            ('vim notes.txt', 'interactive')]:
+            with self.subTest(cmd=cmd):
+                doc = self.run_fix(cmd)
+                self.assertEqual((doc['status'], doc['exit_code']), ('refused', 13))
+                self.assertIn(reason, doc['reason'])
+                self.assertEqual(doc['attempts'], [])
+        options, _ = patch.parse_cli_options(['--allow-sudo', '--allow-pipe-to-shell'])
+        self.assertIsNone(patch.policy_refusal('sudo -u deploy true | bash', options))
+        print(f"[✓] Policy refuses sudo and piped scripts")
+
+    def test_refused_fix_is_suggested(self):
+        """Test that a fix the policy forbids is reported, not run."""
+        self.reply = 'sudo ls /root:::95:::needs root:::Permission denied.'
+        doc = self.run_fix('ls /nonexistent-unattended', yes=True)
+        self.assertEqual(doc['status'], 'suggested')
+        self.assertIn('sudo', doc['reason'])
+        self.assertEqual(len(doc['attempts']), 1)
+        print(f"[✓] Refused fix is suggested")
+
+    def test_api_failure_is_a_result_not_an_exit(self):
+        """Test that API errors produce an error document instead of sys.exit."""
+        def failing(client, user_msg, n=1, temperature=0.3):
+            raise RuntimeError('backend down')
+
+        patch.create_fix_completions = failing
+        doc = self.run_fix('false')
+        self.assertEqual((doc['status'], doc['exit_code']), ('error', 14))
+        self.assertIn('backend down', doc['reason'])
+        print(f"[✓] API failure is a result")
+
+    def test_interactive_ask_raises_instead_of_exiting(self):
+        """Test that the spinner path raises FixRequestError rather than calling sys.exit."""
+        import io
+        from contextlib import redirect_stdout
+
+        def failing(client, user_msg, n=1, temperature=0.3):
+            raise RuntimeError('backend down')
+
+        patch.create_fix_completions = failing
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(patch.FixRequestError) as raised:
+                patch.request_fix_completions('prompt', api_key='sk-test-key-not-used-000000')
+        self.assertIn('Unexpected error: backend down', raised.exception.lines[0])
+        print(f"[✓] Ask path raises FixRequestError")
+
+    def test_missing_key_raises_without_prompting(self):
+        """Test that the ask path reports a missing key instead of prompting or exiting."""
+        with mock.patch.dict(os.environ), mock.patch.object(patch, 'user_input', side_effect=AssertionError):
+            os.environ.pop('OPENAI_API_KEY', None)
+            with self.assertRaises(patch.FixRequestError) as raised:
+                patch.request_fix_completions('prompt')
+        self.assertEqual(raised.exception.lines[0], 'OpenAI API key not found.')
+        print(f"[✓] Missing key raises without prompting")
+
+    def test_exit_codes_distinct(self):
+        """Test that every outcome has its own exit code."""
+        codes = list(patch.UNATTENDED_EXIT_CODES.values())
+        self.assertEqual(len(codes), len(set(codes)))
+        print(f"[✓] Exit codes distinct")
+
+
+class TestLogDiagnosis(unittest.TestCase):
+    """Test single-pass error region detection for --from-stdin."""
+
+    def scan(self, text, chunk_size=patch.LOG_CHUNK_BYTES):
+        import io
+        return patch.scan_log(io.BytesIO(text.encode()), chunk_size)
+
+    def test_region_with_context(self):
+        """Test that an error line is kept with lines before and after it."""
+        log = ''.join(f'step {i} ok\n' for i in range(100))
+        log += "\x1b[31mERROR\x1b[0m: No such file or directory: 'config.yml'\n"
+        log += ''.join(f'cleanup {i}\n' for i in range(50))
+        scanner = self.scan(log)
+        self.assertEqual(scanner.lines, 151)
+        self.assertEqual(scanner.error_lines, 1)
+        region = scanner.regions[0]
+        self.assertEqual((region['start'], region['end']), (96, 111))
+        self.assertIn("ERROR: No such file or directory", region['text'])
+        self.assertNotIn('\x1b', region['text'])
+        self.assertTrue(region['category'].startswith('file_not_found'))
+        print(f"[✓] Error region kept with context")
+
+    def test_keeps_first_and_last_regions(self):
+        """Test that memory is bounded to the first and last few regions."""
+        log = ''.join(f'line {i}\n' + ('fatal: failure %d\n' % i if i % 100 == 0 else '') for i in range(1000))
+        scanner = self.scan(log)
+        self.assertEqual(scanner.region_count, 10)
+        self.assertEqual(len(scanner.regions), patch.LOG_MAX_REGIONS)
+        self.assertIn('failure 0', scanner.regions[0]['text'])
+        self.assertIn('failure 900', scanner.regions[-1]['text'])
+        self.assertLessEqual(len(patch.log_excerpt(scanner)), patch.LOG_PROMPT_CHARS + 500)
+        print(f"[✓] First and last regions kept")
+
+    def test_chunk_boundaries_do_not_matter(self):
+        """Test that tiny chunks split mid-line give the same regions."""
+        log = ''.join(f'compiling module_{i}.c\n' for i in range(300))
+        log += 'ModuleNotFoundError: No module named requests\n' + 'done\n' * 20
+        big, small = self.scan(log), self.scan(log, chunk_size=7)
+        self.assertEqual(big.lines, small.lines)
+        self.assertEqual([(r['start'], r['end'], r['text']) for r in big.regions],
+                         [(r['start'], r['end'], r['text']) for r in small.regions])
+        self.assertEqual(big.error_lines, 1)
+        print(f"[✓] Chunk boundaries do not matter")
+
+    def test_huge_line_not_buffered(self):
+        """Test that a newline-free stream is cut instead of buffered whole."""
+        scanner = patch.LogScanner()
+        for _ in range(5):
+            scanner.feed(b'x' * patch.LOG_CHUNK_BYTES)
+            self.assertLess(len(scanner._carry), 2 * patch.LOG_CHUNK_BYTES)
+        scanner.finish()
+        self.assertEqual(scanner.bytes, 5 * patch.LOG_CHUNK_BYTES)
+        print(f"[✓] Huge line not buffered")
+
+    def test_long_lines_scan_in_linear_time(self):
+        """Test that long minified-style lines cannot make the rule matching backtrack."""
+        for line in ['module not ' * 5000, 'a.b(c,d);module' * 20000, 'x' * 200000 + ' error']:
+            with self.subTest(line=line[:20]):
+                start = time.monotonic()
+                scanner = self.scan(line + '\n')
+                self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(scanner.error_lines, 1)
+        print(f"[✓] Long lines scanned in linear time")
+
+    def test_markers_respect_word_boundaries(self):
+        """Test that generic markers match whole words, like the regexes they replace."""
+        scanner = self.scan('0 errors, 0 failures\nstderr redirected\nError: boom\nexit code 0\nexit status 2\n')
+        self.assertEqual(scanner.error_lines, 2)
+        self.assertIn('Error: boom', scanner.regions[0]['text'])
+        print(f"[✓] Markers respect word boundaries")
+
+    def test_every_rule_has_a_trigger_word(self):
+        """Test that no rule or marker is searched for in blocks without its trigger word."""
+        self.assertEqual([m for m in patch._LOG_MATCHERS if m[0] is None], [])
+        self.assertEqual(patch._split_alternatives(r'a(b|c)|[|]d|e\|f'), ['a(b|c)', '[|]d', 'e\\|f'])
+        print(f"[✓] Every rule has a trigger word")
+
+    def test_clean_log_needs_no_model(self):
+        """Test that a log without errors exits ok without asking the model."""
+        import io
+        from contextlib import redirect_stdout
+        import json
+        options, _ = patch.parse_cli_options(['--from-stdin', '--json'])
+        stream = io.BytesIO(b'build started\nall tests passed\n')
+        out = io.StringIO()
+        with redirect_stdout(out):
+            with self.assertRaises(SystemExit) as exited:
+                patch.log_main(options, None, stream)
+        self.assertEqual(exited.exception.code, 0)
+        doc = json.loads(out.getvalue())
+        self.assertEqual((doc['status'], doc['lines'], doc['regions']), ('ok', 2, []))
+        print(f"[✓] Clean log needs no model")
+
+
+class TestFollowMode(unittest.TestCase):
+    """Test log tailing, rotation handling and error dedup for --follow."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'app.log')
+        self.regions = []
+        self.write('old error: ignored because it predates --follow\n', 'w')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text, mode='a'):
+        with open(self.path, mode) as f:
+            f.write(text)
+
+    def follow(self):
+        return patch.FollowedFile(self.path, self.regions.append)
+
+    def test_fingerprint_masks_numbers_and_ids(self):
+        """Test that errors differing only in numbers and ids share a fingerprint."""
+        a = patch.error_fingerprint(['ERROR: connection refused to 10.0.0.1:5432 (req 3f2a9c1d7e)'])
+        b = patch.error_fingerprint(['error: connection refused to 10.0.0.7:6543 (req 0bd14ee290)'])
+        c = patch.error_fingerprint(['ERROR: permission denied: /var/lib/app'])
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        print(f"[✓] Fingerprints ignore numbers and ids")
+
+    def test_appended_lines_only(self):
+        """Test that only lines written after startup are scanned."""
+        followed = self.follow()
+        self.write('step 1\nfatal: disk full\n' + 'step\n' * 20)
+        followed.poll()
+        self.assertEqual(len(self.regions), 1)
+        self.assertEqual(self.regions[0]['errors'], ['fatal: disk full'])
+        self.assertEqual(self.regions[0]['start'], 1)
+        followed.close()
+        print(f"[✓] Appended lines scanned")
+
+    def test_long_line_does_not_block_polling(self):
+        """Test that a long minified line appended to a followed file is scanned quickly."""
+        followed = self.follow()
+        self.write('module not ' * 5000 + '\n' + 'a.b(c,d);' * 20000 + '\nfatal: disk full\n' + 'step\n' * 20)
+        start = time.monotonic()
+        followed.poll()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(len(self.regions), 1)
+        self.assertEqual(self.regions[0]['errors'], ['fatal: disk full'])
+        followed.close()
+        print(f"[✓] Long line does not block polling")
+
+    def test_idle_flush_closes_region(self):
+        """Test that a region waiting for context can be closed early."""
+        followed = self.follow()
+        self.write('Traceback (most recent call last):\nKeyError: 42\n')
+        followed.poll()
+        self.assertEqual(self.regions, [])
+        self.assertTrue(followed.scanner.pending)
+        followed.scanner.flush()
+        self.assertEqual(len(self.regions), 1)
+        followed.close()
+        print(f"[✓] Idle flush closes region")
+
+    def test_rotation_by_rename(self):
+        """Test that the old file is drained and the new one read from the top."""
+        followed = self.follow()
+        self.write('fatal: before rotation\n')
+        os.rename(self.path, self.path + '.1')
+        self.write('fatal: after rotation\n', 'w')
+        followed.poll()
+        followed.scanner.flush()
+        self.assertEqual([r['errors'][0] for r in self.regions], ['fatal: before rotation', 'fatal: after rotation'])
+        self.assertEqual(self.regions[1]['start'], 1)
+        followed.close()
+        print(f"[✓] Rotation followed")
+
+    def test_missing_file_waits_for_creation(self):
+        """Test that a path deleted and recreated later is picked up."""
+        followed = self.follow()
+        os.unlink(self.path)
+        self.assertEqual(followed.poll(), 0)
+        self.write('fatal: recreated\n', 'w')
+        followed.poll()
+        followed.scanner.flush()
+        self.assertEqual(self.regions[0]['errors'], ['fatal: recreated'])
+        followed.close()
+        print(f"[✓] Recreated file picked up")
+
+    def test_truncation(self):
+        """Test that copytruncate restarts reading from the beginning."""
+        followed = self.follow()
+        self.write('padding line\n' * 10)
+        followed.poll()
+        self.write('fatal: after truncate\n', 'w')
+        followed.poll()
+        followed.scanner.flush()
+        self.assertEqual(self.regions[0]['errors'], ['fatal: after truncate'])
+        followed.close()
+        print(f"[✓] Truncation handled")
+
+    def test_tracker_dedups_and_reports_repeats(self):
+        """Test that a fingerprint is diagnosed once and repeats are batched."""
+        now = [0.0]
+        tracker = patch.ErrorTracker(clock=lambda: now[0])
+        self.assertEqual(tracker.observe('abc')[0], 'diagnose')
+        for _ in range(5):
+            now[0] += 1
+            self.assertIsNone(tracker.observe('abc')[0])
+        now[0] += patch.FOLLOW_REPEAT_SECONDS
+        action, state = tracker.observe('abc')
+        self.assertEqual((action, state['unreported'], state['count']), ('repeat', 6, 7))
+        print(f"[✓] Repeats deduplicated")
+
+    def test_tracker_rate_limit(self):
+        """Test that new fingerprints beyond the rate limit are not diagnosed until they recur."""
+        now = [0.0]
+        tracker = patch.ErrorTracker(clock=lambda: now[0])
+        actions = [tracker.observe(f'fp{i}')[0] for i in range(patch.FOLLOW_DIAGNOSES_PER_MINUTE + 2)]
+        self.assertEqual(actions.count('diagnose'), patch.FOLLOW_DIAGNOSES_PER_MINUTE)
+        self.assertEqual(actions[-2:], ['limited', 'limited'])
+        now[0] += 60.0
+        self.assertEqual(tracker.observe(f'fp{patch.FOLLOW_DIAGNOSES_PER_MINUTE}')[0], 'diagnose')
+        print(f"[✓] Diagnoses rate limited")
+
+    def test_inotify_reports_changes(self):
+        """Test the ctypes inotify binding where the kernel supports it."""
+        import select
+        try:
+            inotify = patch.Inotify()
+        except OSError:
+            self.skipTest('inotify not available')
+        try:
+            inotify.add_watch(self.tmp.name, patch.FOLLOW_WATCH_MASK)
+            self.write('hello\n')
+            self.assertTrue(select.select([inotify], [], [], 2)[0])
+            events = inotify.read_events()
+            self.assertIn('app.log', [name for _, _, name in events])
+            self.assertTrue(any(mask & patch.IN_MODIFY for _, mask, _ in events))
+        finally:
+            inotify.close()
+        print(f"[✓] inotify events received")
+
+
+class TestFixService(unittest.TestCase):
+    """Test the patch serve HTTP/JSON API, its cache and its backpressure."""
+
+    def setUp(self):
+        import threading
+        self.original = patch.create_fix_completions
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+        def fake_completions(client, user_msg, n=1, temperature=0.3):
+            self.calls.append(user_msg)
+            self.gate.wait(5)
+            return ['git status:::95:::typo:::gti is a typo of git.']
+
+        patch.create_fix_completions = fake_completions
+        self.history = patch.HISTORY_ENABLED
+        patch.HISTORY_ENABLED = False
+        self.start(jobs=2, queue=2)
+
+    def start(self, jobs, queue):
+        import threading
+        self.service = patch.FixService(object(), jobs, queue)
+        self.server = patch.make_fix_server(self.service, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+    def tearDown(self):
+        self.stop()
+        patch.create_fix_completions = self.original
+        patch.HISTORY_ENABLED = self.history
+
+    def request(self, method, path, body=None):
+        import http.client
+        import json
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        try:
+            data = body if isinstance(body, (str, type(None))) else json.dumps(body)
+            conn.request(method, path, data, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read()), response
+        finally:
+            conn.close()
+
+    def test_fix_and_cache(self):
+        """Test that a fix is returned and an identical request is answered from cache."""
+        body = {'command': 'gti status', 'error': 'gti: command not found', 'context': {'shell': 'zsh'}}
+        status, doc, _ = self.request('POST', '/fix', body)
+        self.assertEqual(status, 200)
+        self.assertEqual((doc['fix'], doc['confidence'], doc['cached']), ('git status', 95, False))
+        self.assertIn('shell: zsh', self.calls[0])
+        status, doc, _ = self.request('POST', '/fix', body)
+        self.assertEqual((status, doc['cached']), (200, True))
+        self.assertEqual(len(self.calls), 1)
+        _, health, _ = self.request('GET', '/health')
+        self.assertEqual((health['requests'], health['cache_hits'], health['cache_size']), (2, 1, 1))
+        print(f"[✓] Fix served and cached")
+
+    def test_server_file_system_stays_out_of_prompts(self):
+        """Test that a remote command's prompt does not describe the server's own files."""
+        body = {'command': f'cat {os.getcwd()}/requests.txt', 'error': 'cat: No such file or directory'}
+        status, _, _ = self.request('POST', '/fix', body)
+        self.assertEqual(status, 200)
+        self.assertIn(patch.REMOTE_FILE_SYSTEM_CONTEXT, self.calls[0])
+        self.assertNotIn('Current working directory', self.calls[0])
+        self.assertNotIn('Contents of parent directory', self.calls[0])
+        print(f"[✓] Server file system stays out of prompts")
+
+    def test_answers_are_not_checked_against_the_server(self):
+        """Test that a fix using a program the server lacks is not rejected (only syntax is checked)."""
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: (
+            self.calls.append(user_msg) or ['not-on-this-server-xyz get pods --no-such-flag:::90:::x:::y'])
+        status, doc, _ = self.request('POST', '/fix', {'command': 'not-on-this-server-xyz get pod',
+                                                        'error': 'error: the server doesn\'t have a resource type'})
+        self.assertEqual(status, 200)
+        self.assertEqual(doc['fix'], 'not-on-this-server-xyz get pods --no-such-flag')
+        self.assertNotIn('rejected', doc)
+        self.assertEqual(len(self.calls), 1)
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: ['echo "broken:::90:::x:::y']
+        _, doc, _ = self.request('POST', '/fix', {'command': 'echo', 'error': 'unterminated'})
+        self.assertIn('syntax error', doc['rejected'][0]['problems'][0])
+        print(f"[✓] Answers are not checked against the server")
+
+    def test_bad_requests(self):
+        """Test that malformed requests get 4xx answers without calling the model."""
+        self.assertEqual(self.request('POST', '/fix', {'error': 'x'})[0], 400)
+        self.assertEqual(self.request('POST', '/fix', '{not json')[0], 400)
+        self.assertEqual(self.request('POST', '/fix', {'command': 'ls', 'timeout': 0})[0], 400)
+        self.assertEqual(self.request('POST', '/nope', {'command': 'ls'})[0], 404)
+        self.assertEqual(self.calls, [])
+        print(f"[✓] Bad requests rejected")
+
+    def test_backpressure(self):
+        """Test that requests beyond jobs + queue get 503 with Retry-After."""
+        import threading
+        self.stop()
+        self.gate.clear()
+        self.start(jobs=1, queue=0)
+        first = threading.Thread(target=self.request, args=('POST', '/fix', {'command': 'gti one'}))
+        first.start()
+        while not self.calls:
+            time.sleep(0.01)
+        status, doc, response = self.request('POST', '/fix', {'command': 'gti two'})
+        self.assertEqual(status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '1')
+        self.gate.set()
+        first.join()
+        while self.service.in_flight:
+            time.sleep(0.01)
+        self.assertEqual(self.request('POST', '/fix', {'command': 'gti two'})[0], 200)
+        print(f"[✓] Backpressure with 503")
+
+    def test_timeout_then_cached_retry(self):
+        """Test that a slow answer gives 504 and is then served from cache."""
+        self.gate.clear()
+        body = {'command': 'gti log', 'error': 'gti: command not found', 'timeout': 0.2}
+        self.assertEqual(self.request('POST', '/fix', body)[0], 504)
+        self.gate.set()
+        while self.service.in_flight:
+            time.sleep(0.01)
+        status, doc, _ = self.request('POST', '/fix', body)
+        self.assertEqual((status, doc['cached']), (200, True))
+        self.assertEqual(len(self.calls), 1)
+        print(f"[✓] Timeout answered 504, retry cached")
+
+    def test_model_failure_is_502(self):
+        """Test that a failed model call is reported and not cached."""
+        def failing(client, user_msg, n=1, temperature=0.3):
+            raise RuntimeError('backend down')
+
+        patch.create_fix_completions = failing
+        status, doc, _ = self.request('POST', '/fix', {'command': 'gti diff'})
+        self.assertEqual(status, 502)
+        self.assertIn('backend down', doc['error'])
+        self.assertEqual(len(self.service.cache), 0)
+        print(f"[✓] Model failure answered 502")
+
+
+class TestErrorCorpus(unittest.TestCase):
+    """Test that the labelled corpus is well formed and its manifest is current."""
+
+    CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+    def test_manifest_matches_files(self):
+        """Test that every corpus file still has the checksum its manifest version records."""
+        import hashlib
+        import json
+        with open(os.path.join(self.CORPUS, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertIsInstance(manifest['version'], int)
+        for name, entry in manifest['files'].items():
+            with open(os.path.join(self.CORPUS, name), 'rb') as f:
+                data = f.read()
+            self.assertEqual(hashlib.sha256(data).hexdigest(), entry['sha256'],
+                             f'{name} changed: bump the manifest version and its sha256')
+            self.assertEqual(data.count(b'\n'), entry['examples'])
+        print(f"[✓] Corpus manifest is current")
+
+    def test_entries_are_labelled(self):
+        """Test that entries carry a known category, app and fix and cover test_scenarios.py."""
+        examples = patch.load_error_corpus(os.path.join(self.CORPUS, 'errors.jsonl'))
+        known = {category.split(':')[0] for _, category in patch.ERROR_TYPE_RULES if category}
+        apps = set(patch.detector_tables().apps.values())
+        for example in examples:
+            self.assertIn(example['category'], known | {'daemon_not_running', 'other'})
+            self.assertTrue(example['app'] is None or example['app'] in apps, example['app'])
+            self.assertIn('fix', example)
+        scenarios = {e['scenario'] for e in examples if e.get('scenario')}
+        self.assertIn('test_scenarios.py::TestDockerScenarios.test_docker_socket_error', scenarios)
+        print(f"[✓] Corpus entries are labelled")
+
+
+def numpy_available():
+    try:
+        import numpy  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+@unittest.skipUnless(numpy_available(), 'NumPy not installed')
+class TestLocalClassifier(unittest.TestCase):
+    """Test the trainable naive Bayes error classifier behind patch train."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.examples = patch.load_error_corpus(patch.CLASSIFIER_CORPUS)
+        cls.classifier = patch.ErrorClassifier.train(cls.examples)
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'classifier.npz')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        patch.local_classifier.cache_clear()
+
+    def test_classifies_phrasings_rules_miss(self):
+        """Test that the model labels errors the rules call other."""
+        error = 'E: Unable to locate package libfoo-dev'
+        self.assertTrue(categorize_error_type(error, 'apt install libfoo-dev').startswith('other'))
+        self.assertEqual(self.classifier.classify(error, 'apt install libfoo-dev')[0], 'dependency_missing')
+        self.assertEqual(self.classifier.classify('curl: (6) Could not resolve host: example.org')[0],
+                         'network_error')
+        print(f"[✓] Model labels phrasings the rules miss")
+
+    def test_batch_matches_single(self):
+        """Test that vectorised batch inference agrees with one-at-a-time."""
+        texts = [example['error'] for example in self.examples[:50]] + ['']
+        commands = [example['command'] for example in self.examples[:50]] + ['']
+        batch = self.classifier.classify_batch(texts, commands)
+        for (category, confidence), text, command in zip(batch, texts, commands):
+            single = self.classifier.classify(text, command)
+            self.assertEqual(category, single[0])
+            self.assertAlmostEqual(confidence, single[1], places=4)
+        print(f"[✓] Batch inference matches single")
+
+    def test_confident_model_answers_before_rules(self):
+        """Test that a saved model's confident answer comes first and the rules decide the rest."""
+        self.classifier.save(self.path)
+        with mock.patch.dict(os.environ, {'PATCH_CLASSIFIER': self.path}):
+            patch.local_classifier.cache_clear()
+            self.assertEqual(categorize_error_type('E: Unable to locate package libfoo', 'apt install libfoo'),
+                             'dependency_missing: Required package not available')
+            self.assertEqual(categorize_error_type('cat: x: Permission denied', 'cat x'),
+                             'permission_denied: User lacks required permissions')
+            # patch's own timeout marker is not up to the model
+            timed_out = 'E: Unable to locate package libfoo\n[patch] Command timed out after 5s, process group terminated'
+            self.assertTrue(categorize_error_type(timed_out, 'apt install libfoo').startswith('timeout:'))
+            self.assertIn('Error type: timeout:', build_fix_prompt(timed_out, 'apt install libfoo'))
+            with mock.patch.object(patch, 'CLASSIFIER_MIN_CONFIDENCE', 1.01):
+                self.assertEqual(categorize_error_type('cat: x: Permission denied', 'cat x'),
+                                 'permission_denied: User lacks required permissions')
+                self.assertEqual(categorize_error_type('E: Unable to locate package libfoo', 'apt install libfoo'),
+                                 'other: General error')
+        with mock.patch.dict(os.environ, {'PATCH_CLASSIFIER': '0'}):
+            patch.local_classifier.cache_clear()
+            self.assertEqual(categorize_error_type('E: Unable to locate package libfoo', 'apt install libfoo'),
+                             'other: General error')
+        print(f"[✓] Confident model answers before the rules")
+
+    def test_report_compares_with_rules(self):
+        """Test that the cross-validated report beats the rules on the shipped corpus."""
+        report, _ = patch.evaluate_classifier(self.examples, batch=100)
+        self.assertEqual(report['examples'], len(self.examples))
+        accuracy = report['accuracy']
+        self.assertGreater(accuracy['rules+model'], accuracy['rules'])
+        # The order patch uses measures best
+        self.assertGreaterEqual(accuracy['model+rules'], max(accuracy['model'], accuracy['rules+model']))
+        self.assertGreater(report['per_second']['model_batch'], 1000)
+        print(f"[✓] Report compares the model with the rules")
+
+    def test_bad_corpus_line_is_reported(self):
+        """Test that a malformed corpus names the offending line."""
+        with open(self.path, 'w') as f:
+            f.write('{"error": "x", "category": "other"}\n{"error": "y"}\n')
+        with self.assertRaisesRegex(ValueError, ':2:'):
+            patch.load_error_corpus(self.path)
+        print(f"[✓] Bad corpus line reported")
+
+
+class TestAttemptHistory(unittest.TestCase):
+    """Test the attempt log, its memory-mapped index and serving remembered fixes."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = patch.AttemptHistory(self.tmp.name)
+        self.error = "bash: gti: command not found"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_known_fix_needs_successes(self):
+        """Test that a fix is served only once it has worked often enough."""
+        self.history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        self.assertIsNone(self.history.known_fix('gti status', self.error))
+        self.history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        self.history.record('gti status', self.error, 'gti --fix', True, 1, 900.0)
+        entry = self.history.known_fix('gti status', self.error)
+        self.assertEqual(entry['fix'], 'git status')
+        self.assertEqual((entry['applied'], entry['succeeded']), (2, 2))
+        self.assertEqual([e['fix'] for e in self.history.ranked('gti status', self.error)],
+                         ['git status', 'gti --fix'])
+        print(f"[✓] Known fix needs successes")
+
+    def test_damaged_index_is_rebuilt(self):
+        """Test that a truncated or garbage index.bin neither crashes nor loses the history."""
+        import io
+        from contextlib import redirect_stderr
+        for _ in range(3):
+            self.history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        self.history.compact()
+        for damage in (b'PHX1\0\0', b'', b'x' * 100):
+            with self.subTest(damage=damage):
+                with open(self.history.index_path, 'wb') as f:
+                    f.write(damage)
+                history = patch.AttemptHistory(self.tmp.name)
+                with redirect_stderr(io.StringIO()) as err:
+                    self.assertEqual(history.known_fix('gti status', self.error)['fix'], 'git status')
+                self.assertIn('Rebuilding damaged history index', err.getvalue())
+                history.compact()
+                self.assertEqual(history._load()[2], 1)
+        print(f"[✓] Damaged history index rebuilt")
+
+    def test_fix_not_shared_across_commands(self):
+        """Test that a fix for one command is not served for another with the same error."""
+        for _ in range(3):
+            self.history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        self.assertIsNone(self.history.known_fix('gti log', self.error))
+        self.assertIsNotNone(self.history.known_fix('gti   status', self.error))
+        print(f"[✓] Fix not shared across commands")
+
+    def test_unapplied_suggestions_are_not_outcomes(self):
+        """Test that declined or interrupted fixes count as suggested, not as failures."""
+        for _ in range(3):
+            self.history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        self.history.record('gti status', self.error, 'git status', False, None, 900.0)
+        self.history.record('gti status', self.error, 'git status', True, None, 900.0)
+        entry = self.history.known_fix('gti status', self.error)
+        self.assertEqual((entry['suggested'], entry['applied'], entry['succeeded']), (5, 3, 3))
+        print(f"[✓] Unapplied suggestions are not outcomes")
+
+    def test_compact_matches_log(self):
+        """Test that lookups agree before and after folding the log into the index."""
+        commands = [f'deploy {name}' for name in ('api', 'web', 'db', 'cache')]
+        for n in range(40):
+            self.history.record(commands[n % 4], 'error: unit failed', f'fix-{n % 3}', True, n % 2, 10.0)
+        keys = [patch.history_key(c, patch.failure_fingerprint('error: unit failed')) for c in commands]
+        before = [self.history.lookup(key) for key in keys]
+        self.history.compact()
+        self.assertEqual([self.history.lookup(key) for key in keys], before)
+        # Rows after the rebuild are merged with indexed ones, by a fresh reader too
+        self.history.record(commands[0], 'error: unit failed', 'fix-0', True, 0, 10.0)
+        self.history.compact()
+        fresh = patch.AttemptHistory(self.tmp.name)
+        self.assertEqual(fresh._load()[2], 12)
+        self.assertEqual(sum(v[1] for v in fresh.lookup(keys[0]).values()), 11)
+        self.assertEqual(fresh.ranked(commands[0], 'error: unit failed'),
+                         self.history.ranked(commands[0], 'error: unit failed'))
+        print(f"[✓] Compacted index matches log")
+
+    def test_unattended_serves_remembered_fix(self):
+        """Test that --yes records outcomes and then skips the model for a proven fix."""
+        import io
+        from contextlib import redirect_stdout
+        calls = []
+        original = patch.create_fix_completions
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: (
+            calls.append(user_msg) or ['true:::90:::missing path:::Nothing to list.'])
+        saved = patch.PATCH_HOME, patch.HISTORY_ENABLED, patch.TELEMETRY_ENABLED
+        patch.PATCH_HOME, patch.HISTORY_ENABLED, patch.TELEMETRY_ENABLED = self.tmp.name, True, False
+        try:
+            for _ in range(3):
+                options, _ = patch.parse_cli_options(['--json', '--yes'])
+                options.update(timeout=5)
+                with redirect_stdout(io.StringIO()):
+                    patch.run_unattended_fix(options, 'ls /definitely-missing-dir', client=object())
+        finally:
+            patch.create_fix_completions = original
+            patch.PATCH_HOME, patch.HISTORY_ENABLED, patch.TELEMETRY_ENABLED = saved
+        self.assertEqual(len(calls), 2)
+        print(f"[✓] Unattended mode serves remembered fix")
+
+
+class TestNegativeCache(unittest.TestCase):
+    """Test that fixes known to fail here are neither asked for nor accepted."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = patch.PATCH_HOME, patch.HISTORY_ENABLED
+        patch.PATCH_HOME, patch.HISTORY_ENABLED = self.tmp.name, True
+        self.error = "bash: gti: command not found"
+        history = patch.attempt_history()
+        history.record('gti status', self.error, 'gti  --fix', True, 1, 900.0)
+        history.record('gti status', self.error, 'gti --fix', True, 127, 900.0)
+        history.record('gti status', self.error, 'git status', True, 0, 900.0)
+        history.record('gti status', self.error, 'gti help', False, None, 900.0)
+
+    def tearDown(self):
+        patch.PATCH_HOME, patch.HISTORY_ENABLED = self.saved
+        self.tmp.cleanup()
+
+    def test_fixes_to_avoid(self):
+        """Test that only run-and-failed fixes and this run's tries are avoided."""
+        avoid = patch.fixes_to_avoid('gti status', self.error, tried=['git stash'])
+        self.assertEqual(avoid, {'gti --fix': 'already failed here 2 times',
+                                 'git stash': 'already failed in this run'})
+        self.assertEqual(patch.fixes_to_avoid('gti log', self.error), {})
+        print(f"[✓] Fixes to avoid")
+
+    def test_known_failure_rejected_and_listed(self):
+        """Test that a known failure is re-asked for and listed as do-not-suggest."""
+        replies = ['gti --fix:::90:::typo:::Retry.', 'git status:::80:::typo:::gti is git.']
+        prompts = []
+        original = patch.create_fix_completions
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: (
+            prompts.append(user_msg) or [replies[len(prompts) - 1]])
+        try:
+            fix, rejected, source = patch.suggest_fix(object(), self.error, 'gti status', tried=['git stash'])
+        finally:
+            patch.create_fix_completions = original
+        self.assertEqual(fix[0], 'git status')
+        self.assertEqual(rejected, [('gti --fix', ['already failed here 2 times'])])
+        self.assertEqual(source, 'model')
+        self.assertIn('DO NOT SUGGEST', prompts[0])
+        self.assertIn('git stash -> already failed in this run', prompts[0])
+        self.assertNotIn('gti help', prompts[0])
+        print(f"[✓] Known failure rejected and listed")
+
+    def test_prompt_list_is_bounded(self):
+        """Test that the do-not-suggest list is capped."""
+        avoid = {f'fix-{i}': 'already failed here once' for i in range(50)}
+        prompt = build_fix_prompt(self.error, 'gti status', avoid=avoid)
+        self.assertEqual(prompt.count('already failed here once'), patch.NEGATIVE_CACHE_PROMPT_FIXES)
+        print(f"[✓] Do-not-suggest list is bounded")
+
+
+class TestFixPacks(unittest.TestCase):
+    """Test building, memory-mapping and consulting fix packs."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = patch.FIXPACK_DIR, patch.HISTORY_ENABLED
+        patch.FIXPACK_DIR, patch.HISTORY_ENABLED = os.path.join(self.tmp.name, 'fixpacks'), False
+        patch.fix_packs.cache_clear()
+
+    def tearDown(self):
+        patch.FIXPACK_DIR, patch.HISTORY_ENABLED = self.saved
+        patch.fix_packs.cache_clear()
+        self.tmp.cleanup()
+
+    def write_source(self, *items, meta=None):
+        import json
+        path = os.path.join(self.tmp.name, 'test.jsonl')
+        with open(path, 'w') as f:
+            f.write(json.dumps(meta or {'pack': 'test', 'version': 3}) + '\n')
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        return path
+
+    def test_build_and_lookup(self):
+        """Test that a built pack is found by error line, first installed program winning."""
+        source = self.write_source(
+            {'errors': ['bash: htop: command not found'], 'fix': 'no-such-manager install htop',
+             'confidence': 88, 'requires': 'definitely-not-a-real-binary-xyz'},
+            {'errors': ['bash: htop: command not found', 'zsh: command not found: htop'],
+             'fix': 'sh -c "install htop"', 'confidence': 80, 'reason': 'missing', 'requires': 'sh'})
+        pack = patch.install_fix_pack(source)
+        self.assertEqual((pack.name, pack.version, pack.count), ('test', 3, 3))
+        records = pack.lookup(patch.fixpack_key('bash: htop: command not found'))
+        self.assertEqual([r[0] for r in records], ['no-such-manager install htop', 'sh -c "install htop"'])
+        # Numbers are masked, as in error fingerprints
+        self.assertEqual(pack.lookup(patch.fixpack_key('bash: line 7: htop: command not found')), [])
+        self.assertEqual(pack.lookup(patch.fixpack_key('nothing like it')), [])
+        fix = patch.packed_fix('htop', 'some noise\nzsh: command not found: htop\n')
+        self.assertEqual(fix[:3], ('sh -c "install htop"', '80', 'missing'))
+        self.assertIn('test fix pack', fix[3])
+        print(f"[✓] Fix pack build and lookup")
+
+    def test_placeholders_and_avoid(self):
+        """Test {args}/{subargs} substitution and that known failures are skipped."""
+        patch.install_fix_pack(self.write_source(
+            {'errors': ['bash: gti: command not found'], 'fix': 'git {args}', 'confidence': 90},
+            {'errors': ["git: 'stauts' is not a git command. See 'git --help'."],
+             'fix': 'git status {subargs}', 'confidence': 92}))
+        self.assertEqual(patch.packed_fix('gti log -1', 'bash: gti: command not found')[0], 'git log -1')
+        error = "git: 'stauts' is not a git command. See 'git --help'.\n\nThe most similar command is\n\tstatus"
+        self.assertEqual(patch.packed_fix('git stauts -s', error)[0], 'git status -s')
+        self.assertIsNone(patch.packed_fix('git stauts -s', error, avoid={'git status -s': 'failed'}))
+        print(f"[✓] Fix pack placeholders and negative cache")
+
+    def test_placeholders_follow_the_parsed_command(self):
+        """Test sudo, env and redirections are kept, and compound or ambiguous commands skip the entry."""
+        patch.install_fix_pack(self.write_source(
+            {'errors': ['bash: gti: command not found'], 'fix': 'git {args}', 'confidence': 90},
+            {'errors': ["git: 'stauts' is not a git command. See 'git --help'."],
+             'fix': 'git status {subargs}', 'confidence': 92}))
+        missing = 'bash: gti: command not found'
+        self.assertEqual(patch.packed_fix('sudo -u bob gti log -1 > out.txt 2>&1', missing)[0],
+                         'sudo -u bob git log -1 > out.txt 2>&1')
+        self.assertEqual(patch.packed_fix('GIT_PAGER=cat gti log "a b"', missing)[0], "GIT_PAGER=cat git log 'a b'")
+        for command in ['cd repo && gti status', 'gti log | head', 'gti log $(cat ref)', 'git log']:
+            with self.subTest(command=command):
+                self.assertIsNone(patch.packed_fix(command, missing))
+        error = "git: 'stauts' is not a git command. See 'git --help'."
+        self.assertIsNone(patch.packed_fix('git -C repo stauts', error))
+        self.assertEqual(patch.packed_fix('sudo git stauts -s', error)[0], 'sudo git status -s')
+        print(f"[✓] Fix pack placeholders follow the parsed command")
+
+    def test_packed_fixes_are_validated(self):
+        """Test that a pack answer failing validate_fix is not returned."""
+        patch.install_fix_pack(self.write_source(
+            {'errors': ['bash: htop: command not found'], 'fix': 'definitely-not-a-real-binary-xyz install htop',
+             'confidence': 95},
+            {'errors': ['bash: htop: command not found'], 'fix': 'echo install htop', 'confidence': 80}))
+        self.assertEqual(patch.packed_fix('htop', 'bash: htop: command not found')[0], 'echo install htop')
+        print(f"[✓] Fix pack answers validated")
+
+    def test_invalid_packs_rejected(self):
+        """Test that bad sources name their line and non-packs are refused."""
+        with self.assertRaisesRegex(ValueError, 'test.jsonl:2'):
+            patch.build_fix_pack(self.write_source({'errors': ['x'], 'confidence': 90}), os.path.join(self.tmp.name, 'x.pfp'))
+        with self.assertRaisesRegex(ValueError, 'test.jsonl:1'):
+            patch.build_fix_pack(self.write_source(meta={'name': 'x'}), os.path.join(self.tmp.name, 'x.pfp'))
+        junk = os.path.join(self.tmp.name, 'junk.pfp')
+        with open(junk, 'wb') as f:
+            f.write(b'not a fix pack at all, not even close')
+        with self.assertRaises(ValueError):
+            patch.install_fix_pack(junk)
+        self.assertEqual(patch.fix_packs(), ())
+        print(f"[✓] Invalid fix packs rejected")
+
+    def test_bundled_pack(self):
+        """Test that the bundled common pack builds and answers a typo without the model."""
+        pack = patch.install_fix_pack(patch.FIXPACK_SOURCE)
+        self.assertGreater(pack.count, 1000)
+        fix, rejected, source = patch.suggest_fix(None, 'bash: gti: command not found', 'gti status')
+        self.assertEqual((fix[0], rejected, source), ('git status', [], 'fixpack'))
+        print(f"[✓] Bundled fix pack")
+
+    def test_unattended_without_api_key(self):
+        """Test that --json diagnoses a packed error with no OPENAI_API_KEY set."""
+        patch.install_fix_pack(self.write_source(
+            {'errors': ['ls: cannot access \'/definitely-missing-dir\': No such file or directory'],
+             'fix': 'true', 'confidence': 95}))
+        options, _ = patch.parse_cli_options(['--json'])
+        options.update(timeout=5)
+        saved_key, saved_telemetry = os.environ.pop('OPENAI_API_KEY', None), patch.TELEMETRY_ENABLED
+        patch.TELEMETRY_ENABLED = False
+        try:
+            doc = patch.run_unattended_fix(options, 'ls /definitely-missing-dir')
+        finally:
+            patch.TELEMETRY_ENABLED = saved_telemetry
+            if saved_key is not None:
+                os.environ['OPENAI_API_KEY'] = saved_key
+        self.assertEqual(doc['status'], 'suggested')
+        self.assertEqual(doc['suggestion']['command'], 'true')
+        print(f"[✓] Unattended mode uses fix packs without an API key")
+
+
+class TestTeamCache(unittest.TestCase):
+    """Test the shared team fix cache: reference store, HTTP protocol, batching and fallback."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = os.environ.get('PATCH_TEAM_CACHE'), patch.HISTORY_ENABLED, patch.FIXPACK_DIR
+        patch.HISTORY_ENABLED, patch.FIXPACK_DIR = False, os.path.join(self.tmp.name, 'fixpacks')
+        patch.fix_packs.cache_clear()
+        patch.team_cache.cache_clear()
+        self.server = None
+
+    def tearDown(self):
+        url, patch.HISTORY_ENABLED, patch.FIXPACK_DIR = self.saved
+        if url is None:
+            os.environ.pop('PATCH_TEAM_CACHE', None)
+        else:
+            os.environ['PATCH_TEAM_CACHE'] = url
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        patch.fix_packs.cache_clear()
+        patch.team_cache.cache_clear()
+        self.tmp.cleanup()
+
+    def start(self, store):
+        import threading
+        self.server = patch.make_cache_server(store, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        os.environ['PATCH_TEAM_CACHE'] = f'http://127.0.0.1:{self.server.server_port}'
+        patch.team_cache.cache_clear()
+
+    def test_store_serves_fixes_that_work(self):
+        """Test that outcomes rank fixes, and unverified fixes and net failures are not served."""
+        store = patch.TeamCacheStore()
+        store.put_many([{'key': 'k', 'fix': 'a', 'confidence': 90}, {'key': 'k', 'fix': 'b', 'confidence': 70}])
+        self.assertEqual(store.get_many(['k']), {})
+        store.put_many([{'key': 'k', 'fix': 'b', 'outcome': 'success'}, {'key': 'k', 'fix': 'zz', 'outcome': 'success'}])
+        self.assertEqual(store.get_many(['k', 'missing'])['k']['fix'], 'b')
+        store.put_many([{'key': 'k', 'fix': 'b', 'outcome': 'failure'}, {'key': 'k', 'fix': 'b', 'outcome': 'failure'}])
+        self.assertEqual(store.get_many(['k']), {})
+        store.put_many([{'key': 'k', 'fix': 'a', 'outcome': 'success'}])
+        self.assertEqual(store.get_many(['k'])['k']['fix'], 'a')
+        store.put_many([{'key': 'k', 'fix': 'a', 'outcome': 'failure'}, {'key': 'k', 'fix': 'a', 'outcome': 'failure'}])
+        self.assertEqual(store.get_many(['k']), {})
+        print(f"[✓] Team cache serves fixes that work")
+
+    def test_store_persists_and_bounds(self):
+        """Test that --store replays its log and old keys are dropped."""
+        path = os.path.join(self.tmp.name, 'cache.jsonl')
+        store = patch.TeamCacheStore(path, size=2)
+        store.put_many([entry for k in ('a', 'b', 'c')
+                        for entry in ({'key': k, 'fix': f'fix {k}'}, {'key': k, 'fix': f'fix {k}', 'outcome': 'success'})])
+        store.close()
+        with open(path, 'a') as f:
+            f.write('{"torn line\n')
+        replayed = patch.TeamCacheStore(path, size=10)
+        self.assertEqual(sorted(replayed.get_many(['a', 'b', 'c'])), ['a', 'b', 'c'])
+        replayed.close()
+        self.assertEqual(sorted(store.get_many(['a', 'b', 'c'])), ['b', 'c'])
+        print(f"[✓] Team cache persists and is bounded")
+
+    def test_read_through_write_back(self):
+        """Test that one engineer's model answer, once it worked, is served to the next without the model."""
+        self.start(patch.TeamCacheStore())
+        calls = []
+        original = patch.create_fix_completions
+        patch.create_fix_completions = lambda client, user_msg, n=1, temperature=0.3: (
+            calls.append(user_msg) or ['git status:::90:::typo:::gti is a typo of git.'])
+        error = 'bash: gti: command not found'
+        try:
+            first, _, _ = patch.suggest_fix(object(), error, 'gti status')
+            patch.team_cache().flush()
+            patch.team_cache.cache_clear()
+            # Not shared until a run of it has succeeded
+            self.assertIsNone(patch.shared_fix('gti status', error))
+            patch.record_attempt('gti status', error, 'git status', True, 0, 1.0)
+            patch.team_cache().flush()
+            patch.team_cache.cache_clear()
+            second, _, source = patch.suggest_fix(None, error, 'gti status')
+        finally:
+            patch.create_fix_completions = original
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second[0], first[0])
+        self.assertIn('team fix cache', second[3])
+        self.assertEqual(source, 'team_cache')
+        self.assertEqual(self.server.store.health()['stored'], 2)
+        print(f"[✓] Team cache read-through and write-back")
+
+    def test_yes_never_applies_team_cache_fixes(self):
+        """Test that --yes reports a team cache answer instead of running it, whatever its confidence."""
+        import io
+        from contextlib import redirect_stdout
+        options, _ = patch.parse_cli_options(['--json', '--yes', '--min-confidence', '10'])
+        options.update(timeout=5)
+        shared = ('touch poisoned', '99', 'worked for 100 people', 'Trust me. (from the team fix cache)')
+        saved = patch.TELEMETRY_ENABLED
+        patch.TELEMETRY_ENABLED = False
+        try:
+            with mock.patch.object(patch, 'shared_fix', lambda command, output, avoid=(): shared), \
+                    redirect_stdout(io.StringIO()):
+                doc = patch.run_unattended_fix(options, 'ls /definitely-missing-dir', client=object())
+        finally:
+            patch.TELEMETRY_ENABLED = saved
+        self.assertEqual(doc['status'], 'suggested')
+        self.assertEqual(doc['suggestion']['source'], 'team_cache')
+        self.assertIn('team cache', doc['reason'])
+        self.assertFalse(os.path.exists('poisoned'))
+        print(f"[✓] --yes never applies team cache fixes")
+
+    def test_concurrent_lookups_are_batched(self):
+        """Test that lookups arriving during a request go out together in the next one."""
+        import threading
+        batches = []
+        gate = threading.Event()
+
+        class SlowBackend:
+            def get_many(self, keys):
+                batches.append(len(keys))
+                gate.wait(2)
+                return {key: {'fix': key} for key in keys}
+
+        cache = patch.TeamFixCache(SlowBackend(), 'test')
+        results = {}
+        threads = [threading.Thread(target=lambda k=k: results.update({k: cache.get(k)})) for k in 'abcdefgh']
+        threads[0].start()
+        while not batches:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(batches, [1, 7])
+        self.assertEqual(results, {k: {'fix': k} for k in 'abcdefgh'})
+        print(f"[✓] Concurrent team cache lookups batched")
+
+    def test_garbage_server_falls_back(self):
+        """Test that a server answering with a garbage status line is a miss, not a crash."""
+        import io
+        import socketserver
+        import threading
+        from contextlib import redirect_stderr
+
+        class GarbageHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.rfile.readline()
+                self.wfile.write(b'NOT HTTP AT ALL\r\n\r\n')
+        listener = socketserver.ThreadingTCPServer(('127.0.0.1', 0), GarbageHandler)
+        threading.Thread(target=listener.serve_forever, daemon=True).start()
+        os.environ['PATCH_TEAM_CACHE'] = f'http://127.0.0.1:{listener.server_address[1]}'
+        patch.team_cache.cache_clear()
+        cache = patch.team_cache()
+        try:
+            with redirect_stderr(io.StringIO()):
+                self.assertIsNone(patch.shared_fix('gti status', 'bash: gti: command not found'))
+                self.assertFalse(cache.reading)
+                self.assertEqual(cache.reads, {})
+                cache.down_until = None
+                patch.share_fix('gti status', 'bash: gti: command not found', ('git status', '90', '', ''))
+                cache.flush()
+                self.assertIsNone(cache.writer)
+                # Writes go out again once the cache is back
+                cache.down_until = None
+                patch.share_fix('gti log', 'bash: gti: command not found', ('git log', '90', '', ''))
+                cache.flush()
+                self.assertIsNone(cache.writer)
+                self.assertFalse(cache.available())
+        finally:
+            listener.shutdown()
+            listener.server_close()
+        print(f"[✓] Garbage team cache server falls back")
+
+    def test_backend_errors_release_waiting_lookups(self):
+        """Test that any backend exception resolves the batch and lets the next lookup lead."""
+        import http.client
+
+        class BrokenBackend:
+            calls = 0
+
+            def get_many(self, keys):
+                self.calls += 1
+                raise http.client.IncompleteRead(b'')
+
+        import io
+        from contextlib import redirect_stderr
+        backend = BrokenBackend()
+        cache = patch.TeamFixCache(backend, 'test')
+        with redirect_stderr(io.StringIO()):
+            start = time.monotonic()
+            self.assertIsNone(cache.get('a'))
+            cache.down_until = None
+            self.assertIsNone(cache.get('b'))
+        self.assertLess(time.monotonic() - start, patch.TEAM_CACHE_TIMEOUT)
+        self.assertEqual((backend.calls, cache.reading, cache.reads), (2, False, {}))
+        print(f"[✓] Team cache backend errors release waiting lookups")
+
+    def test_unreachable_cache_falls_back(self):
+        """Test that a dead cache costs one short timeout and is then skipped."""
+        import io
+        import socket
+        from contextlib import redirect_stderr
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        os.environ['PATCH_TEAM_CACHE'] = f'http://127.0.0.1:{port}'
+        patch.team_cache.cache_clear()
+        stderr = io.StringIO()
+        start = time.monotonic()
+        with redirect_stderr(stderr):
+            self.assertIsNone(patch.shared_fix('gti status', 'bash: gti: command not found'))
+            self.assertIsNone(patch.shared_fix('gti log', 'bash: gti: command not found'))
+        self.assertLess(time.monotonic() - start, patch.TEAM_CACHE_TIMEOUT * 2)
+        self.assertFalse(patch.team_cache().available())
+        self.assertEqual(stderr.getvalue().count('local-only'), 1)
+        print(f"[✓] Unreachable team cache falls back to local-only")
+
+    def test_server_rejects_bad_requests(self):
+        """Test the reference server's validation."""
+        import http.client
+        import json
+        self.start(patch.TeamCacheStore())
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=5)
+        for path, body in [('/cache/put', {'entries': [{'key': 'k'}]}), ('/cache/get', {'keys': 'k'}),
+                           ('/cache/put', {'entries': [{'key': 'k', 'fix': 'x', 'outcome': 'maybe'}]})]:
+            with self.subTest(path=path, body=body):
+                conn.request('POST', path, json.dumps(body), {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                self.assertEqual(response.status, 400)
+                self.assertIn('error', json.loads(response.read()))
+        conn.close()
+        print(f"[✓] Team cache server rejects bad requests")
+
+
+class TestTracing(unittest.TestCase):
+    """Test --trace spans (Chrome and OTLP output), time to first token and --profile."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = patch.TRACER, patch.PROFILER
+
+    def tearDown(self):
+        patch.TRACER, patch.PROFILER = self.saved
+        self.tmp.cleanup()
+
+    def trace(self, name):
+        patch.TRACER = patch.Tracer(os.path.join(self.tmp.name, name))
+        return patch.TRACER
+
+    def written(self, tracer):
+        import json
+        tracer.write()
+        with open(tracer.path) as f:
+            return json.load(f)
+
+    def test_chrome_trace_nests_phases_under_session(self):
+        """Test traced functions become complete events inside the session span."""
+        tracer = self.trace('run.json')
+        patch.categorize_error_type('bash: foo: command not found', 'foo')
+        with patch.trace_span('context.list', path='/tmp') as attrs:
+            attrs['entries'] = 3
+        events = self.written(tracer)['traceEvents']
+        spans = {e['name']: e for e in events if e['ph'] == 'X'}
+        self.assertEqual({'session', 'classify', 'context.list'}, set(spans))
+        self.assertEqual(spans['context.list']['args'], {'path': '/tmp', 'entries': 3})
+        session = spans['session']
+        for name in ('classify', 'context.list'):
+            self.assertGreaterEqual(spans[name]['ts'], session['ts'])
+            self.assertLessEqual(spans[name]['ts'] + spans[name]['dur'], session['ts'] + session['dur'])
+        print(f"[✓] Chrome trace records phases inside the session")
+
+    def test_fix_pack_lookup_is_one_span(self):
+        """Test that a fix-pack lookup, hit or miss, is traced once as a whole."""
+        tracer = self.trace('run.json')
+        with mock.patch.object(patch, 'fix_packs', lambda: ()):
+            patch.packed_fix('gti status', "git: 'stauts' is not a git command.")
+        events = self.written(tracer)['traceEvents']
+        self.assertEqual([e['name'] for e in events if e['ph'] == 'X' and e['name'].startswith('lookup')],
+                         ['lookup.fixpack'])
+        print(f"[✓] Fix-pack lookup traced as one span")
+
+    def test_otlp_trace_links_parents_and_errors(self):
+        """Test .otlp.json output: parent span ids, typed attributes and error status."""
+        tracer = self.trace('run.otlp.json')
+        with self.assertRaises(ValueError):
+            with patch.trace_span('outer', n=2):
+                with patch.trace_span('inner', ok=True):
+                    raise ValueError('boom')
+        doc = self.written(tracer)
+        spans = {s['name']: s for s in doc['resourceSpans'][0]['scopeSpans'][0]['spans']}
+        self.assertEqual(spans['inner']['parentSpanId'], spans['outer']['spanId'])
+        self.assertEqual(spans['outer']['parentSpanId'], spans['session']['spanId'])
+        self.assertNotIn('parentSpanId', spans['session'])
+        self.assertEqual({s['traceId'] for s in spans.values()}, {tracer.trace_id})
+        attributes = {a['key']: a['value'] for a in spans['outer']['attributes']}
+        self.assertEqual(attributes['n'], {'intValue': '2'})
+        self.assertEqual(spans['inner']['status'], {'code': 2, 'message': 'ValueError'})
+        print(f"[✓] OTLP trace links parents and marks errors")
+
+    def test_model_request_records_time_to_first_token(self):
+        """Test the traced model request streams and still returns whole responses."""
+        from types import SimpleNamespace as NS
+
+        class FakeCompletions:
+            def create(self, stream=False, n=1, **kwargs):
+                self.stream = stream
+                pieces = [(0, 'FIX: ls'), (1, 'FIX: pwd'), (0, ' -la'), (1, None)]
+                return iter([NS(choices=[NS(index=i, delta=NS(content=c))]) for i, c in pieces])
+
+        completions = FakeCompletions()
+        client = NS(chat=NS(completions=completions))
+        tracer = self.trace('run.json')
+        self.assertEqual(patch.create_fix_completions(client, 'prompt', n=2), ['FIX: ls -la', 'FIX: pwd'])
+        self.assertTrue(completions.stream)
+        events = self.written(tracer)['traceEvents']
+        llm = next(e for e in events if e['name'] == 'llm')
+        self.assertIn('time_to_first_token_ms', llm['args'])
+        self.assertEqual(llm['args']['response_chars'], len('FIX: ls -laFIX: pwd'))
+        self.assertTrue(any(e['name'] == 'first_token' and e['ph'] == 'i' for e in events))
+        print(f"[✓] Model request span records time to first token")
+
+    def test_tracing_off_is_passthrough(self):
+        """Test traced functions and spans do nothing extra without a tracer."""
+        patch.TRACER = None
+        self.assertEqual(patch.categorize_error_type('bash: foo: command not found', 'foo'),
+                         patch.categorize_error_type.__wrapped__('bash: foo: command not found', 'foo'))
+        with patch.trace_span('anything') as attrs:
+            attrs['ignored'] = True
+        patch.trace_event('nothing')
+        options, command = patch.parse_cli_options(['--trace', 'out.json', '--profile=out.prof', 'ls'])
+        self.assertEqual((options['trace'], options['profile'], command), ('out.json', 'out.prof', ['ls']))
+        print(f"[✓] Tracing is a passthrough when off")
+
+    def test_profile_is_dumped_at_exit(self):
+        """Test --profile stats are written for pstats."""
+        import cProfile
+        import pstats
+        path = os.path.join(self.tmp.name, 'run.prof')
+        patch.TRACER = None
+        patch.PROFILER = (cProfile.Profile(), path)
+        patch.PROFILER[0].enable()
+        patch.categorize_error_type('bash: foo: command not found', 'foo')
+        patch._finish_tracing()
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == 'categorize_error_type' for func in stats.stats))
+        print(f"[✓] Profile dumped at exit")
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the Prometheus textfile metrics: format, merging across processes and what is counted."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = patch.METRICS, patch.TRACER, patch.HISTORY_ENABLED
+        patch.TRACER, patch.HISTORY_ENABLED = None, False
+        patch.METRICS = patch.Metrics(self.tmp.name)
+
+    def tearDown(self):
+        patch.METRICS, patch.TRACER, patch.HISTORY_ENABLED = self.saved
+        self.tmp.cleanup()
+
+    def samples(self):
+        patch.METRICS.flush()
+        with open(os.path.join(self.tmp.name, 'patch.prom')) as f:
+            text = f.read()
+        return text, patch.parse_prom_samples(text)
+
+    def test_text_format_round_trips(self):
+        """Test HELP/TYPE lines, bucket order and label escaping survive a parse."""
+        patch.count_metric('patch_cache_hits_total', cache='fix"pack\\\n')
+        for seconds in (0.003, 0.2, 90):
+            patch.observe_metric('patch_phase_seconds', seconds, phase='llm')
+        text, samples = self.samples()
+        self.assertIn('# TYPE patch_phase_seconds histogram', text)
+        self.assertIn('# TYPE patch_cache_hits_total counter', text)
+        buckets = [line for line in text.splitlines() if line.startswith('patch_phase_seconds_bucket')]
+        self.assertTrue(buckets[0].endswith('le="0.001"} 0'))
+        self.assertTrue(buckets[-1].endswith('le="+Inf"} 3'))
+        self.assertEqual(samples[('patch_phase_seconds_bucket', (('phase', 'llm'), ('le', '0.25')))], 2)
+        self.assertEqual(samples[('patch_phase_seconds_count', (('phase', 'llm'),))], 3)
+        self.assertEqual(samples[('patch_cache_hits_total', (('cache', 'fix"pack\\\n'),))], 1)
+        self.assertEqual(patch.format_prom_samples(samples), text)
+        print(f"[✓] Metrics text format round trips")
+
+    def test_concurrent_flushes_add_up(self):
+        """Test flushes from several writers at once lose no updates."""
+        import threading
+        writers = [patch.Metrics(self.tmp.name) for _ in range(8)]
+
+        def work(metrics):
+            for i in range(50):
+                metrics.inc('patch_attempts_total')
+                metrics.observe('patch_prompt_tokens', 300)
+                if i % 10 == 0:
+                    metrics.flush()
+            metrics.flush()
+        threads = [threading.Thread(target=work, args=(metrics,)) for metrics in writers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _, samples = self.samples()
+        self.assertEqual(samples[('patch_attempts_total', ())], 400)
+        self.assertEqual(samples[('patch_prompt_tokens_bucket', (('le', '500'),))], 400)
+        self.assertEqual(samples[('patch_prompt_tokens_bucket', (('le', '250'),))], 0)
+        self.assertEqual(samples[('patch_prompt_tokens_sum', ())], 120000)
+        self.assertEqual([f for f in os.listdir(self.tmp.name) if not f.startswith('.patch.prom.lock')],
+                         ['patch.prom'])
+        print(f"[✓] Concurrent metric flushes add up")
+
+    def test_failed_flush_keeps_counts(self):
+        """Test counts survive a flush that cannot write, and are written by the next one."""
+        metrics = patch.Metrics(os.path.join(self.tmp.name, 'missing', 'dir'))
+        metrics.inc('patch_successes_total', 2)
+        metrics.observe('patch_prompt_tokens', 700)
+        with mock.patch('patch.tempfile.mkstemp', side_effect=PermissionError):
+            metrics.flush()
+        self.assertEqual(metrics.counters, {('patch_successes_total', ()): 2})
+        metrics.observe('patch_prompt_tokens', 50)
+        metrics.flush()
+        self.assertEqual((metrics.counters, metrics.histograms), ({}, {}))
+        with open(metrics.path) as f:
+            text = f.read()
+        self.assertIn('patch_successes_total 2', text)
+        self.assertIn('patch_prompt_tokens_bucket{le="100"} 1', text)
+        self.assertIn('patch_prompt_tokens_count 2', text)
+        print(f"[✓] Failed metric flush keeps counts")
+
+    def test_model_calls_attempts_and_phases_counted(self):
+        """Test model calls, rate limits, prompt tokens, fix attempts and traced phases are recorded."""
+        from types import SimpleNamespace as NS
+
+        class FakeCompletions:
+            fail = False
+
+            def create(self, **kwargs):
+                if self.fail:
+                    raise patch.RateLimitError.__new__(patch.RateLimitError)
+                return NS(choices=[NS(message=NS(content='FIX: ls'))], usage=NS(prompt_tokens=1200))
+
+        completions = FakeCompletions()
+        client = NS(chat=NS(completions=completions))
+        self.assertEqual(patch.create_fix_completions(client, 'prompt'), ['FIX: ls'])
+        completions.fail = True
+        with self.assertRaises(patch.RateLimitError):
+            patch.create_fix_completions(client, 'prompt')
+        patch.record_attempt('ls', 'error', 'ls -la', True, 0, 5)
+        patch.record_attempt('ls', 'error', 'ls -l', True, 2, 5)
+        patch.record_attempt('ls', 'error', 'ls -a', False, None, 5)
+        patch.categorize_error_type('bash: foo: command not found', 'foo')
+        _, samples = self.samples()
+        self.assertEqual(samples[('patch_llm_calls_total', (('outcome', 'ok'),))], 1)
+        self.assertEqual(samples[('patch_llm_calls_total', (('outcome', 'error'),))], 1)
+        self.assertEqual(samples[('patch_rate_limit_events_total', (('source', 'openai'),))], 1)
+        self.assertEqual(samples[('patch_prompt_tokens_sum', ())], 1200)
+        self.assertEqual(samples[('patch_attempts_total', ())], 2)
+        self.assertEqual(samples[('patch_successes_total', ())], 1)
+        self.assertEqual(samples[('patch_phase_seconds_count', (('phase', 'llm'),))], 2)
+        self.assertEqual(samples[('patch_phase_seconds_count', (('phase', 'classify'),))], 1)
+        print(f"[✓] Model calls, attempts and phases counted")
+
+
 class TestAPIKeyValidation(unittest.TestCase):
     """Test API key validation."""
 
@@ -351,7 +2715,33 @@ def run_test_suite():
     suite.addTests(loader.loadTestsFromTestCase(TestPlatformDetection))
     suite.addTests(loader.loadTestsFromTestCase(TestAppDetection))
     suite.addTests(loader.loadTestsFromTestCase(TestErrorCategorization))
+    suite.addTests(loader.loadTestsFromTestCase(TestErrorEvidence))
+    suite.addTests(loader.loadTestsFromTestCase(TestErrorCorpus))
+    suite.addTests(loader.loadTestsFromTestCase(TestLocalClassifier))
     suite.addTests(loader.loadTestsFromTestCase(TestPipeDetection))
+    suite.addTests(loader.loadTestsFromTestCase(TestCommandParsing))
+    suite.addTests(loader.loadTestsFromTestCase(TestInteractiveDetection))
+    suite.addTests(loader.loadTestsFromTestCase(TestOutputCapture))
+    suite.addTests(loader.loadTestsFromTestCase(TestExecutionTimeouts))
+    suite.addTests(loader.loadTestsFromTestCase(TestPtyExecution))
+    suite.addTests(loader.loadTestsFromTestCase(TestStreamSeparation))
+    suite.addTests(loader.loadTestsFromTestCase(TestResourceAccounting))
+    suite.addTests(loader.loadTestsFromTestCase(TestSandboxValidation))
+    suite.addTests(loader.loadTestsFromTestCase(TestFixResponseParser))
+    suite.addTests(loader.loadTestsFromTestCase(TestFixPreValidation))
+    suite.addTests(loader.loadTestsFromTestCase(TestBatchMode))
+    suite.addTests(loader.loadTestsFromTestCase(TestShellIntegration))
+    suite.addTests(loader.loadTestsFromTestCase(TestUnattendedMode))
+    suite.addTests(loader.loadTestsFromTestCase(TestLogDiagnosis))
+    suite.addTests(loader.loadTestsFromTestCase(TestFollowMode))
+    suite.addTests(loader.loadTestsFromTestCase(TestFixService))
+    suite.addTests(loader.loadTestsFromTestCase(TestAttemptHistory))
+    suite.addTests(loader.loadTestsFromTestCase(TestNegativeCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestFixPacks))
+    suite.addTests(loader.loadTestsFromTestCase(TestTeamCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestTracing))
+    suite.addTests(loader.loadTestsFromTestCase(TestMetrics))
+    suite.addTests(loader.loadTestsFromTestCase(TestCommandDetectors))
     suite.addTests(loader.loadTestsFromTestCase(TestAPIKeyValidation))
     suite.addTests(loader.loadTestsFromTestCase(TestResponseParsing))
 